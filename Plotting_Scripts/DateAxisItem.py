@@ -1,5 +1,6 @@
 import numpy as np
 import time
+from collections import OrderedDict
 from datetime import datetime
 from pyqtgraph.graphicsItems.AxisItem import AxisItem
 
@@ -20,12 +21,17 @@ def makeMSStepper(stepSize):
         val *= 1000
         f = stepSize * 1000
         return (val // (n*f) + 1) * (n*f) / 1000.0
+    # fixed spacing, so TickSpec can make all the ticks at once
+    stepper.stepSize = stepSize
+    stepper.scale = 1000
     return stepper
 
 
 def makeSStepper(stepSize):
     def stepper(val, n):
         return (val // (n*stepSize) + 1) * (n*stepSize)
+    stepper.stepSize = stepSize
+    stepper.scale = 1
     return stepper
 
 
@@ -33,7 +39,7 @@ def makeMStepper(stepSize):
     def stepper(val, n):
         d = datetime.utcfromtimestamp(val)
         base0m = (d.month + n*stepSize - 1)
-        d = datetime(d.year + base0m / 12, base0m % 12 + 1, 1)
+        d = datetime(d.year + base0m // 12, base0m % 12 + 1, 1)
         return (d - datetime(1970, 1, 1)).total_seconds()
     return stepper
 
@@ -73,8 +79,17 @@ class TickSpec:
         self.autoSkip = autoSkip
 
     def makeTicks(self, minVal, maxVal, minSpc):
-        ticks = []
         n = self.skipFactor(minSpc)
+        stepSize = getattr(self.step, 'stepSize', None)
+        if stepSize is not None:
+            # ticks are evenly spaced, so there's no need to step through them
+            # one at a time. Same arithmetic as the stepper, in whole units
+            unit = n * stepSize * self.step.scale
+            first = minVal * self.step.scale // unit + 1
+            last = maxVal * self.step.scale // unit
+            return (np.arange(first, last + 1) * unit / self.step.scale, n)
+        # months and years aren't all the same length
+        ticks = []
         x = self.step(minVal, n)
         while x <= maxVal:
             ticks.append(x)
@@ -94,7 +109,15 @@ class TickSpec:
 
 
 class ZoomLevel:
-    """ Generates the ticks which appear in a specific zoom level """
+    """ Generates the ticks which appear in a specific zoom level
+
+    The axis asks for its ticks on every repaint, which during live plotting
+    is several times a second while the range barely moves. The ticks are
+    made for the range rounded outward (to a power of 2 of about a quarter of
+    its width) and the last few are kept, so a repaint with the same or a
+    slightly shifted range only has to pick out the ticks that are in view """
+    cacheSize = 16
+
     def __init__(self, tickSpecs):
         """
         ============= ==========================================================
@@ -105,6 +128,7 @@ class ZoomLevel:
         """
         self.tickSpecs = tickSpecs
         self.utcOffset = 0
+        self.cache = OrderedDict()
 
     def tickValues(self, minVal, maxVal, minSpc):
         # return tick values for this format in the range minVal, maxVal
@@ -112,25 +136,46 @@ class ZoomLevel:
         # minSpc indicates the minimum spacing (in seconds) between two ticks
         # to fullfill the maxTicksPerPt constraint of the DateAxisItem at the
         # current zoom level. This is used for auto skipping ticks.
-        allTicks = []
         valueSpecs = []
         # back-project (minVal maxVal) to UTC, compute ticks then offset to
         # back to local time again
         utcMin = minVal - self.utcOffset
         utcMax = maxVal - self.utcOffset
+        quantum = 2.0 ** np.ceil(np.log2(max(utcMax - utcMin, 1e-3) / 4))
+        low = np.floor(utcMin / quantum) * quantum
+        high = np.ceil(utcMax / quantum) * quantum
+        skipFactors = tuple(spec.skipFactor(minSpc) for spec in self.tickSpecs)
+        key = (self.utcOffset, low, high, skipFactors)
+        levels = self.cache.get(key)
+        if levels is None:
+            levels = self.makeLevels(low, high, minSpc)
+            self.cache[key] = levels
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+
+        for spacing, ticks in levels:
+            ticks = ticks[(ticks > utcMin) & (ticks <= utcMax)]
+            # reposition tick labels to local time coordinates
+            valueSpecs.append((spacing, (ticks + self.utcOffset).tolist()))
+        return valueSpecs
+
+    def makeLevels(self, utcMin, utcMax, minSpc):
+        # list of (<avg spacing>, array of UTC tick positions)
+        levels = []
+        allTicks = np.empty(0)
         for spec in self.tickSpecs:
             ticks, skipFactor = spec.makeTicks(utcMin, utcMax, minSpc)
-            # reposition tick labels to local time coordinates
-            ticks += self.utcOffset
             # remove any ticks that were present in higher levels
-            tick_list = [x for x in ticks.tolist() if x not in allTicks]
-            allTicks.extend(tick_list)
-            valueSpecs.append((spec.spacing, tick_list))
+            ticks = ticks[~np.isin(ticks, allTicks)]
+            allTicks = np.concatenate([allTicks, ticks])
+            levels.append((spec.spacing, ticks))
             # if we're skipping ticks on the current level there's no point in
             # producing lower level ticks
             if skipFactor > 1:
                 break
-        return valueSpecs
+        return levels
 
 
 YEAR_MONTH_ZOOM_LEVEL = ZoomLevel([
@@ -0,0 +1,172 @@
+import io
+import os
+import numpy as np
+import binary_data
+
+__all__ = ['ColumnBuffer', 'CSVTail', 'BinaryTail', 'open_source']
+
+
+class ColumnBuffer:
+    """ Keeps each column in its own NumPy array that grows as rows are added.
+    The arrays have room to spare and double in size when they fill up, so
+    adding rows doesn't copy everything that came before each time """
+    def __init__(self, columns, capacity=4096):
+        self.columns = columns
+        self.length = 0
+        self.arrays = [np.empty(capacity) for _ in range(columns)]
+
+    def extend(self, rows):
+        """ Add a (rows x columns) array to the end """
+        rows = np.asarray(rows, dtype=float)
+        needed = self.length + len(rows)
+        if needed > len(self.arrays[0]):
+            capacity = max(needed, 2 * len(self.arrays[0]))
+            for ii, array in enumerate(self.arrays):
+                bigger = np.empty(capacity)
+                bigger[:self.length] = array[:self.length]
+                self.arrays[ii] = bigger
+        for ii, array in enumerate(self.arrays):
+            array[self.length:needed] = rows[:, ii]
+        self.length = needed
+
+    def column(self, ii):
+        """ The filled part of a column (a view, not a copy) """
+        return self.arrays[ii][:self.length]
+
+    def __len__(self):
+        return self.length
+
+
+class CSVTail:
+    """ Reads a CSV file that is still being written, the way "tail -f" does.
+    It remembers how far into the file it has read, and each call to
+    read_new() only reads what was added since then. A last line that doesn't
+    end in a newline yet (because the writer is in the middle of it) is held
+    back until the rest of it shows up.
+
+    ============= ==========================================================
+    Arguments
+    filename      the CSV file
+    delimiter     what separates the columns
+    comments      lines starting with this are skipped
+    ============= ==========================================================
+    """
+    def __init__(self, filename, delimiter=',', comments='#'):
+        self.filename = filename
+        self.delimiter = delimiter
+        self.comments = comments
+        self.offset = 0
+        self.partial = b''
+        self.labels = None
+        self.first_row = True       # whether the next row that isn't a comment is the first one in the file
+        self.buffer = None
+
+    def reset(self):
+        self.offset = 0
+        self.partial = b''
+        self.labels = None
+        self.first_row = True
+        self.buffer = None
+
+    def read_new(self):
+        """ Reads whatever was added to the file and returns the number of new
+        rows """
+        if os.path.getsize(self.filename) < self.offset:
+            # the file was replaced or cut short, so start over
+            self.reset()
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        self.offset += len(chunk)
+
+        text = self.partial + chunk
+        end = text.rfind(b'\n') + 1
+        self.partial = text[end:]
+        lines = [line for line in text[:end].decode().splitlines()
+                 if line.strip() and not line.startswith(self.comments)]
+        if not lines:
+            return 0
+
+        if self.first_row:
+            # the first row that isn't a comment is expected to be the labels. A broken row later on is skipped
+            self.first_row = False
+            if not self.is_numeric(lines[0]):
+                self.labels = [label.strip() for label in lines.pop(0).split(self.delimiter)]
+        rows = self.parse(lines)
+        if not len(rows):
+            return 0
+        if self.buffer is None:
+            self.buffer = ColumnBuffer(rows.shape[1])
+        self.buffer.extend(rows)
+        return len(rows)
+
+    def is_numeric(self, line):
+        try:
+            [float(value) for value in line.split(self.delimiter)]
+            return True
+        except ValueError:
+            return False
+
+    def parse(self, lines):
+        columns = None if self.buffer is None else self.buffer.columns
+        try:
+            rows = np.loadtxt(io.StringIO('\n'.join(lines)), delimiter=self.delimiter, ndmin=2)
+            if columns is None or rows.shape[1] == columns:
+                return rows
+        except ValueError:
+            pass
+        # something in there is broken, so go line by line and leave out the lines that don't fit
+        good = []
+        for line in lines:
+            try:
+                row = [float(value) for value in line.split(self.delimiter)]
+            except ValueError:
+                continue
+            if columns is None:
+                columns = len(row)
+            if len(row) == columns:
+                good.append(row)
+        return np.array(good, dtype=float).reshape(-1, columns or 0)
+
+    def column(self, ii):
+        if self.buffer is None:
+            return np.empty(0)
+        return self.buffer.column(ii)
+
+    @property
+    def columns(self):
+        return 0 if self.buffer is None else self.buffer.columns
+
+    def __len__(self):
+        return 0 if self.buffer is None else len(self.buffer)
+
+
+class BinaryTail:
+    """ Same as CSVTail for binary_data files. These are memory-mapped, so
+    reading new rows is just a matter of mapping the file again """
+    def __init__(self, filename):
+        self.filename = filename
+        self.source = binary_data.load(filename)
+        self.labels = self.source.columns
+
+    def read_new(self):
+        old = len(self.source)
+        self.source = binary_data.load(self.filename)
+        return max(len(self.source) - old, 0)
+
+    def column(self, ii):
+        return self.source.column(ii)
+
+    @property
+    def columns(self):
+        return len(self.labels)
+
+    def __len__(self):
+        return len(self.source)
+
+
+def open_source(filename):
+    """ The right kind of tail reader for a file """
+    if binary_data.is_binary(filename):
+        return BinaryTail(filename)
+    return CSVTail(filename)
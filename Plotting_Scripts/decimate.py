@@ -0,0 +1,54 @@
+import numpy as np
+
+__all__ = ['visible_range', 'peak_decimate']
+
+
+def visible_range(x, x_min, x_max):
+    """ Start and stop indices of the points between x_min and x_max (x has to
+    be sorted), plus one point on either side so the line runs off the edge of
+    the plot instead of stopping short of it """
+    start = max(int(np.searchsorted(x, x_min, 'left')) - 1, 0)
+    stop = min(int(np.searchsorted(x, x_max, 'right')) + 1, len(x))
+    return start, stop
+
+
+def peak_decimate(x, y, x_min, x_max, width):
+    """ Cuts a curve down to about 2 points per pixel before it is drawn.
+
+    The visible points are split into `width` bins, and only the lowest and
+    highest point in each bin is kept (in the order they came in). A screen
+    can't show more than that anyway, but unlike taking every n-th point,
+    spikes and glitches don't disappear when you zoom out. The bins have the
+    same number of points each, which assumes the points are spaced about
+    evenly in x (true for data taken at a steady rate).
+
+    ============= ==========================================================
+    Arguments
+    x, y          the whole curve, x sorted from low to high
+    x_min, x_max  the part of x that is in view
+    width         how many pixels wide the plot is
+    ============= ==========================================================
+
+    Returns the (x, y) to hand to the curve
+    """
+    start, stop = visible_range(x, x_min, x_max)
+    x = x[start:stop]
+    y = y[start:stop]
+    width = max(int(width), 1)
+    count = len(x)
+    if count <= 4 * width:
+        return x, y
+
+    per_bin = count // width
+    full = per_bin * width
+    bins = y[:full].reshape(width, per_bin)
+    offsets = np.arange(width) * per_bin
+    lowest = bins.argmin(axis=1) + offsets
+    highest = bins.argmax(axis=1) + offsets
+    keep = [np.sort(np.stack([lowest, highest], axis=1), axis=1).ravel()]
+    if full < count:
+        # the few points left over become one last bin
+        tail = y[full:]
+        keep.append(np.sort([full + tail.argmin(), full + tail.argmax()]))
+    keep = np.concatenate(keep)
+    return x[keep], y[keep]
@@ -0,0 +1,182 @@
+import os
+import numpy as np
+import binary_data
+
+__all__ = ['Pyramid', 'cache_name', 'file_stamp', 'open_pyramid']
+
+
+class Pyramid:
+    """ Level-of-detail copies of a data set for browsing long runs.
+
+    Level 1 splits the rows into bins of `factor` rows and keeps the lowest,
+    highest and average value of every column in each bin. Level 2 does the
+    same to level 1, and so on until a level has fewer than `min_bins` bins.
+    When the plot is zoomed out, it draws from the level that has about as
+    many bins in view as the plot has pixels, so it never has to touch every
+    row of the file.
+
+    A level is a dict of arrays:
+        x       average x of the bin
+        count   how many rows went into the bin
+        min     (bins x columns) lowest y values
+        max     (bins x columns) highest y values
+        mean    (bins x columns) average y values
+
+    A pyramid loaded from a file keeps the file open until close() is called,
+    or until the end of a `with` block:
+        with Pyramid.load(filename) as pyramid:
+            ...
+    """
+    names = ('x', 'count', 'min', 'max', 'mean')
+
+    def __init__(self, store, depth, factor, rows, stamp=None):
+        self.store = store          # a dict, or an np.load of a saved pyramid (which only reads a level when asked)
+        self.depth = depth
+        self.factor = factor
+        self.rows = rows
+        self.stamp = stamp          # the file_stamp of the data file it was made from, if known
+        self.loaded = {}
+
+    def close(self):
+        """ Closes the saved pyramid's file. Levels that were already read
+        stay usable """
+        if hasattr(self.store, 'close'):
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def build(cls, x, ys, factor=8, min_bins=512, chunk_rows=1 << 20):
+        """ x is the x column and ys a list of y columns. These can be memory-
+        mapped; they are read chunk_rows at a time so the whole file never has
+        to be in memory at once """
+        rows = len(x)
+        chunk_rows -= chunk_rows % factor
+        pieces = []
+        for start in range(0, rows, chunk_rows):
+            stop = min(start + chunk_rows, rows)
+            y = np.stack([np.asarray(column[start:stop], dtype=float) for column in ys], axis=1)
+            pieces.append(cls.reduce(np.asarray(x[start:stop], dtype=float), np.ones(stop - start),
+                                     y, y, y, factor))
+        level = {name: np.concatenate([piece[name] for piece in pieces]) for name in cls.names}
+
+        store = {}
+        depth = 0
+        while True:
+            depth += 1
+            for name in cls.names:
+                store[f'{name}_{depth}'] = level[name]
+            if len(level['x']) <= min_bins:
+                break
+            level = cls.reduce(level['x'], level['count'], level['min'], level['max'], level['mean'], factor)
+        return cls(store, depth, factor, rows)
+
+    @staticmethod
+    def reduce(x, count, low, high, mean, factor):
+        """ Combines every `factor` bins (or rows) into one """
+        edges = np.arange(0, len(x), factor)
+        total = np.add.reduceat(count, edges)
+        return {'x': np.add.reduceat(x * count, edges) / total,
+                'count': total,
+                'min': np.fmin.reduceat(low, edges, axis=0),
+                'max': np.fmax.reduceat(high, edges, axis=0),
+                'mean': np.add.reduceat(mean * count[:, None], edges, axis=0) / total[:, None]}
+
+    def level(self, depth):
+        if depth not in self.loaded:
+            self.loaded[depth] = {name: self.store[f'{name}_{depth}'] for name in self.names}
+        return self.loaded[depth]
+
+    def depth_for(self, rows_in_view, width):
+        """ The coarsest level that still has at least `width` bins in view
+        (0 means the rows themselves are few enough to draw) """
+        depth = 0
+        while depth < self.depth and rows_in_view / self.factor ** (depth + 1) >= width:
+            depth += 1
+        return depth
+
+    def query(self, column, x_min, x_max, rows_in_view, width, method='peak'):
+        """ Points to draw for y column number `column` between x_min and
+        x_max, for a plot `width` pixels wide. method is 'peak' (a min and max
+        point for each bin, so spikes stay visible) or 'mean'. Returns None if
+        the rows themselves should be drawn """
+        depth = self.depth_for(rows_in_view, width)
+        if depth == 0:
+            return None
+        level = self.level(depth)
+        x = level['x']
+        start = max(int(np.searchsorted(x, x_min)) - 1, 0)
+        stop = min(int(np.searchsorted(x, x_max, 'right')) + 1, len(x))
+        x = x[start:stop]
+        if method == 'mean':
+            return x, level['mean'][start:stop, column]
+        y = np.stack([level['min'][start:stop, column], level['max'][start:stop, column]], axis=1).ravel()
+        return np.repeat(x, 2), y
+
+    def save(self, filename, stamp):
+        """ Saves the pyramid with the modification time and size of the data
+        file (stamp), so it can tell later if the file changed """
+        temporary = filename + '.tmp.npz'
+        np.savez(temporary, stamp=np.array(stamp, dtype=float),
+                 info=np.array([self.depth, self.factor, self.rows]), **{key: self.store[key] for key in self.keys()})
+        os.replace(temporary, filename)
+
+    def keys(self):
+        return [f'{name}_{depth}' for depth in range(1, self.depth + 1) for name in self.names]
+
+    @classmethod
+    def load(cls, filename, stamp=None):
+        """ Opens a saved pyramid. Returns None if there isn't one or if it was
+        made from a different version of the data file """
+        try:
+            store = np.load(filename)
+        except (OSError, ValueError):
+            return None
+        if stamp is not None and not np.array_equal(store['stamp'], np.array(stamp, dtype=float)):
+            store.close()
+            return None
+        depth, factor, rows = (int(value) for value in store['info'])
+        return cls(store, depth, factor, rows, [float(value) for value in store['stamp']])
+
+
+def cache_name(filename):
+    """ Where the pyramid for a data file is kept: next to it """
+    return filename + '.lod.npz'
+
+
+def file_stamp(filename):
+    """ The modification time and size of a data file (for a binary_data
+    file, of the .bin holding the numbers) """
+    if binary_data.is_binary(filename):
+        filename = binary_data.data_name(filename)
+    status = os.stat(filename)
+    return [status.st_mtime, status.st_size]
+
+
+def open_pyramid(filename, source, factor=8):
+    """ Loads the pyramid for a data file from its cache, or builds it from
+    source (a data_source reader) and caches it if the file changed or there
+    isn't one yet. Returns None for a file with no rows """
+    if not len(source):
+        return None
+    stamp = file_stamp(filename)
+    if binary_data.is_binary(filename):
+        filename = binary_data.data_name(filename)
+    pyramid = Pyramid.load(cache_name(filename), stamp)
+    if pyramid is not None:
+        if pyramid.rows == len(source) and pyramid.factor == factor:
+            return pyramid
+        pyramid.close()
+
+    pyramid = Pyramid.build(source.column(0), [source.column(ii) for ii in range(1, source.columns)], factor)
+    pyramid.stamp = stamp
+    try:
+        pyramid.save(cache_name(filename), stamp)
+    except OSError:
+        # can't write next to the data (a read-only drive, say), so it just won't be cached
+        pass
+    return pyramid
@@ -0,0 +1,275 @@
+"""
+Example code created for the Quantum Forge course
+This code measures how many messages per second the server in gpib_comm_server can handle, and how long each client has
+to wait for its replies when several clients are sending messages at the same time.
+
+It starts a server in the background (talking to a simulated instrument from simulated.py, so no hardware is needed),
+runs a number of clients against it for a while, and reports the throughput, the latency percentiles, how long the
+clients spent connecting, and how long messages spent waiting in line for the bus (or, for server_gpib, for the global
+lock). The results can be saved as JSON, so
+you can compare a run before and after changing the server:
+```
+python benchmark.py --server concurrent --clients 8 --mode pooled --output after.json --compare before.json
+```
+
+@author: Teddy Tortorici
+"""
+
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+import numpy as np
+import gpib
+import gpib_client_tools as client
+import gpib_protocol as protocol
+import gpib_comm_server as server
+import simulated
+
+
+SERVERS = ["echo", "gpib", "concurrent"]
+MODES = ["oneshot", "pooled"]
+
+
+def parse_mix(mix: str) -> dict:
+    """Turns "KRDG? A=4,HTR?=1" into {"KRDG? A": 4., "HTR?": 1.}"""
+    weights = {}
+    for item in mix.split(','):
+        message, _, weight = item.rpartition('=')
+        weights[message.strip()] = float(weight)
+    return weights
+
+
+class TimedLakeShore(simulated.SimulatedLakeShore):
+    """Adds up how long the simulated bus was busy, which for server_gpib is how long it held its global lock"""
+    def __init__(self, **kwargs):
+        super(TimedLakeShore, self).__init__(**kwargs)
+        self.time_busy = 0.
+
+    def wait(self, message: str):
+        started = time.perf_counter()
+        super(TimedLakeShore, self).wait(message)
+        self.time_busy += time.perf_counter() - started
+
+
+def start_server(kind: str, port: int, latency: float, jitter: float, cache: bool = True):
+    """Start a server in a background thread. Returns a function that stops it again and gives back the server's
+    BusWorkers and the simulated instrument"""
+    backend = None
+    # logging every message would slow the server down and bury the results
+    server.setup_logging("WARNING")
+    if kind != "echo":
+        backend = TimedLakeShore(latency=latency, jitter=jitter)
+        server.Interpreter.devices.add("LS", gpib.Device(8, backend=backend))
+        server.Interpreter.cache = server.ResponseCache() if cache else server.ResponseCache(ttls={})
+
+    if kind == "concurrent":
+        concurrent_server = server.ConcurrentServer(port=port)
+        thread = threading.Thread(target=concurrent_server.serve_forever, daemon=True)
+    else:
+        concurrent_server = None
+        if kind == "echo":
+            thread = threading.Thread(target=server.server_echo_rev, kwargs={"port": port}, daemon=True)
+        else:
+            thread = threading.Thread(target=server.server_gpib, kwargs={"port": port, "log_level": "WARNING"},
+                                      daemon=True)
+    thread.start()
+
+    # wait until the server is listening
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+    def stop():
+        if concurrent_server is not None:
+            workers = list(concurrent_server.workers.values())
+            concurrent_server.shutdown()
+        else:
+            workers = []
+            with socket.create_connection(("localhost", port)) as s:
+                s.sendall(b"shutdown")
+        thread.join(timeout=5)
+        return workers, backend
+    return stop
+
+
+def run_client(mode: str, port: int, messages: list, weights: list, end_time: float, seed: int, results: dict):
+    """Send messages to the server until end_time, keeping track of how long each one took"""
+    rng = random.Random(seed)
+    latencies = []
+    connect_times = []
+    errors = 0
+    device = client.Device("LS", port=port, persistent=True) if mode == "pooled" else None
+
+    while time.perf_counter() < end_time:
+        msg = rng.choices(messages, weights)[0]
+        full_msg = f"LS::Q::{msg}"
+        try:
+            start = time.perf_counter()
+            if mode == "oneshot":
+                with socket.create_connection(("localhost", port)) as s:
+                    connect_times.append(time.perf_counter() - start)
+                    s.sendall(full_msg.encode())
+                    s.shutdown(socket.SHUT_WR)
+                    reply = protocol.recv_all(s).decode()
+            else:
+                reply = device.query(msg)
+            latencies.append(time.perf_counter() - start)
+            if not reply or "timed out" in reply or reply.startswith("error"):
+                errors += 1
+        except OSError:
+            errors += 1
+    results["latencies"].extend(latencies)
+    results["connect_times"].extend(connect_times)
+    results["errors"] += errors
+
+
+def summarize(times: list) -> dict:
+    """Mean and percentiles in milliseconds"""
+    if not times:
+        return None
+    times = np.array(times) * 1e3
+    return {"mean": float(times.mean()),
+            "p50": float(np.percentile(times, 50)),
+            "p95": float(np.percentile(times, 95)),
+            "p99": float(np.percentile(times, 99)),
+            "max": float(times.max())}
+
+
+def run_benchmark(server_kind: str = "concurrent", clients: int = 4, duration: float = 5., mode: str = "oneshot",
+                  mix: str = "KRDG? A=4,KRDG? B=4,HTR?=1,SETP? 1=1", latency: float = 0.025, jitter: float = 0.004,
+                  port: int = 62590, cache: bool = True, seed: int = 0) -> dict:
+    """Run one benchmark and return the configuration and results as a dictionary"""
+    if mode == "pooled" and server_kind != "concurrent":
+        raise ValueError("pooled clients need the concurrent server")
+    config = {"server": server_kind, "clients": clients, "duration": duration, "mode": mode, "mix": mix,
+              "latency": latency, "jitter": jitter, "cache": cache, "seed": seed}
+    weights = parse_mix(mix)
+    stop = start_server(server_kind, port, latency, jitter, cache)
+
+    results = {"latencies": [], "connect_times": [], "errors": 0}
+    start = time.perf_counter()
+    end_time = start + duration
+    threads = []
+    for ii in range(clients):
+        # every client keeps its own lists, and they get combined at the end
+        own = {"latencies": [], "connect_times": [], "errors": 0}
+        thread = threading.Thread(target=run_client, args=(mode, port, list(weights), list(weights.values()),
+                                                           end_time, seed + ii, own))
+        thread.own = own
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+        for key in ("latencies", "connect_times"):
+            results[key].extend(thread.own[key])
+        results["errors"] += thread.own["errors"]
+    elapsed = time.perf_counter() - start
+
+    client.close_connections()
+    workers, backend = stop()
+
+    bus = None
+    if workers:
+        jobs = sum(worker.jobs_done for worker in workers)
+        waiting = sum(worker.time_waiting for worker in workers)
+        busy = sum(worker.time_busy for worker in workers)
+        bus = {"jobs": jobs,
+               "time_waiting_s": waiting,
+               "mean_wait_ms": waiting / jobs * 1e3 if jobs else 0.,
+               "utilization": busy / elapsed / len(workers)}
+
+    # server_gpib makes every connection wait for one global lock. It handles connections one at a time, so that wait
+    # happens in the socket's backlog before the server even accepts the connection, where the server can't time it.
+    # Instead, it is whatever part of the clients' latency the server didn't spend running messages
+    lock = None
+    if server_kind == "gpib" and results["latencies"]:
+        busy = backend.time_busy
+        waiting = max(sum(results["latencies"]) - busy, 0.)
+        lock = {"connections": len(results["connect_times"]),
+                "time_waiting_s": waiting,
+                "mean_wait_ms": waiting / len(results["latencies"]) * 1e3,
+                "utilization": busy / elapsed}
+
+    return {"config": config,
+            "results": {"requests": len(results["latencies"]),
+                        "errors": results["errors"],
+                        "elapsed_s": elapsed,
+                        "throughput": len(results["latencies"]) / elapsed,
+                        "latency_ms": summarize(results["latencies"]),
+                        "connect_ms": summarize(results["connect_times"]),
+                        "connections": len(results["connect_times"]),
+                        "bus": bus,
+                        "lock": lock}}
+
+
+def compare(old: dict, new: dict):
+    """Print how the throughput and latency changed between two runs"""
+    def change(a, b):
+        return f"{a:10.2f} -> {b:10.2f}  ({(b - a) / a * 100 if a else 0.:+.1f}%)"
+    print(f"throughput (1/s) {change(old['results']['throughput'], new['results']['throughput'])}")
+    for key in ("p50", "p95", "p99"):
+        print(f"latency {key} (ms) {change(old['results']['latency_ms'][key], new['results']['latency_ms'][key])}")
+    old_wait, new_wait = mean_wait(old), mean_wait(new)
+    if old_wait is not None and new_wait is not None:
+        print(f"mean wait (ms) {change(old_wait, new_wait)}")
+
+
+def mean_wait(report: dict):
+    """How long messages waited for the bus (or connections for the lock) on average in ms, if it was measured"""
+    for name in ("bus", "lock"):
+        if report["results"].get(name):
+            return report["results"][name]["mean_wait_ms"]
+    return None
+
+
+def print_report(report: dict):
+    results = report["results"]
+    print(f"{report['config']}")
+    print(f"{results['requests']} requests, {results['errors']} errors in {results['elapsed_s']:.2f} s: "
+          f"{results['throughput']:.1f} per second")
+    for name in ("latency_ms", "connect_ms"):
+        if results[name]:
+            print(f"{name}: " + ", ".join(f"{key} {value:.2f}" for key, value in results[name].items()))
+    if results["bus"]:
+        print(f"bus: {results['bus']['jobs']} jobs, mean wait {results['bus']['mean_wait_ms']:.2f} ms, "
+              f"utilization {results['bus']['utilization'] * 100:.0f}%")
+    if results.get("lock"):
+        lock = results["lock"]
+        print(f"lock: {lock['connections']} connections, mean wait {lock['mean_wait_ms']:.2f} ms, "
+              f"utilization {lock['utilization'] * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gpib_comm_server against a simulated instrument")
+    parser.add_argument("--server", choices=SERVERS, default="concurrent")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5., help="seconds each client sends messages for")
+    parser.add_argument("--mode", choices=MODES, default="oneshot",
+                        help="oneshot: new connection for every message, "
+                             "pooled: share one multiplexed connection (concurrent server only)")
+    parser.add_argument("--mix", default="KRDG? A=4,KRDG? B=4,HTR?=1,SETP? 1=1",
+                        help="queries to send and how often, as message=weight,message=weight")
+    parser.add_argument("--latency", type=float, default=0.025, help="simulated bus time per message in seconds")
+    parser.add_argument("--jitter", type=float, default=0.004)
+    parser.add_argument("--no-cache", action="store_true", help="turn off the server's response cache")
+    parser.add_argument("--port", type=int, default=62590)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.server, args.clients, args.duration, args.mode, args.mix, args.latency, args.jitter,
+                           args.port, not args.no_cache, args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
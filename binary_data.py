@@ -0,0 +1,134 @@
+"""
+Example code created for the Quantum Forge course
+This code saves data as raw binary numbers instead of text, which makes big data files much faster to save and load.
+
+A CSV file has to be turned back from text into numbers every time it's loaded, which gets slow once a file has millions
+of rows. Here, every row is saved as a block of 8-byte (little-endian float64) numbers in a ".bin" file, and the column
+names and comments are saved next to it in a ".json" file with the same name. Since every row takes the same number of
+bytes, reading the file back doesn't involve any conversion: it is opened "memory-mapped" (np.memmap), so the operating
+system only reads the parts of the file you actually look at. Pulling an hour out of a week-long run only reads that
+hour from the disk.
+```
+import binary_data
+
+with binary_data.BinaryDataWriter("run.bin", columns=["Time (s)", "Stage A (K)"]) as f:
+    f.append([0.0, 300.1])
+    f.append_rows(np.array([[1.0, 300.0], [2.0, 299.9]]))
+
+data = binary_data.load("run.bin")
+last_hour = data.time_slice(data.data[-1, 0] - 3600, data.data[-1, 0])
+```
+
+@author: Teddy Tortorici
+"""
+
+import json
+import os
+import time
+import numpy as np
+
+
+DTYPE = np.dtype("<f8")
+
+
+def header_name(filename: str) -> str:
+    """The .json file that goes with a .bin file"""
+    return os.path.splitext(filename)[0] + ".json"
+
+
+def data_name(filename: str) -> str:
+    """The .bin file that goes with a .json file"""
+    return os.path.splitext(filename)[0] + ".bin"
+
+
+class BinaryDataWriter:
+    """Adds rows to the end of a binary data file. If the file already exists, new rows are added after the old ones
+    (the columns have to match)"""
+    def __init__(self, filename: str, columns: list, comments: list = None):
+        self.filename = data_name(filename)
+        self.columns = list(columns)
+        self.header = {"columns": self.columns,
+                       "dtype": DTYPE.str,
+                       "created": time.ctime(time.time()),
+                       "comments": list(comments or [])}
+        if os.path.exists(header_name(self.filename)):
+            with open(header_name(self.filename), 'r') as f:
+                old_header = json.load(f)
+            if old_header["columns"] != self.columns:
+                raise ValueError(f"{self.filename} already has the columns {old_header['columns']}")
+            old_header["comments"] += self.header["comments"]
+            self.header = old_header
+        self.write_header()
+        self.file = open(self.filename, 'ab')
+
+    def write_header(self):
+        with open(header_name(self.filename), 'w') as f:
+            json.dump(self.header, f, indent=1)
+
+    def add_comment(self, comment: str):
+        self.header["comments"].append(str(comment))
+        self.write_header()
+
+    def append(self, row):
+        """Add one row"""
+        self.append_rows([row])
+
+    def append_rows(self, rows):
+        """Add a block of rows (a list of rows or a 2-D array)"""
+        rows = np.asarray(rows, dtype=DTYPE)
+        if rows.ndim != 2 or rows.shape[1] != len(self.columns):
+            raise ValueError(f"rows need {len(self.columns)} columns, got an array shaped {rows.shape}")
+        self.file.write(np.ascontiguousarray(rows).tobytes())
+        # so anything reading the file while it's being written sees the new rows
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BinaryData:
+    """A binary data file opened for reading. data is a (rows x columns) array mapped onto the file, so nothing is read
+    from the disk until you use it (np.array(data.data) reads it all into memory)"""
+    def __init__(self, filename: str):
+        self.filename = data_name(filename)
+        with open(header_name(self.filename), 'r') as f:
+            self.header = json.load(f)
+        self.columns = self.header["columns"]
+        self.comments = self.header["comments"]
+        dtype = np.dtype(self.header["dtype"])
+        row_bytes = dtype.itemsize * len(self.columns)
+        # a row that is only partly written (because the file is still being written) is left off
+        rows = os.path.getsize(self.filename) // row_bytes
+        if rows:
+            self.data = np.memmap(self.filename, dtype=dtype, mode='r', shape=(rows, len(self.columns)))
+        else:
+            self.data = np.empty((0, len(self.columns)), dtype=dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    def column(self, name) -> np.ndarray:
+        """One column, by name or by number"""
+        index = self.columns.index(name) if isinstance(name, str) else name
+        return self.data[:, index]
+
+    def time_slice(self, start: float, stop: float, time_column=0) -> np.ndarray:
+        """The rows with start <= time < stop, assuming the time column only goes up. Only those rows are read"""
+        times = self.column(time_column)
+        first, last = np.searchsorted(times, [start, stop])
+        return self.data[first:last]
+
+
+def load(filename: str) -> BinaryData:
+    return BinaryData(filename)
+
+
+def is_binary(filename: str) -> bool:
+    """Whether a file name looks like a binary data file (or its header)"""
+    return os.path.splitext(filename)[1].lower() in (".bin", ".json")
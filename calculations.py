@@ -7,52 +7,185 @@ You can import these into any other .py file
 @author: Teddy Tortorici
 """
 
+import os
+import collections
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import scipy
 from scipy import special
+import get
 
 
 # global constants
 eps0 = 8.85e-6  # electric constant in pF/um
 
 
-def capacitance(g: float, u: float, N: float, L: float, hS: float, epsS: float) -> float:
+def capacitance(g: float, u: float, N: float, L: float, hS: float, epsS: float, fast: bool = False) -> float:
     """
-    calculates the capacitance of an interdigital capacitor
+    calculates the capacitance of an interdigital capacitor. Every parameter can also be a NumPy array, and arrays of
+    different shapes are broadcast together like in any NumPy operation
     g - size of gap in um
     u - unit cell size in um
     N - number of fingers
     L - length of fingers in um
-    hS - thickness of substrate
+    hS - thickness of substrate in um (np.inf for a substrate much thicker than the unit cell)
     epsS - relative dielectric constant of the substrate (unitless)
+    fast - use the lookup table for the elliptic integrals (see EllipticTable)
     output - capacitance in pF
     """
     ka = k_ell(g, u)
     kS = k_ell(g, u, hS)
-    return 2 * (N - 1) * L * eps0 * (elliptic_over_comp(ka) + (epsS - 1) * elliptic_over_comp(kS) / 2)
+    return 2 * (N - 1) * L * eps0 * (elliptic_over_comp(ka, fast) + (epsS - 1) * elliptic_over_comp(kS, fast) / 2)
 
 
-def elliptic_over_comp(k):
+def elliptic_over_comp(k, fast: bool = False):
     """Calculates the elliptic integral divided by its compliment to reduce the amount of typing in the capacitance
-    calculation"""
+    calculation. fast uses the lookup table from elliptic_table() instead, which is several times quicker for big
+    arrays"""
+    if fast:
+        return elliptic_table()(k)
     return special.ellipk(k) / special.ellipk(np.sqrt(1 - k**2))
 
 
+class EllipticTable:
+    """
+    A lookup table for elliptic_over_comp, which is where capacitance spends most of its time.
+    The values are tabulated at evenly spaced k between k_min and k_max, and in between them a cubic is drawn through
+    the 4 nearest values. The table starts small and doubles until the largest relative error, measured at 8 points
+    inside every interval, is below rel_tol. That measured error is kept in max_rel_error. It is only checked at those
+    points, not everywhere in between, so it is a very good estimate of the error rather than a guarantee. If the
+    table reaches max_size without getting there (or values are given that don't), a ValueError is raised. Any k
+    outside [k_min, k_max] (where the elliptic integrals blow up and a cubic can't follow them) is calculated exactly.
+    k_min, k_max - range of k covered by the table
+    rel_tol - largest relative error allowed
+    """
+    max_size = 1 << 22
+
+    def __init__(self, k_min: float = 0.01, k_max: float = 0.99, rel_tol: float = 1e-9, values: np.ndarray = None):
+        self.k_min = float(k_min)
+        self.k_max = float(k_max)
+        self.rel_tol = float(rel_tol)
+        if values is None:
+            size = 512
+            while True:
+                self.make_coefficients(self.tabulate(size))
+                self.max_rel_error = self.measure_error()
+                if self.max_rel_error <= self.rel_tol or size >= self.max_size:
+                    break
+                size *= 2
+        else:
+            self.make_coefficients(values)
+            self.max_rel_error = self.measure_error()
+        if self.max_rel_error > self.rel_tol:
+            raise ValueError(f"a table of {self.size} values has a relative error of {self.max_rel_error:.2g}, "
+                             f"which is more than rel_tol={self.rel_tol:g}")
+
+    def tabulate(self, size: int) -> np.ndarray:
+        """Exact values at size evenly spaced k, plus one more on each end for the cubics at the edges"""
+        step = (self.k_max - self.k_min) / (size - 1)
+        return elliptic_over_comp(self.k_min + step * np.arange(-1, size + 1))
+
+    def make_coefficients(self, values: np.ndarray):
+        """For each interval, the cubic a + b t + c t^2 + d t^3 (t from 0 to 1 across the interval) through the
+        values at its ends and at the ends of the intervals on either side"""
+        self.values = values
+        self.size = len(values) - 2
+        self.step = (self.k_max - self.k_min) / (self.size - 1)
+        before, start, end, after = values[:-3], values[1:-2], values[2:-1], values[3:]
+        self.a = start.copy()
+        self.b = -before / 3 - start / 2 + end - after / 6
+        self.c = before / 2 - start + end / 2
+        self.d = -before / 6 + start / 2 - end / 2 + after / 6
+
+    def measure_error(self) -> float:
+        k = np.linspace(self.k_min, self.k_max, 8 * (self.size - 1) + 1)
+        return float(np.max(np.abs(self.interpolate(k) / elliptic_over_comp(k) - 1)))
+
+    def interpolate(self, k: np.ndarray, chunk_size: int = 1 << 14) -> np.ndarray:
+        """Evaluate the cubics (k has to be inside the table). Big arrays are done a chunk at a time, so the temporary
+        arrays stay in the CPU's cache"""
+        k = np.asarray(k, dtype=float)
+        flat = k.ravel()
+        result = np.empty_like(flat)
+        for start in range(0, len(flat), chunk_size):
+            x = (flat[start:start + chunk_size] - self.k_min) * (1 / self.step)
+            index = x.astype(np.intp)
+            np.clip(index, 0, self.size - 2, out=index)
+            t = x - index
+            y = self.d.take(index)
+            for coefficient in (self.c, self.b, self.a):
+                y *= t
+                y += coefficient.take(index)
+            result[start:start + chunk_size] = y
+        return result.reshape(k.shape)
+
+    def __call__(self, k):
+        k = np.asarray(k, dtype=float)
+        inside = (k >= self.k_min) & (k <= self.k_max)
+        if inside.all():
+            return self.interpolate(k)
+        result = np.empty_like(k)
+        result[inside] = self.interpolate(k[inside])
+        result[~inside] = elliptic_over_comp(k[~inside])
+        return result[()]
+
+    @staticmethod
+    def file_name(folder: str, k_min: float, k_max: float, rel_tol: float) -> str:
+        return os.path.join(folder, f"elliptic_table_{k_min:g}_{k_max:g}_{rel_tol:g}.npz")
+
+    def save(self, folder: str):
+        file_name = self.file_name(folder, self.k_min, self.k_max, self.rel_tol)
+        np.savez(file_name, values=self.values, scipy_version=scipy.__version__)
+
+    @classmethod
+    def load_or_build(cls, k_min: float = 0.01, k_max: float = 0.99, rel_tol: float = 1e-9, folder: str = None):
+        """Loads the table from folder (get.cache_folder() if None), or builds it and saves it there if it isn't there
+        yet or was made with a different version of scipy"""
+        folder = get.cache_folder() if folder is None else folder
+        try:
+            with np.load(cls.file_name(folder, k_min, k_max, rel_tol)) as saved:
+                if str(saved['scipy_version']) == scipy.__version__:
+                    return cls(k_min, k_max, rel_tol, values=saved['values'])
+        except (OSError, KeyError, ValueError):
+            pass
+        table = cls(k_min, k_max, rel_tol)
+        try:
+            table.save(folder)
+        except OSError:
+            pass
+        return table
+
+
+_elliptic_table = None
+
+
+def elliptic_table() -> EllipticTable:
+    """The table used by elliptic_over_comp(k, fast=True), loaded (or built) the first time it's needed"""
+    global _elliptic_table
+    if _elliptic_table is None:
+        _elliptic_table = EllipticTable.load_or_build()
+    return _elliptic_table
+
+
 def k_ell(g, u, h=None):
     """
-    Calculates the k in K(k) for elliptic integrals. If h is not given, it is assumed it is large, and the
-    large h approximation is used
+    Calculates the k in K(k) for elliptic integrals. If h is not given (or is 0), it is assumed it is large, and the
+    large h approximation is used. Any of the parameters can be arrays, and elements of h that are 0 or np.inf use
+    the large h approximation too
     g - gap size in um
     u - unit cell size in um
     h - thickness of material in um
     """
-    # if h is given, calculate h using it
-    if h:
+    # if h >> u, then you don't have to give h, and this approximation is valid
+    k_large_h = (u - g) / (u + g) * np.sqrt(2 * (u - g) / (2 * u - g))
+    if h is None:
+        return k_large_h
+    # if h is given, calculate k using it
+    h = np.asarray(h, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
         k = sinhpi4(u - g, h) / sinhpi4(u + g, h) * np.sqrt((sinhpi4(3 * u - g, h) ** 2 - sinhpi4(u + g, h) ** 2)
                                                             / (sinhpi4(3 * u - g, h) ** 2 - sinhpi4(u - g, h) ** 2))
-    # if h >> u, then you don't have to give h, and this approximation is valid
-    else:
-        k = (u - g) / (u + g) * np.sqrt(2 * (u - g) / (2 * u - g))
-    return k
+    return np.where(np.isinf(h) | (h == 0), k_large_h, k)
 
 
 def sinhpi4(x, h):
@@ -67,3 +200,209 @@ def cap_common(g):
     thick piece of silica with 50 1mm long fingers with the only variable likely changing from capacitor to capacitor
     being the gap thickness (which could be due to variability in an etch process)."""
     return capacitance(g=g, u=20, N=50, L=1000, hS=500, epsS=3.9)
+
+
+class SweepResult:
+    """The result of sweep: values has one axis for every swept parameter, in the order they were given
+    names - the names of the swept parameters
+    axes - {name: the values that parameter took}
+    fixed - {name: value} of the parameters that weren't swept"""
+    def __init__(self, values: np.ndarray, axes: dict, fixed: dict):
+        self.values = values
+        self.axes = axes
+        self.names = list(axes)
+        self.fixed = fixed
+
+    def sel(self, **coordinates):
+        """Pick out the result at the nearest swept value of each parameter given, e.g. result.sel(g=2, N=50). Axes
+        not given are kept"""
+        index = []
+        axes = {}
+        for name in self.names:
+            if name in coordinates:
+                index.append(int(np.argmin(np.abs(self.axes[name] - coordinates[name]))))
+            else:
+                index.append(slice(None))
+                axes[name] = self.axes[name]
+        values = self.values[tuple(index)]
+        if not axes:
+            return float(values)
+        fixed = dict(self.fixed)
+        fixed.update({name: self.axes[name][ii] for name, ii in zip(self.names, index) if name not in axes})
+        return SweepResult(values, axes, fixed)
+
+    def to_xarray(self):
+        """The same thing as an xarray.DataArray (needs xarray installed)"""
+        import xarray
+        return xarray.DataArray(self.values, coords=self.axes, dims=self.names, attrs=self.fixed)
+
+    def __repr__(self):
+        shape = ', '.join(f"{name}: {len(self.axes[name])}" for name in self.names)
+        return f"SweepResult({shape}, fixed={self.fixed})"
+
+
+_sweep_job = {}         # what each worker process is sweeping, set once by _start_sweep_worker
+
+
+def _start_sweep_worker(function, axes, fixed):
+    _sweep_job.update(function=function, axes=axes, fixed=fixed)
+
+
+def _sweep_chunk(start: int, stop: int) -> tuple:
+    """Evaluate the points start to stop of the grid (counting through it in order, like np.ravel)"""
+    axes = _sweep_job['axes']
+    shape = tuple(len(values) for values in axes.values())
+    if not shape:
+        # nothing is swept, so the grid is a single point
+        return start, np.atleast_1d(_sweep_job['function'](**_sweep_job['fixed']))
+    indices = np.unravel_index(np.arange(start, stop), shape)
+    parameters = {name: values[index] for (name, values), index in zip(axes.items(), indices)}
+    return start, _sweep_job['function'](**parameters, **_sweep_job['fixed'])
+
+
+def sweep(function=capacitance, chunk_size: int = 1_000_000, processes: int = None, **parameters) -> SweepResult:
+    """
+    Evaluates function (capacitance by default) on every combination of the parameters given as lists or arrays, e.g.
+        sweep(g=np.linspace(1, 5, 100), u=[10, 20, 40], N=np.arange(10, 200), L=1000, hS=500, epsS=3.9)
+    Parameters given as a single number are the same at every point (if every parameter is, the result has shape ()).
+    The grid is worked through chunk_size points at a time, so only the result (and not every combination of the
+    parameters) has to fit in memory, and the chunks are spread across processes worker processes (all the CPUs if
+    None, and 1 does everything in this process). With more than 1 process, function has to be defined at the top
+    level of a module, and on Windows the script calling this needs an if __name__ == "__main__": block
+    """
+    axes = {}
+    fixed = {}
+    for name, value in parameters.items():
+        if np.ndim(value) == 0:
+            fixed[name] = value
+        else:
+            axes[name] = np.asarray(value).ravel()
+    shape = tuple(len(values) for values in axes.values())
+    total = int(np.prod(shape))
+    result = np.empty(total)
+    chunks = [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+
+    processes = os.cpu_count() if processes is None else processes
+    if processes <= 1 or len(chunks) <= 1:
+        _start_sweep_worker(function, axes, fixed)
+        for start, stop in chunks:
+            result[start:stop] = _sweep_chunk(start, stop)[1]
+        _sweep_job.clear()
+    else:
+        with ProcessPoolExecutor(processes, initializer=_start_sweep_worker,
+                                 initargs=(function, axes, fixed)) as pool:
+            # only a couple of chunks per process are handed out at a time, so finished chunks don't pile up
+            waiting = set()
+            for start, stop in chunks:
+                if len(waiting) >= 2 * processes:
+                    done, waiting = wait(waiting, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        first, values = future.result()
+                        result[first:first + len(values)] = values
+                waiting.add(pool.submit(_sweep_chunk, start, stop))
+            for future in waiting:
+                first, values = future.result()
+                result[first:first + len(values)] = values
+    return SweepResult(result.reshape(shape), axes, fixed)
+
+
+Solution = collections.namedtuple('Solution', ['value', 'converged', 'iterations', 'residual'])
+Solution.__doc__ = """The result of solve_for. Each is an array with one element per device
+value - the value of the parameter that was solved for (nan where it wasn't bracketed)
+converged - True where the value was found to within the tolerance
+iterations - how many times function was evaluated for each element after the ends of the bracket
+residual - function at value minus the target"""
+
+
+def solve_for(name: str, target, low, high, function=capacitance, rel_tol: float = 1e-10, max_iter: int = 100,
+              **parameters) -> Solution:
+    """
+    Finds the value of the parameter name that makes function (capacitance by default) give target, for every element
+    of target at once, e.g. the gap of every device on a wafer from its measured capacitance:
+        solve_for('g', measured, low=0.01, high=20, u=20, N=50, L=1000, hS=500, epsS=3.9)
+    The answer has to be between low and high, and function has to cross target exactly once in that range. target,
+    low, high, and the other parameters can be numbers or arrays (which are broadcast together).
+    Each step tries the secant through the last two points, and bisects instead if that lands outside the bracket or
+    the bracket didn't at least halve over the last two steps, so it is nearly as quick as Newton's method near the
+    answer but can't run away from it. Elements stop being worked on as soon as the bracket (or the last step) is
+    smaller than rel_tol times the value, or function hits target exactly, so each step only evaluates function for
+    the ones still going
+    """
+    arrays = {key: value for key, value in parameters.items() if np.ndim(value) > 0}
+    fixed = {key: value for key, value in parameters.items() if np.ndim(value) == 0}
+    broadcast = np.broadcast_arrays(np.asarray(target, dtype=float), np.asarray(low, dtype=float),
+                                    np.asarray(high, dtype=float), *[np.asarray(value) for value in arrays.values()])
+    shape = broadcast[0].shape
+    target, a, b = [array.astype(float).ravel() for array in broadcast[:3]]
+    arrays = {key: array.ravel() for key, array in zip(arrays, broadcast[3:])}
+
+    def residual(x, where):
+        subset = {key: array[where] for key, array in arrays.items()}
+        return function(**{name: x}, **subset, **fixed) - target[where]
+
+    everything = np.arange(len(target))
+    fa = residual(a, everything)
+    fb = residual(b, everything)
+    value = np.full(len(target), np.nan)
+    final = np.full(len(target), np.nan)
+    converged = np.zeros(len(target), dtype=bool)
+    iterations = np.zeros(len(target), dtype=int)
+
+    # ends that are already the answer
+    for end, f_end in ((a, fa), (b, fb)):
+        exact = (f_end == 0) & np.isnan(value)
+        value[exact], final[exact], converged[exact] = end[exact], 0., True
+    # keep the elements with a sign change between the ends
+    active = np.flatnonzero(np.isnan(value) & (np.sign(fa) * np.sign(fb) < 0))
+    a, b, fa, fb = a[active], b[active], fa[active], fb[active]
+    # the last two points for the secant, starting from the ends
+    x0, f0, x1, f1 = a, fa, b, fb
+    width = last_width = b - a
+    bisect = np.zeros(len(active), dtype=bool)
+
+    for iteration in range(1, max_iter + 1):
+        if not len(active):
+            break
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = x1 - f1 * (x1 - x0) / (f1 - f0)
+        outside = ~((x > np.minimum(a, b)) & (x < np.maximum(a, b)))
+        x = np.where(bisect | outside, (a + b) / 2, x)
+        f = residual(x, active)
+        iterations[active] = iteration
+
+        # replace the end of the bracket that has the same sign
+        same_as_a = np.sign(f) == np.sign(fa)
+        a, fa = np.where(same_as_a, x, a), np.where(same_as_a, f, fa)
+        b, fb = np.where(same_as_a, b, x), np.where(same_as_a, fb, f)
+        x0, f0, x1, f1 = x1, f1, x, f
+        # bisect next if the bracket didn't at least halve over the last two steps
+        new_width = np.abs(b - a)
+        bisect = new_width > last_width / 2
+        last_width, width = width, new_width
+
+        done = (f == 0) | (width <= rel_tol * np.abs(x)) | (np.abs(x1 - x0) <= rel_tol * np.abs(x))
+        value[active[done]], final[active[done]], converged[active[done]] = x[done], f[done], True
+        going = ~done
+        active = active[going]
+        a, b, fa, fb, x0, f0, x1, f1, width, last_width, bisect = [
+            array[going] for array in (a, b, fa, fb, x0, f0, x1, f1, width, last_width, bisect)]
+    # whatever didn't converge in time gets its best guess
+    if len(active):
+        best = np.abs(fa) < np.abs(fb)
+        value[active] = np.where(best, a, b)
+        final[active] = np.where(best, fa, fb)
+    return Solution(value.reshape(shape), converged.reshape(shape), iterations.reshape(shape), final.reshape(shape))
+
+
+def gap_from_capacitance(capacitance_pF, u=20, N=50, L=1000, hS=500, epsS=3.9, rel_tol: float = 1e-10,
+                         fast: bool = False) -> Solution:
+    """
+    The opposite of capacitance: the gap size (in um) that gives each measured capacitance (in pF), for many devices
+    at once. The defaults are the same capacitors as in cap_common, and any of the parameters can be arrays with one
+    element per device. Capacitance only goes down as the gap gets bigger, so the gap is searched for between a
+    millionth of u and u. Returns a Solution, so check .converged for devices whose capacitance couldn't come from
+    any gap
+    """
+    u_array = np.asarray(u, dtype=float)
+    return solve_for('g', capacitance_pF, low=1e-6 * u_array, high=u_array, rel_tol=rel_tol, u=u, N=N, L=L, hS=hS,
+                     epsS=epsS, fast=fast)
@@ -8,16 +8,14 @@ also communicate with the same instruments without conflict
 
 """MUST BE RUNNING gpib_comm_server.py IN A COMMAND LINE"""
 
-import time
-
-
-def set_temperature_and_wait(setpoint, dev, power=5):
+def set_temperature_and_wait(setpoint, dev, power=5, tolerance=0.5, window=60., timeout=None, polled=None):
     dev.set_heater_range(power)
     dev.set_setpoint(setpoint)
 
-    while abs(dev.read_temperature(channel='A', units='K') - setpoint) > 1:
-        time.sleep(15)      # wait 15 seconds between checks
-    # while loop breaks after temperature comes within 1 K of setpoint
+    # checks often once it gets close, and only returns after the temperature has stayed within tolerance of the
+    # setpoint for a whole window (in seconds) instead of the first time one reading happens to be close enough
+    return dev.wait_for_setpoint(setpoint, channel='A', tolerance=tolerance, window=window, timeout=timeout,
+                                 polled=polled)
 
 
 if __name__ == "__main__":
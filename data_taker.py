@@ -7,26 +7,283 @@ also communicate with the same instruments without conflict. This script takes d
 """
 
 import gpib_client_tools as client
+import binary_data
 import get
 import os
+import io
 import time
+import atexit
+import signal
+import threading
+import collections
+import numpy as np
+
+
+class BufferedWriter:
+    """Keeps new lines in memory and writes them to the file in chunks from a background thread, instead of opening,
+    writing, and closing the file for every line. The lines are written out whenever flush_rows of them have piled up,
+    or flush_interval seconds have gone by, whichever comes first. The file stays open in between, which matters on a
+    synced folder (like a Google Drive) where every open and close makes the sync program look at the file again.
+    fsync - if True, make the operating system put every flush on the disk right away (slower, but nothing is lost if
+            the computer crashes)"""
+    def __init__(self, filename: str, flush_rows: int = 100, flush_interval: float = 5., fsync: bool = False):
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.lines = []
+        self.line_count = 0
+        self.file = open(filename, 'a')
+        self.file_lock = threading.Lock()           # only one flush writes to the file at a time
+        self.new_lines = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=f"writer-{os.path.basename(filename)}", daemon=True)
+        self.thread.start()
+
+    def write(self, text: str):
+        """Add text (one or more whole lines) to be written"""
+        with self.new_lines:
+            if self.closed:
+                raise ValueError(f"{self.filename} is already closed")
+            self.lines.append(text)
+            self.line_count += text.count('\n')
+            if self.line_count >= self.flush_rows:
+                self.new_lines.notify()
+
+    def run(self):
+        while True:
+            with self.new_lines:
+                if not self.closed and self.line_count < self.flush_rows:
+                    self.new_lines.wait(self.flush_interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self, fsync: bool = None):
+        """Write everything that is waiting to the file right now"""
+        with self.file_lock:
+            with self.new_lines:
+                lines, self.lines = self.lines, []
+                self.line_count = 0
+            if lines:
+                self.file.write(''.join(lines))
+            self.file.flush()
+            if self.fsync if fsync is None else fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        """Write out anything left, make sure it's on the disk, and close the file"""
+        with self.new_lines:
+            if self.closed:
+                return
+            self.closed = True
+            self.new_lines.notify()
+        self.thread.join()
+        self.flush(fsync=True)
+        self.file.close()
+
+
+Sample = collections.namedtuple('Sample', ['index', 'timestamp', 'elapsed', 'latency', 'lateness', 'values'])
+Sample.__doc__ = """One measurement taken by a Scheduler.
+index - which tick of the schedule it was taken on (ticks that were skipped leave a gap)
+timestamp - time.time() halfway through the measurement
+elapsed - seconds from the start of the schedule to halfway through the measurement
+latency - how long the measurement took in seconds
+lateness - how long after its tick the measurement started in seconds
+values - what the measurement gave back"""
+
+
+class MeasurementGroup:
+    """A measurement to be taken at a steady rate by a Scheduler.
+    measure - function that takes the measurement and returns the values
+    rate - measurements per second
+    callback - function that is handed every Sample (to save it, for example)
+    skip_overruns - when a measurement takes so long that the next tick has already gone by, skip the ticks that were
+                    missed instead of rushing to catch up. Either way every tick stays on the original schedule, so the
+                    samples don't drift
+    history - how many of the latest latencies to keep"""
+    def __init__(self, name: str, measure, rate: float, callback=None, skip_overruns: bool = False,
+                 history: int = 1000):
+        if rate <= 0:
+            raise ValueError(f"rate has to be positive, -{rate}- given instead")
+        self.name = name
+        self.measure = measure
+        self.period = 1. / rate
+        self.callback = callback
+        self.skip_overruns = skip_overruns
+        self.samples = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.latencies = collections.deque(maxlen=history)
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.max_lateness = 0.
+
+    def report(self) -> dict:
+        latencies = np.array(self.latencies)
+        return {'name': self.name,
+                'rate': 1. / self.period,
+                'samples': self.samples,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'mean_latency': self.total_latency / self.samples if self.samples else 0.,
+                'max_latency': self.max_latency,
+                'p95_latency': float(np.percentile(latencies, 95)) if len(latencies) else 0.,
+                'max_lateness': self.max_lateness}
+
+
+class Scheduler:
+    """Takes measurements at fixed rates. Each MeasurementGroup runs in its own thread, so groups with different rates
+    (or a slow instrument) don't hold each other up.
+
+    Tick k of a group is due at start + k / rate on time.monotonic(), which only counts up and doesn't jump when the
+    computer's clock gets adjusted. Because every tick is worked out from the start instead of from the last
+    measurement, the time each measurement takes doesn't add up into a drift, and the samples stay evenly spaced.
+    Each sample is stamped with the time halfway through the measurement, which is the best guess for when the
+    instrument actually took the reading.
+
+    If a measurement (or a callback) raises an error, every group is stopped and run() raises that error."""
+    def __init__(self, groups=(), verbose: bool = True):
+        self.groups = list(groups)
+        self.verbose = verbose
+        self.stopping = threading.Event()
+        self.error = None           # the first error raised in a group's thread
+        self.threads = []
+        self.start_monotonic = None
+        self.start_time = None
+
+    def add(self, group: MeasurementGroup):
+        self.groups.append(group)
+        if self.threads:
+            # joins on the next of its ticks
+            self.start_group(group, int(np.ceil((time.monotonic() - self.start_monotonic) * (1. / group.period))))
+
+    def start(self):
+        self.stopping.clear()
+        self.error = None
+        # time.time() is only looked at here, to turn the monotonic clock into time stamps
+        self.start_monotonic = time.monotonic()
+        self.start_time = time.time()
+        for group in self.groups:
+            self.start_group(group)
+
+    def start_group(self, group: MeasurementGroup, first_tick: int = 0):
+        thread = threading.Thread(target=self.run_group, args=(group, first_tick), name=f"scheduler-{group.name}",
+                                  daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def run_group(self, group: MeasurementGroup, tick: int):
+        try:
+            self.run_ticks(group, tick)
+        except Exception as e:
+            # hand the error to run() instead of letting the thread die quietly
+            if self.error is None:
+                self.error = e
+            self.stopping.set()
+
+    def run_ticks(self, group: MeasurementGroup, tick: int):
+        start = self.start_monotonic
+        while not self.stopping.is_set():
+            due = start + tick * group.period
+            wait = due - time.monotonic()
+            if wait > 0 and self.stopping.wait(wait):
+                break
+            began = time.monotonic()
+            values = group.measure()
+            ended = time.monotonic()
+
+            midpoint = (began + ended) / 2. - self.start_monotonic
+            sample = Sample(tick, self.start_time + midpoint, midpoint, ended - began, began - due, values)
+            group.samples += 1
+            group.latencies.append(sample.latency)
+            group.total_latency += sample.latency
+            group.max_latency = max(group.max_latency, sample.latency)
+            group.max_lateness = max(group.max_lateness, sample.lateness)
+            if group.callback is not None:
+                group.callback(sample)
+
+            tick += 1
+            behind = time.monotonic() - (start + tick * group.period)
+            if behind > 0:
+                group.overruns += 1
+                missed = int(behind // group.period) + 1
+                if group.skip_overruns:
+                    tick += missed
+                    group.skipped += missed
+                if self.verbose:
+                    action = f"skipping {missed} tick(s)" if group.skip_overruns else "catching up"
+                    print(f"{group.name}: sample {sample.index} overran its slot by {behind:.3f} s, {action}")
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self, duration: float = None) -> list:
+        """Take measurements for duration seconds (or until the program is stopped) and return a report for each
+        group. If a measurement raises an error, everything is stopped and the error is raised from here"""
+        self.start()
+        try:
+            if duration is None:
+                while not self.stopping.wait(1.):
+                    pass
+            else:
+                self.stopping.wait(duration)
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+        return self.report()
+
+    def report(self) -> list:
+        return [group.report() for group in self.groups]
 
 
 class DataFile:
+    """Creates a data file and takes data for it.
+    buffered - if True, rows are kept in memory and written in chunks by a BufferedWriter (flush_rows and flush_interval
+               set how often) instead of opening the file for every row. Use close() (or a with block) when done, which
+               also happens automatically if the program exits or is stopped
+    float_format - %-style format for numbers (like "%.6f" or "%.8e"). None writes them with as many digits as it takes
+                   to get the exact same number back
+    storage - "csv" for a text file, or "binary" to save the numbers as raw binary with binary_data (much faster to
+              save and load for long runs). columns names the columns for binary files"""
+    columns = ['Time (s)', 'Stage A (K)', 'Stage B (K)']
 
-    def __init__(self, path, filename, header='', host="localhost", port=62535):
+    def __init__(self, path, filename, header='', host="localhost", port=62535, buffered: bool = False,
+                 flush_rows: int = 100, flush_interval: float = 5., float_format: str = None, storage: str = "csv",
+                 columns: list = None):
         # define object attributes for communicating to the server.
         # These will be for each device involved in taking data for this data file
-        self.ls = client.LakeShore(model_num=331, port=port)
+        self.ls = client.LakeShore(model_num=331, host=host, port=port)
 
         # the full name will be file path plus the filename
         # the file path will be relative to the Google Drive location
-        self.name = os.path.join(get.googledrive(), path, filename)
+        self.name = os.path.join(get.google_drive(), path, filename)
 
         # make sure the name ends in the correct extension
         # you can write even more checks to ensure the name fits the conditions you desire.
-        if '.csv' not in self.name:
-            self.name += '.csv'
+        extension = '.bin' if storage == "binary" else '.csv'
+        if extension not in self.name:
+            self.name += extension
+
+        self.float_format = float_format
+        self.writer = None
+        self.binary = None
+        if columns is not None:
+            self.columns = columns
+        if storage == "binary":
+            # the binary file is kept open and every row is added to the end, so there is nothing to buffer
+            self.binary = binary_data.BinaryDataWriter(self.name, self.columns)
+            atexit.register(self.close)
+        elif buffered:
+            self.writer = BufferedWriter(self.name, flush_rows, flush_interval)
+            # make sure nothing is left in memory when the program ends
+            atexit.register(self.close)
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGTERM, self.close_on_signal)
 
         # Write header for file
         self.write_comment(f"This data file was created on {time.ctime(time.time())}")
@@ -34,35 +291,105 @@ class DataFile:
 
         self.start_time = time.time()
 
+    def measure(self) -> list:
+        """Read the instruments (everything in a row except the time)"""
+        # read both channels in one transaction on the bus
+        return list(self.ls.read_temperatures(['A', 'B']))
+
     def single_measure(self):
         """Take a single data point"""
-        time_elapsed = time.time()-self.start_time
-        temp1 = self.ls.read_temperature('A')
-        temp2 = self.ls.read_temperature('B')
-        data = [time_elapsed, temp1, temp2]
+        began = time.time()
+        values = self.measure()
+        # the readings were taken somewhere in between, so halfway is the best guess
+        time_elapsed = (began + time.time()) / 2. - self.start_time
+        data = [time_elapsed] + values
         self.write_row(data)
         print(data)
 
-    def take_data(self):
-        """Will just continuously take data until program is cancelled"""
-        while True:
-            self.single_measure()
+    def record_sample(self, sample: Sample):
+        """Save a Sample from a Scheduler"""
+        data = [sample.timestamp - self.start_time] + sample.values
+        self.write_row(data)
+        print(data)
+
+    def take_data(self, rate: float = None, duration: float = None, skip_overruns: bool = False):
+        """Will continuously take data until the program is cancelled (or for duration seconds).
+        rate - measurements per second, kept steady by a Scheduler. None takes them as fast as the instruments answer
+        skip_overruns - see MeasurementGroup"""
+        try:
+            if rate is None:
+                end = None if duration is None else time.monotonic() + duration
+                while end is None or time.monotonic() < end:
+                    self.single_measure()
+            else:
+                scheduler = Scheduler([MeasurementGroup(os.path.basename(self.name), self.measure, rate,
+                                                        self.record_sample, skip_overruns)])
+                print(scheduler.run(duration))
+        finally:
+            self.close()
+
+    def format_value(self, value) -> str:
+        if isinstance(value, (float, np.floating)):
+            return self.float_format % value if self.float_format else repr(float(value))
+        return str(value)
 
     def write_row(self, row_to_write: list):
         """Writes a new line in the csv file comma separated for each element in the list."""
         if isinstance(row_to_write, list):
-            with open(self.name, 'a') as f:
-                f.write(str(row_to_write).strip('[').strip(']').replace("'", "") + '\n')
+            if self.binary is not None:
+                self.binary.append(row_to_write)
+            else:
+                self.write(','.join(self.format_value(value) for value in row_to_write) + '\n')
         else:
             raise ValueError(f"write_row only accepts a list, -{type(row_to_write)}- given instead")
 
+    def write_rows(self, rows):
+        """Writes many rows at once. rows can be a list of lists or a 2-D NumPy array (one row of the file per row of
+        the array)"""
+        rows = np.asarray(rows, dtype=float)
+        if rows.ndim != 2:
+            raise ValueError(f"write_rows needs 2-D data, -{rows.ndim}-D given instead")
+        if self.binary is not None:
+            self.binary.append_rows(rows)
+            return
+        text = io.StringIO()
+        np.savetxt(text, rows, fmt=self.float_format or '%s', delimiter=',')
+        self.write(text.getvalue())
+
     def write_comment(self, comment: str):
-        with open(self.name, 'a') as f:
-            f.write(f'# {str(comment)}\n')
+        if self.binary is not None:
+            self.binary.add_comment(comment)
+        else:
+            self.write(f'# {str(comment)}\n')
+
+    def write(self, text: str):
+        if self.writer is not None:
+            self.writer.write(text)
+        else:
+            with open(self.name, 'a') as f:
+                f.write(text)
+
+    def flush(self, fsync: bool = False):
+        """Write anything waiting in memory to the file now"""
+        if self.writer is not None:
+            self.writer.flush(fsync)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.binary is not None and not self.binary.file.closed:
+            self.binary.close()
+
+    def close_on_signal(self, signum, frame):
+        self.close()
+        raise SystemExit(f"Stopped by signal {signum}")
+
+    def __enter__(self):
+        return self
 
-for ii in zip(10):
-    print(ii)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 if __name__ == "__main__":
     data = DataFile(path=os.path.join('data', '2022'), filename=f'file-{time.time()}', header='example data')
-    data.take_data()
+    data.take_data(rate=2.)
@@ -30,6 +30,17 @@ def google_drive() -> str:
     return path
 
 
+def cache_folder() -> str:
+    """A folder for files that are slow to make but can be made again at any time (like lookup tables), so they don't
+    clutter up the repository or the Google Drive"""
+    if os.name == 'nt':
+        path = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')), 'quantum_forge')
+    else:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'quantum_forge')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 gpib_address = {"LS": 13,
                 "SCOPE": 10,
                 "VS": 4}
\ No newline at end of file
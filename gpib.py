@@ -5,19 +5,71 @@ This code allows you to establish connection with an instrument over GPIB
 @author: Teddy Tortorici
 """
 
+import json
+import threading
 import pyvisa
 import numpy as np
 
 
+# Every Device in the program shares one ResourceManager, which is only created the first time it's needed
+_resource_manager = None
+_resource_manager_lock = threading.Lock()
+
+
+def resource_manager() -> pyvisa.ResourceManager:
+    global _resource_manager
+    with _resource_manager_lock:
+        if _resource_manager is None:
+            _resource_manager = pyvisa.ResourceManager()
+    return _resource_manager
+
+
 class Device:
-    def __init__(self, addr: int, gpib_num: int = 0):
+    def __init__(self, addr: int, gpib_num: int = 0, backend="visa"):
         """establish connection with instrument over GPIB
         addr - (int) the GPIB address of the instrument you wish to communicate with
         gpib_num - (int) Which GPIB interface connected to the computer. Typically 0, unless
-                   multiple GPIB interfaces are connected"""
+                   multiple GPIB interfaces are connected
+        backend - "visa" to talk to a real instrument, "sim" to talk to a simulated.SimulatedLakeShore instead, or
+                  any simulated instrument object from simulated.py
+        The connection isn't actually opened until the first time the instrument is used, so an instrument that is
+        switched off doesn't cause any trouble until you try to talk to it"""
         self.addr = addr
-        self.rm = pyvisa.ResourceManager()
-        self.dev = self.rm.open_resource(f"GPIB{gpib_num}::{addr}::INSTR")
+        self.gpib_num = gpib_num
+        self.resource_name = f"GPIB{gpib_num}::{addr}::INSTR"
+        self.backend = backend
+        self._dev = None
+        self.open_lock = threading.Lock()
+        if backend != "visa":
+            # only load the simulation code if it's being used
+            import simulated
+            self._dev = simulated.SimulatedLakeShore() if backend == "sim" else backend
+
+    @property
+    def rm(self) -> pyvisa.ResourceManager:
+        return resource_manager()
+
+    @property
+    def dev(self):
+        """The pyvisa resource for the instrument, opened the first time it's asked for"""
+        if self._dev is None:
+            with self.open_lock:
+                if self._dev is None:
+                    self._dev = self.rm.open_resource(self.resource_name)
+        return self._dev
+
+    @property
+    def is_open(self) -> bool:
+        return self._dev is not None
+
+    def close(self):
+        """Close the connection (it will be opened again if the instrument is used again). A simulated instrument is
+        kept, since there is nothing to open again"""
+        with self.open_lock:
+            if self._dev is not None:
+                self._dev.close()
+                if self.backend == "visa":
+                    self._dev = None
 
     def query(self, msg):
         """Send message to instrument and return result"""
@@ -54,6 +106,57 @@ class Device:
         return self.query('*IDN?')
 
 
+class DeviceRegistry:
+    """Keeps track of which instrument ID (like "LS") goes with which Device, e.g.
+        registry = DeviceRegistry(get.gpib_address)
+        registry.get("LS").query("KRDG? A")
+    config - {instrument ID: settings}, where the settings are either just the GPIB address, a dictionary of the
+             arguments for Device (like {"addr": 13, "gpib_num": 1}), or a Device that has already been made.
+    Nothing is opened until an instrument is used, and instruments can be added and removed while the program runs."""
+    def __init__(self, config: dict = None):
+        self.devices = {}       # instrument ID -> Device
+        self.lock = threading.Lock()
+        for dev_id, settings in (config or {}).items():
+            self.add(dev_id, settings)
+
+    @classmethod
+    def from_file(cls, filename: str):
+        """Load the config from a JSON file shaped like the config dictionary"""
+        with open(filename, 'r') as f:
+            return cls(json.load(f))
+
+    def add(self, dev_id: str, settings) -> Device:
+        """Add an instrument (or replace the one that had this ID)"""
+        if isinstance(settings, Device):
+            device = settings
+        elif isinstance(settings, dict):
+            device = Device(**settings)
+        else:
+            device = Device(int(settings))
+        with self.lock:
+            old = self.devices.get(dev_id.upper())
+            self.devices[dev_id.upper()] = device
+        if old is not None and old is not device:
+            old.close()
+        return device
+
+    def remove(self, dev_id: str):
+        with self.lock:
+            device = self.devices.pop(dev_id.upper(), None)
+        if device is not None:
+            device.close()
+
+    def get(self, dev_id: str):
+        """Returns the Device for an instrument ID, or None if there isn't one"""
+        return self.devices.get(dev_id.upper())
+
+    def ids(self) -> list:
+        return list(self.devices)
+
+    def __contains__(self, dev_id):
+        return dev_id.upper() in self.devices
+
+
 if __name__ == "__main__":
     """This only runs when you run this .py script directly, and is skipped if you import the script"""
     address = 12
@@ -0,0 +1,310 @@
+"""
+Example code created for the Quantum Forge course
+This code is an asyncio version of the Device and LakeShore classes in gpib_client_tools, for scripts that talk to
+several instruments at the same time.
+
+With gpib_client_tools, every query waits for its reply before the next line of the script runs, so reading three
+instruments takes three round trips one after the other (unless you start threads yourself). Here every method is a
+coroutine, so you can start several and wait for all of them together:
+```
+import asyncio
+import gpib_client_async as aclient
+
+async def main():
+    ls = aclient.LakeShore(port=62538)
+    scope = aclient.Device("SCOPE")
+    temp_a, temp_b, idn = await asyncio.gather(ls.read_temperature('A'), ls.read_temperature('B'), scope.read_id())
+
+asyncio.run(main())
+```
+Every request goes over one shared framed connection (see gpib_protocol) to server_gpib_concurrent, which runs messages
+for instruments on different GPIB interfaces at the same time and sends back each reply as soon as it is ready.
+
+@author: Teddy Tortorici
+"""
+
+import asyncio
+import itertools
+import json
+import socket
+import numpy as np
+import gpib_protocol as protocol
+import lakeshore_state
+
+
+class Connection:
+    """A connection to the server shared by every Device in the same event loop. Every request is tagged with an ID, so
+    any number of requests can be waiting on the server at once and the replies are matched back up to the right request
+    no matter what order they come back in. Open one with Connection.open(host, port), which has to be awaited"""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host="localhost", port=62538):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}           # request ID -> asyncio.Future waiting for the reply
+        self.ids = itertools.count(1)
+        self.open = True
+        self.reader_task = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def open(cls, host="localhost", port=62538):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(reader, writer, host, port)
+
+    async def request(self, msg):
+        """Send a message and wait for the reply. Other coroutines can send their own requests while this one waits"""
+        if not self.open:
+            raise ConnectionError(f"connection to {self.host}:{self.port} is closed")
+        req_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = future
+        self.writer.write(protocol.encode_frame(protocol.TEXT, req_id, msg.encode()))
+        await self.writer.drain()
+        return await future
+
+    async def read_replies(self):
+        """Runs as a task and hands each reply to the request waiting on it"""
+        try:
+            while True:
+                header = await self.reader.readexactly(protocol.HEADER.size)
+                magic, kind, req_id, length = protocol.HEADER.unpack(header)
+                if magic != protocol.MAGIC:
+                    raise IOError("lost track of the frames in the stream")
+                body = await self.reader.readexactly(length)
+                future = self.pending.pop(req_id, None)
+                if future is None or future.done():
+                    continue
+                try:
+                    future.set_result(protocol.decode_reply(kind, body))
+                except IOError as e:
+                    future.set_exception(e)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        # the server went away, so nothing that is still waiting will get a reply
+        self.open = False
+        waiting, self.pending = self.pending, {}
+        for future in waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"lost connection to {self.host}:{self.port}"))
+
+    async def close(self):
+        self.open = False
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        await self.reader_task
+
+
+_connections = {}       # (event loop, host, port) -> task that opens the Connection
+
+
+async def get_connection(host="localhost", port=62538) -> Connection:
+    """Returns the shared connection to a server, opening a new one if there isn't one or the old one was lost.
+    Coroutines that ask at the same time wait for the same connection instead of each opening their own"""
+    # connections from event loops that have been closed (like an earlier asyncio.run) can't be used again
+    for key in [key for key in _connections if key[0].is_closed()]:
+        del _connections[key]
+    key = (asyncio.get_running_loop(), host, port)
+    opening = _connections.get(key)
+    if opening is not None and opening.done() and (opening.exception() is not None or not opening.result().open):
+        opening = None
+    if opening is None:
+        opening = asyncio.ensure_future(Connection.open(host, port))
+        _connections[key] = opening
+    return await opening
+
+
+async def close_connections():
+    """Close the connections opened in the running event loop"""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _connections if key[0] is loop]:
+        opening = _connections.pop(key)
+        try:
+            connection = await opening
+        except (ConnectionError, OSError):
+            continue
+        await connection.close()
+
+
+class Batch:
+    """Same as gpib_client_tools.Batch, but sent with "async with":
+
+        async with ls.batch() as batch:
+            temp_a = batch.query('KRDG? A')
+            temp_b = batch.query('KRDG? B')
+        print(float(temp_a.result()), float(temp_b.result()))
+    """
+    def __init__(self, device):
+        self.device = device
+        self.commands = []
+        self.futures = []
+
+    def query(self, msg) -> asyncio.Future:
+        return self.add("Q", msg)
+
+    def write(self, msg) -> asyncio.Future:
+        return self.add("W", msg)
+
+    def read(self) -> asyncio.Future:
+        return self.add("R", "")
+
+    def add(self, command, msg) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.commands.append([command, msg])
+        self.futures.append(future)
+        return future
+
+    async def send(self) -> list:
+        """Send everything collected so far and return the list of replies"""
+        commands, futures = self.commands, self.futures
+        self.commands, self.futures = [], []
+        if not commands:
+            return []
+        reply = await self.device.send(f"{self.device.dev_id}::B::{json.dumps(commands)}")
+        try:
+            replies = json.loads(reply)
+        except ValueError:
+            replies = None
+        if not isinstance(replies, list) or len(replies) != len(futures):
+            error = IOError(f"batch failed: {reply}")
+            for future in futures:
+                future.set_exception(error)
+            raise error
+        for future, result in zip(futures, replies):
+            future.set_result(result)
+        return replies
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.send()
+
+
+class Device:
+    """The same methods as gpib_client_tools.Device, but each one has to be awaited"""
+    def __init__(self, dev_id, host='localhost', port=62538):
+        self.dev_id = dev_id
+        self.host = host
+        self.port = port
+
+    async def query(self, msg):
+        return await self.send(f"{self.dev_id}::Q::{msg}")
+
+    async def write(self, msg):
+        """Returns "empty" if the write went through, or what went wrong (like "timed out")"""
+        return await self.send(f"{self.dev_id}::W::{msg}")
+
+    async def query_array(self, msg) -> np.ndarray:
+        """Query for a whole data set at once (like a scope trace). The numbers come back as raw binary"""
+        reply = await self.send(f"{self.dev_id}::A::{msg}")
+        if isinstance(reply, np.ndarray):
+            return reply
+        return np.array([float(x) for x in reply.split(',')])
+
+    async def read(self):
+        return await self.send(f"{self.dev_id}::R")
+
+    def batch(self) -> Batch:
+        """Collect several writes and queries to send all at once (see Batch)"""
+        return Batch(self)
+
+    async def read_id(self):
+        return await self.query('*IDN?')
+
+    async def reset(self):
+        await self.write('*RST')
+
+    async def send(self, msg):
+        connection = await get_connection(self.host, self.port)
+        return await connection.request(msg)
+
+
+class LakeShore(Device):
+    """The same methods as gpib_client_tools.LakeShore, but each one has to be awaited. Nothing is sent to the
+    instrument until a method is called"""
+    def __init__(self, model_num=331, host='localhost', port=62535):
+        super(LakeShore, self).__init__(dev_id="LS", host=host, port=port)
+
+        self.model_num = int(model_num)    # as in for LS331 or LS340
+
+        """Correspond heater power (in Watts) with heater range settings (index of the list)"""
+        if self.model_num == 340:
+            self.heater_ranges = [0.0, 0.05, 0.50, 5.0, 50.0]
+        else:
+            self.heater_ranges = [0.0, 0.5, 5.0, 50.0]
+        self.inputs = ['A', 'B', 'C', 'D'] if self.model_num in (340, 336, 350) else ['A', 'B']
+
+    async def read_heater_output(self) -> float:
+        """Query the percent power being output to the heater"""
+        return float(await self.query('HTR?'))
+
+    async def read_heater_range(self) -> float:
+        """Query the heater range. Returns value in Watts"""
+        return float(self.heater_ranges[int(await self.query('RANGE?'))])
+
+    async def read_pid(self, loop: int = 1) -> tuple:
+        self.check_loop(loop)
+        return lakeshore_state.parse_pid(await self.query(f"PID? {int(loop)}"))
+
+    async def read_ramp_speed(self, loop: int = 1) -> float:
+        """Kelvin per minute"""
+        self.check_loop(loop)
+        return float((await self.query(f"RAMP? {loop}")).split(',')[1])
+
+    async def read_ramp_status(self, loop: int = 1) -> bool:
+        """Check whether the setpoint is ramping or not"""
+        self.check_loop(loop)
+        return bool(int(await self.query(f"RAMPST? {loop}")))
+
+    async def read_setpoint(self, loop=1):
+        """Return the value of setpoint in current units"""
+        self.check_loop(loop)
+        return float(await self.query(f"SETP? {loop}"))
+
+    async def read_temperature(self, channel: str = 'A', units: str = 'K') -> float:
+        """Read the temperature on a channel"""
+        channel = channel.upper()
+        units = units.upper()
+        if channel not in self.inputs:
+            raise IOError(f"Invalid channel: {channel}")
+        if units not in ['K', 'C']:
+            raise IOError(f"Invalid units: {units}")
+        return float(await self.query(f"{units}RDG? {channel}"))
+
+    async def set_heater_range(self, power_range: float, override: bool = False):
+        """Sets the heater range"""
+        power_range = abs(float(power_range))
+        # find the nearest valid setting to the power given
+        setting = np.argmin(np.abs(np.array(self.heater_ranges) - power_range))
+        if self.heater_ranges[setting] == 50. and not override:
+            print("50V is probably too high and will fry your solder joints. If you disagree, override==True")
+        else:
+            await self.write(f"RANGE {setting}")
+
+    async def set_pid(self, p='', i='', d='', loop=1):
+        """Any of p, i, d left out keep the value the instrument has now"""
+        self.check_loop(loop)
+        if '' in (p, i, d):
+            current = await self.read_pid(loop)
+            p, i, d = [current[ii] if value == '' else float(value) for ii, value in enumerate((p, i, d))]
+        await self.write(f"PID {loop}, {p}, {i}, {d}")
+
+    async def set_ramp_speed(self, kelvin_per_min, loop=1):
+        """Set the ramp speed to reach set point in Kelvin per min"""
+        self.check_loop(loop)
+        await self.write(f"RAMP {loop}, 1, {kelvin_per_min}")
+
+    async def set_setpoint(self, value, loop=1):
+        """Configure Control loop setpoint (in whatever units the setpoint is using)"""
+        self.check_loop(loop)
+        await self.write(f"SETP {loop}, {float(value)}")
+
+    @staticmethod
+    def check_loop(loop):
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
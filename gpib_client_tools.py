@@ -7,6 +7,15 @@ This code allows sends messages to the server created in gpib_comm_server
 
 import numpy as np
 import socket
+import threading
+import itertools
+import json
+import time
+import queue
+import collections
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import gpib_protocol as protocol
+import lakeshore_state
 
 
 def send(msg, host="localhost", port=62538):
@@ -14,30 +23,259 @@ def send(msg, host="localhost", port=62538):
     The server will lock the thread until it's done, so you can send more messages and they wait in line"""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((host, port))
-        # send message to server
-        s.send(msg.encode())
-        # message returned from the server
-        msg_out = s.recv(1024)
+        # send message to server, then tell it nothing else is coming
+        s.sendall(msg.encode())
+        s.shutdown(socket.SHUT_WR)
+        # message returned from the server, which closes the connection once it has all been sent
+        msg_out = protocol.recv_all(s)
     return msg_out.decode()
 
 
+class Connection:
+    """A long lived connection to the server (gpib_comm_server.ConcurrentServer) that many Devices and threads can
+    share. Every request is tagged with an ID, so several requests can be waiting on the server at once and the replies
+    are matched back up to the right request no matter what order they come back in.
+    framed - if True, use the length-prefixed frames from gpib_protocol so replies can be any length and arrays come
+             back as NumPy arrays. Otherwise use "@ID::message" text lines."""
+    def __init__(self, host="localhost", port=62538, framed=True):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.pending = {}           # request ID -> Future waiting for the reply
+        self.streams = {}           # request ID -> (callback(reply), on_error(exception)) for requests that get many
+                                    # replies (subscriptions)
+        self.pending_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.open = True
+        self.reader = threading.Thread(target=self.read_replies, name=f"{host}:{port}-reader", daemon=True)
+        self.reader.start()
+
+    def submit(self, msg) -> Future:
+        """Send a message without waiting for the reply. The reply is put in the returned Future"""
+        future = Future()
+        with self.pending_lock:
+            if not self.open:
+                raise ConnectionError(f"connection to {self.host}:{self.port} is closed")
+            req_id = next(self.ids)
+            self.pending[req_id] = future
+        if self.framed:
+            data = protocol.encode_frame(protocol.TEXT, req_id, msg.encode())
+        else:
+            data = f"@{req_id}::{msg}\n".encode()
+        with self.send_lock:
+            self.sock.sendall(data)
+        return future
+
+    def request(self, msg, timeout=None) -> str:
+        """Send a message and wait for the reply"""
+        return self.submit(msg).result(timeout)
+
+    def stream(self, msg, callback, on_error=None) -> int:
+        """Send a message that the server will keep answering (like "POLL::SUBSCRIBE::TEMP_A"). callback(reply) is
+        called from the reader thread for every reply. If the server replies with an error, or callback raises one,
+        the stream is ended and on_error(exception) is called instead (the error is printed if on_error is None).
+        Returns the request ID"""
+        with self.pending_lock:
+            if not self.open:
+                raise ConnectionError(f"connection to {self.host}:{self.port} is closed")
+            req_id = next(self.ids)
+            self.streams[req_id] = (callback, on_error)
+        if self.framed:
+            data = protocol.encode_frame(protocol.TEXT, req_id, msg.encode())
+        else:
+            data = f"@{req_id}::{msg}\n".encode()
+        with self.send_lock:
+            self.sock.sendall(data)
+        return req_id
+
+    def end_stream(self, req_id):
+        """Stop handing replies for a stream to its callback"""
+        with self.pending_lock:
+            self.streams.pop(req_id, None)
+
+    def read_replies(self):
+        """Runs in its own thread and hands each reply to the request waiting on it"""
+        try:
+            for req_id, reply in (self.framed_replies() if self.framed else self.tagged_replies()):
+                with self.pending_lock:
+                    future = self.pending.pop(req_id, None)
+                    stream = self.streams.get(req_id)
+                if stream is not None:
+                    self.hand_to_stream(req_id, stream, reply)
+                if future is None:
+                    continue
+                if isinstance(reply, Exception):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (ConnectionError, OSError):
+            pass
+        # the server went away, so nothing that is still waiting will get a reply
+        with self.pending_lock:
+            self.open = False
+            waiting, self.pending = self.pending, {}
+            self.streams = {}
+        for future in waiting.values():
+            future.set_exception(ConnectionError(f"lost connection to {self.host}:{self.port}"))
+        self.close()
+
+    def hand_to_stream(self, req_id, stream, reply):
+        """Give a reply to a stream's callback. Anything that goes wrong only ends that stream, and the connection
+        carries on for everything else using it"""
+        callback, on_error = stream
+        try:
+            if isinstance(reply, Exception):
+                raise reply
+            callback(reply)
+        except Exception as e:
+            self.end_stream(req_id)
+            if on_error is None:
+                print(f"Ended stream {req_id} from {self.host}:{self.port}: {e!r}")
+            else:
+                try:
+                    on_error(e)
+                except Exception as handler_error:
+                    print(f"Error handler of stream {req_id} failed: {handler_error!r}")
+
+    def tagged_replies(self):
+        with self.sock.makefile('rb') as replies:
+            for line in replies:
+                tag, _, reply = line.decode().rstrip('\n')[1:].partition('::')
+                yield int(tag), reply
+
+    def framed_replies(self):
+        while True:
+            kind, req_id, body = protocol.recv_frame(self.sock)
+            try:
+                yield req_id, protocol.decode_reply(kind, body)
+            except IOError as e:
+                yield req_id, e
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+_connections = {}       # (host, port, framed) -> Connection shared by every persistent Device
+_connections_lock = threading.Lock()
+
+
+def get_connection(host="localhost", port=62538, framed=True) -> Connection:
+    """Returns the shared connection to a server, opening a new one if there isn't one or the old one was lost"""
+    with _connections_lock:
+        connection = _connections.get((host, port, framed))
+        if connection is None or not connection.open:
+            connection = Connection(host, port, framed)
+            _connections[(host, port, framed)] = connection
+    return connection
+
+
+def close_connections():
+    with _connections_lock:
+        for connection in _connections.values():
+            connection.close()
+        _connections.clear()
+
+
+class Batch:
+    """Collects writes and queries for one device and sends them to the server as a single message. The server runs
+    them back to back without letting anything else use the bus in between, and sends all the replies back at once.
+    Each method gives back a Future that holds the reply once the batch has been sent, e.g.
+
+        with ls.batch() as batch:
+            temp_a = batch.query('KRDG? A')
+            temp_b = batch.query('KRDG? B')
+        print(float(temp_a.result()), float(temp_b.result()))
+    """
+    def __init__(self, device):
+        self.device = device
+        self.commands = []
+        self.futures = []
+
+    def query(self, msg) -> Future:
+        return self.add("Q", msg)
+
+    def write(self, msg) -> Future:
+        return self.add("W", msg)
+
+    def read(self) -> Future:
+        return self.add("R", "")
+
+    def add(self, command, msg) -> Future:
+        future = Future()
+        self.commands.append([command, msg])
+        self.futures.append(future)
+        return future
+
+    def send(self) -> list:
+        """Send everything collected so far and return the list of replies"""
+        commands, futures = self.commands, self.futures
+        self.commands, self.futures = [], []
+        if not commands:
+            return []
+        reply = self.device.send(f"{self.device.dev_id}::B::{json.dumps(commands)}")
+        try:
+            replies = json.loads(reply)
+        except ValueError:
+            # the server sends back a plain message (like an invalid device id) when the whole batch fails
+            replies = None
+        if not isinstance(replies, list) or len(replies) != len(futures):
+            error = IOError(f"batch failed: {reply}")
+            for future in futures:
+                future.set_exception(error)
+            raise error
+        for future, result in zip(futures, replies):
+            future.set_result(result)
+        return replies
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.send()
+
+
 class Device:
-    """This class is meant to be inherited by classes dedicated to specific devices"""
-    def __init__(self, dev_id, host='localhost', port=62538):
+    """This class is meant to be inherited by classes dedicated to specific devices
+    persistent - if True, share one long lived connection per server instead of connecting for every message (needs
+                 the server to be running server_gpib_concurrent)
+    framed - if persistent, use length-prefixed frames (see gpib_protocol) so long replies and arrays come through"""
+    def __init__(self, dev_id, host='localhost', port=62538, persistent=False, framed=True):
         self.dev_id = dev_id
         self.host = host
         self.port = port
+        self.persistent = persistent
+        self.framed = framed
 
     def query(self, msg):
         return self.send(f"{self.dev_id}::Q::{msg}")
 
     def write(self, msg):
-        self.send(f"{self.dev_id}::W::{msg}")
-        return "empty"
+        """Returns "empty" if the write went through, or what went wrong (like "timed out")"""
+        return self.send(f"{self.dev_id}::W::{msg}")
+
+    def query_array(self, msg) -> np.ndarray:
+        """Query for a whole data set at once (like a scope trace). Over a framed connection the numbers come back
+        as raw binary, otherwise they come back as comma separated text and get converted here"""
+        reply = self.send(f"{self.dev_id}::A::{msg}")
+        if isinstance(reply, np.ndarray):
+            return reply
+        return np.array([float(x) for x in reply.split(',')])
 
     def read(self):
         return self.send(f"{self.dev_id}::R")
 
+    def batch(self) -> Batch:
+        """Collect several writes and queries to send all at once (see Batch)"""
+        return Batch(self)
+
     def read_id(self):
         return self.query('*IDN?')
 
@@ -45,12 +283,176 @@ class Device:
         self.write('*RST')
 
     def send(self, msg):
+        if self.persistent:
+            return get_connection(self.host, self.port, self.framed).request(msg)
         return send(msg, self.host, self.port)
 
 
-class LakeShore(Device):
-    def __init__(self, model_num=331, host='localhost', port=62535):
-        super(self.__class__, self).__init__(dev_id="LS", host=host, port=port)      # initiate the class inherited from
+class PolledChannel:
+    """A channel the server reads on its own (see gpib_comm_server.Poller). Getting the newest reading from here doesn't
+    send anything over the bus, no matter how many clients are asking.
+    name - the name the channel was given in the server's poll_channels, like TEMP_A"""
+    def __init__(self, name, host='localhost', port=62538):
+        self.name = name.upper()
+        self.host = host
+        self.port = port
+        self.subscriptions = {}     # callback -> request ID of its stream
+
+    def latest(self) -> tuple:
+        """Returns (time, value) of the newest reading, or None if there hasn't been one yet"""
+        reply = json.loads(self.send(f"POLL::LATEST::{self.name}"))
+        return None if reply is None else tuple(reply)
+
+    def history(self) -> np.ndarray:
+        """Returns the readings the server still has as an array with columns of time and value"""
+        return np.array(json.loads(self.send(f"POLL::HISTORY::{self.name}")), dtype=float).reshape(-1, 2)
+
+    def subscribe(self, callback, on_error=None):
+        """callback(time, value) will be called (from a background thread) every time the server takes a new reading.
+        If the server answers with an error instead (like for a channel it isn't polling), the subscription ends and
+        on_error(exception) is called (or the error is printed if on_error is None)"""
+        def on_reply(reply):
+            try:
+                timestamp, value = json.loads(reply)
+            except (TypeError, ValueError):
+                raise IOError(reply)
+            callback(timestamp, value)
+        connection = get_connection(self.host, self.port)
+        self.subscriptions[callback] = connection.stream(f"POLL::SUBSCRIBE::{self.name}", on_reply, on_error)
+
+    def unsubscribe(self, callback, timeout=None):
+        """Ends the subscription of callback. timeout is how long to wait for the server to confirm it (forever if
+        None)"""
+        req_id = self.subscriptions.pop(callback, None)
+        if req_id is not None:
+            connection = get_connection(self.host, self.port)
+            connection.end_stream(req_id)
+            if not self.subscriptions:
+                # the server stops every stream of this channel on the connection
+                connection.request(f"POLL::UNSUBSCRIBE::{self.name}", timeout)
+
+    def send(self, msg):
+        return get_connection(self.host, self.port).request(msg)
+
+
+Settled = collections.namedtuple('Settled', ['value', 'elapsed', 'readings'])
+Settled.__doc__ = """What wait_until_stable gives back once the readings have settled.
+value - the average of the readings in the last window
+elapsed - seconds it took to settle
+readings - array with columns of time and value of every reading in the last window"""
+
+
+def wait_until_stable(target: float, read=None, channel: PolledChannel = None, tolerance: float = 0.1,
+                      window: float = 60., max_slope: float = None, timeout: float = None, min_interval: float = 0.5,
+                      max_interval: float = 15.) -> Settled:
+    """
+    Waits until a reading has stayed within tolerance of target for window seconds without drifting faster than
+    max_slope (units per second, found from a straight line fit over the window; tolerance / window if None).
+    Readings come from one of:
+    read - a function that returns a new reading every time it's called (like a LakeShore's read_temperature). How
+           long to wait between calls depends on how quickly the reading has been approaching target: far away it
+           waits for up to max_interval seconds, and as it gets close (or once it's inside tolerance) it checks more
+           often, down to min_interval. A reading that isn't a number (like "timed out") is skipped
+    channel - a PolledChannel the server is already reading. Every new reading is pushed to us as soon as the server
+              takes it, so waiting doesn't send anything over the bus
+    Raises a TimeoutError if it hasn't settled after timeout seconds (waits forever if None)
+    """
+    if (read is None) == (channel is None):
+        raise ValueError("give either read or channel")
+    max_slope = tolerance / window if max_slope is None else max_slope
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    readings = collections.deque()      # (time, value) from the last window
+    last = None                         # (time, value) of the reading before that
+
+    if channel is not None:
+        pushed = queue.Queue()
+
+        def on_reading(timestamp, value):
+            pushed.put((timestamp, value))
+        channel.subscribe(on_reading, pushed.put)
+    try:
+        while True:
+            if channel is None:
+                try:
+                    reading = (time.time(), float(read()))
+                except (TypeError, ValueError):
+                    reading = None      # couldn't read it this time (like a "timed out" reply), so try again
+            else:
+                try:
+                    reading = pushed.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    reading = None
+                if isinstance(reading, Exception):
+                    raise reading       # the subscription failed
+                if reading is not None and not isinstance(reading[1], (int, float)):
+                    reading = None      # the server couldn't read it this time
+            if reading is not None:
+                if readings:
+                    last = readings[-1]
+                readings.append(reading)
+                # keep the newest reading from at or before window seconds ago, so the readings always cover the
+                # whole window once there have been enough of them
+                while len(readings) > 2 and readings[-1][0] - readings[1][0] >= window:
+                    readings.popleft()
+                if settled(readings, target, tolerance, window, max_slope):
+                    values = np.array(readings, dtype=float)
+                    return Settled(float(np.mean(values[:, 1])), time.monotonic() - start, values)
+
+            if deadline is not None and time.monotonic() >= deadline:
+                newest = f" (last reading {readings[-1][1]})" if readings else ""
+                raise TimeoutError(f"not within {tolerance} of {target} for {window} s after {timeout} s{newest}")
+            if channel is None:
+                if reading is None:
+                    interval = min_interval
+                else:
+                    interval = poll_interval(last, readings[-1], target, tolerance, window, min_interval,
+                                             max_interval)
+                if deadline is not None:
+                    interval = min(interval, max(deadline - time.monotonic(), 0))
+                time.sleep(interval)
+    finally:
+        if channel is not None:
+            try:
+                channel.unsubscribe(on_reading, timeout=5.)
+            except (OSError, FutureTimeout):
+                # the server has stopped answering, which shouldn't hide the reading (or the error) we already have
+                pass
+
+
+def settled(readings, target: float, tolerance: float, window: float, max_slope: float) -> bool:
+    """Whether readings cover window seconds, are all within tolerance of target, and aren't drifting too quickly"""
+    if len(readings) < 2 or readings[-1][0] - readings[0][0] < window:
+        return False
+    values = np.array(readings, dtype=float)
+    if np.any(np.abs(values[:, 1] - target) > tolerance):
+        return False
+    return abs(np.polyfit(values[:, 0] - values[0, 0], values[:, 1], 1)[0]) <= max_slope
+
+
+def poll_interval(last, newest, target: float, tolerance: float, window: float, min_interval: float,
+                  max_interval: float) -> float:
+    """How long to wait before the next reading. Half of the time it would take to get within tolerance at the rate
+    it's been approaching, so it slows down when far away and speeds up when close"""
+    distance = abs(newest[1] - target)
+    if distance <= tolerance:
+        # close enough, so take enough readings to judge whether it is stable
+        return min(max(window / 10, min_interval), max_interval)
+    if last is None or newest[0] <= last[0]:
+        return min_interval
+    # speed in the direction of target
+    approach = (abs(last[1] - target) - distance) / (newest[0] - last[0])
+    if approach <= 0:
+        return max_interval
+    return min(max((distance - tolerance) / approach / 2, min_interval), max_interval)
+
+
+class LakeShore(Device, lakeshore_state.LakeShoreCommands):
+    """The commands themselves come from lakeshore_state.LakeShoreCommands, which temperature_controller.LakeShore
+    uses too"""
+    def __init__(self, model_num=331, host='localhost', port=62535, persistent=False):
+        # initiate the class inherited from
+        super(self.__class__, self).__init__(dev_id="LS", host=host, port=port, persistent=persistent)
 
         self.model_num = int(model_num)    # as in for LS331 or LS340
 
@@ -59,98 +461,18 @@ class LakeShore(Device):
             self.heater_ranges = [0.0, 0.05, 0.50, 5.0, 50.0]
         else:
             self.heater_ranges = [0.0, 0.5, 5.0, 50.0]
+        self.setup_lakeshore(self.model_num)
 
-        # get the PID controll settings for loop 1 and loop 2 (there is no loop 0)
-        self.pid = [0, self.read_pid(1), self.read_pid(2)]
-
-    def read_heater_output(self) -> float:
-        """Query the percent power being output to the heater"""
-        return float(self.query('HTR?'))
-
-    def read_heater_range(self) -> float:
-        """Query the heater range. Returns value in Watts"""
-        return float(self.heater_ranges[int(self.query('RANGE?'))])
-
-    def read_pid(self, loop: int = 1) -> list:
-        """Returns in units of Kelvin per minute"""
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        msg_back = self.query(f"PID? {int(loop)}")
-        p = float(msg_back[0])
-        i = float(msg_back[1])
-        d = float(msg_back[2])
-        return [p, i, d]
-
-    def read_ramp_speed(self, loop: int = 1) -> float:
-        """Kelvin per minute"""
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        return float(self.query(f"RAMP? {loop}").split(',')[1])
-
-    def read_ramp_status(self, loop: int = 1) -> bool:
-        """Check whether the setpoint is ramping or not"""
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        return bool(int(self.query(f"RAMPST? {loop}")))
-
-    def read_setpoint(self, loop=1):
-        """Return the value of setpoint in current units"""
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        return float(self.query(f"SETP? {loop}"))
-
-    def read_temperature(self, channel: str = 'A', units: str = 'K') -> float:
-        """Read the temperature on a channel"""
-        # Ensure the variables are uppercase
-        channel = channel.upper()
-        units = units.upper()
-
-        # Ensure the variables are valid
-        if channel not in ['A', 'B']:
-            raise IOError(f"Invalid channel: {channel}")
-        if units not in ['K', 'C']:
-            raise IOError(f"Invalid units: {units}")
-        return float(self.query(f"{units}RDG? {channel}"))
-
-    def set_heater_range(self, power_range: float, override: bool = False):
-        """Sets the heater range"""
-        # ensure that the power_range is positive
-        power_range = abs(float(power_range))
-
-        # find the nearest valid setting to the power given
-        setting = np.argmin(self.heater_ranges - power_range)
-        if self.heater_ranges[setting] == 50. and not override:
-            print("50V is probably too high and will fry your solder joints. If you disagree, override==True")
-        else:
-            self.write(f"RANGE {setting}")
-
-    def set_pid(self, p='', i='', d='', loop=1):
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        if p == '':
-            p = self.PID[loop][0]
-        else:
-            self.PID[loop][1] = float(p)
-        if i == '':
-            i = self.PID[loop][1]
-        else:
-            self.PID[loop][1] = float(i)
-        if d == '':
-            d = self.PID[loop][2]
-        else:
-            self.PID[loop][2] = float(d)
-        self.write(f"PID {loop}, {p}, {i}, {d}")
-
-    def set_ramp_speed(self, kelvin_per_min, loop=1):
-        """Set the ramp speed to reach set point in Kelvin per min"""
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        self.write(f"RAMP {loop}, 1, {kelvin_per_min}")
-
-    def set_setpoint(self, value, loop=1):
-        """Configure Control loop setpoint.
-        loop: specifies which loop to configure.
-        value: the value for the setpoint (in whatever units the setpoint is using"""
-        if loop != 1 and loop != 2:
-            raise IOError(f"invalid loop: {loop}")
-        self.write(f"SETP {loop}, {float(value)}")
+    def wait_for_setpoint(self, setpoint: float = None, channel: str = 'A', loop: int = 1, tolerance: float = 0.1,
+                          window: float = 60., max_slope: float = None, timeout: float = None,
+                          polled: PolledChannel = None, **kwargs) -> Settled:
+        """Wait for the temperature on channel to settle at setpoint (the loop's setpoint if None). If the server is
+        already polling that channel, give its PolledChannel as polled, and the waiting won't send anything over the
+        bus. See wait_until_stable for the rest of the arguments"""
+        if setpoint is None:
+            setpoint = self.setpoint[loop]
+        if polled is not None:
+            return wait_until_stable(setpoint, channel=polled, tolerance=tolerance, window=window,
+                                     max_slope=max_slope, timeout=timeout, **kwargs)
+        return wait_until_stable(setpoint, read=lambda: self.read_temperature(channel, 'K'), tolerance=tolerance,
+                                 window=window, max_slope=max_slope, timeout=timeout, **kwargs)
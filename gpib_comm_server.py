@@ -9,55 +9,467 @@ communicate over the same protocol without hanging up the system
 import time
 import threading
 import socket
+import selectors
+import queue
+import json
+import collections
+import bisect
+import logging
+import logging.handlers
+import http.server
 import gpib
+import gpib_protocol as protocol
+import get
 
 
 lock = threading.Lock()
 
+# Messages about what the server is doing go through logging instead of print. Each message the server handles is logged
+# at the DEBUG level, so you only see them if you ask for them with setup_logging("DEBUG")
+logger = logging.getLogger("gpib_comm_server")
+_log_listener = None
+
+
+def setup_logging(level="INFO"):
+    """Send the server's log messages to the screen from a background thread, so that a slow command line window
+    never holds up the server"""
+    global _log_listener
+    logger.setLevel(level)
+    if _log_listener is None:
+        log_queue = queue.SimpleQueue()
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        _log_listener = logging.handlers.QueueListener(log_queue, handler)
+        _log_listener.start()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.propagate = False
+
+
+class Histogram:
+    """Counts how many times fell between each of the bounds (in seconds)"""
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)      # the last one is for anything longer than the last bound
+        self.total = 0.
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """[(bound, number of times at or under the bound)] ending with ("+Inf", count)"""
+        running = 0
+        buckets = []
+        for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts):
+            running += count
+            buckets.append((bound, running))
+        return buckets
+
+    def to_dict(self) -> dict:
+        return {"count": self.count,
+                "sum": self.total,
+                "mean": self.total / self.count if self.count else 0.,
+                "buckets": {str(bound): count for bound, count in self.cumulative()}}
+
+
+class Metrics:
+    """Keeps count of what the server has been doing: messages, timeouts, errors, and bytes for every instrument and
+    command, how long each took, how long messages waited for the bus, and how many are waiting right now.
+    Send "STATS" to the server to get all of it as JSON, or run serve_metrics to let Prometheus collect it"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}          # (dev_id, command) -> counters and a Histogram of how long it took
+        self.bus_wait = {}          # bus -> Histogram of how long messages waited in line for it
+        self.buses = {}             # gpib_num -> BusWorker
+        self.errors = 0
+        self.connections_open = 0
+        self.connections_total = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def record_command(self, dev_id: str, command: str, message: str, reply, seconds: float, cached: bool = False):
+        name = ResponseCache.command_of(message) or command
+        with self.lock:
+            counters = self.commands.get((dev_id, name))
+            if counters is None:
+                counters = {"count": 0, "cached": 0, "timeouts": 0, "bytes_out": 0, "bytes_in": 0,
+                            "latency": Histogram()}
+                self.commands[(dev_id, name)] = counters
+            counters["count"] += 1
+            counters["cached"] += cached
+            counters["timeouts"] += isinstance(reply, str) and reply == "timed out"
+            counters["bytes_out"] += len(message)
+            counters["bytes_in"] += reply.nbytes if hasattr(reply, "nbytes") else len(str(reply))
+            counters["latency"].observe(seconds)
+
+    def record_wait(self, bus, seconds: float):
+        with self.lock:
+            if bus not in self.bus_wait:
+                self.bus_wait[bus] = Histogram()
+            self.bus_wait[bus].observe(seconds)
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def record_bytes(self, received: int = 0, sent: int = 0):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_open += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections_open -= 1
+
+    def add_bus(self, worker):
+        with self.lock:
+            self.buses[worker.gpib_num] = worker
+
+    def snapshot(self) -> dict:
+        uptime = time.time() - self.started
+        with self.lock:
+            return {"uptime": uptime,
+                    "errors": self.errors,
+                    "connections_open": self.connections_open,
+                    "connections_total": self.connections_total,
+                    "bytes_received": self.bytes_received,
+                    "bytes_sent": self.bytes_sent,
+                    "commands": [dict(device=dev_id, command=name,
+                                      **{key: value.to_dict() if key == "latency" else value
+                                         for key, value in counters.items()})
+                                 for (dev_id, name), counters in self.commands.items()],
+                    "bus_wait": {str(bus): histogram.to_dict() for bus, histogram in self.bus_wait.items()},
+                    "buses": {str(gpib_num): {"queue_depth": worker.jobs.qsize(),
+                                              "jobs": worker.jobs_done,
+                                              "busy_seconds": worker.time_busy,
+                                              "utilization": worker.time_busy / uptime if uptime else 0.}
+                              for gpib_num, worker in self.buses.items()}}
+
+    def prometheus(self) -> str:
+        """All the metrics in the Prometheus text format"""
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        def histogram(name, histograms):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in histograms:
+                label_text = "".join(f'{key}="{label(val)}",' for key, val in labels.items())
+                for bound, count in hist.cumulative():
+                    lines.append(f'{name}_bucket{{{label_text}le="{bound}"}} {count}')
+                lines.append(f"{name}_sum{{{label_text.rstrip(',')}}} {hist.total}")
+                lines.append(f"{name}_count{{{label_text.rstrip(',')}}} {hist.count}")
+
+        uptime = time.time() - self.started
+        with self.lock:
+            commands = [({"device": dev_id, "command": name}, counters)
+                        for (dev_id, name), counters in self.commands.items()]
+            metric("gpib_requests_total", "counter", [(labels, c["count"]) for labels, c in commands])
+            metric("gpib_cache_hits_total", "counter", [(labels, c["cached"]) for labels, c in commands])
+            metric("gpib_timeouts_total", "counter", [(labels, c["timeouts"]) for labels, c in commands])
+            metric("gpib_instrument_bytes_sent_total", "counter", [(labels, c["bytes_out"]) for labels, c in commands])
+            metric("gpib_instrument_bytes_received_total", "counter",
+                   [(labels, c["bytes_in"]) for labels, c in commands])
+            histogram("gpib_request_seconds", [(labels, c["latency"]) for labels, c in commands])
+            histogram("gpib_bus_wait_seconds", [({"bus": bus}, hist) for bus, hist in self.bus_wait.items()])
+            metric("gpib_bus_queue_depth", "gauge",
+                   [({"bus": gpib_num}, worker.jobs.qsize()) for gpib_num, worker in self.buses.items()])
+            metric("gpib_bus_busy_seconds_total", "counter",
+                   [({"bus": gpib_num}, worker.time_busy) for gpib_num, worker in self.buses.items()])
+            metric("gpib_errors_total", "counter", [({}, self.errors)])
+            metric("gpib_connections_open", "gauge", [({}, self.connections_open)])
+            metric("gpib_connections_total", "counter", [({}, self.connections_total)])
+            metric("gpib_client_bytes_received_total", "counter", [({}, self.bytes_received)])
+            metric("gpib_client_bytes_sent_total", "counter", [({}, self.bytes_sent)])
+            metric("gpib_uptime_seconds", "gauge", [({}, uptime)])
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(port: int = 9101, host: str = "127.0.0.1"):
+    """Serve Interpreter.metrics at http://host:port/metrics in the text format Prometheus reads. Runs in a background
+    thread; call .shutdown() on what this returns to stop it"""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = Interpreter.metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on %s:%s", host, port)
+    return httpd
+
+
+class ResponseCache:
+    """Remembers replies to queries for settings that only change when someone writes them (like "PID?" or "*IDN?"),
+    so asking for them again doesn't have to go over the bus. Replies are kept separately for every instrument and every
+    message, for as long as the time to live (TTL) of the query, and are thrown out as soon as a write that changes
+    them comes through the server.
+    ttls - {query: seconds} for each query that can be cached. Anything not in here is always sent to the instrument
+    invalidated_by - {write command: [queries it changes]}. "*RST" throws out everything for that instrument"""
+    default_ttls = {"*IDN?": 3600.,
+                    "PID?": 60.,
+                    "RANGE?": 10.,
+                    "RAMP?": 10.,
+                    "SETP?": 1.}         # keep this short, the setpoint moves on its own while ramping
+    default_invalidated_by = {"PID": ["PID?"],
+                              "RANGE": ["RANGE?"],
+                              "SETP": ["SETP?"],
+                              "RAMP": ["RAMP?", "SETP?"]}
+
+    def __init__(self, ttls: dict = None, invalidated_by: dict = None):
+        self.ttls = dict(self.default_ttls if ttls is None else ttls)
+        self.invalidated_by = dict(self.default_invalidated_by if invalidated_by is None else invalidated_by)
+        self.entries = {}       # (dev_id, message) -> (time it expires, reply)
+        self.hits = {}          # query -> number of times it was answered from the cache
+        self.misses = {}        # query -> number of times it had to go to the instrument
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def command_of(message: str) -> str:
+        """The command is the first word of the message, e.g. PID? in "PID? 1" or SETP in "SETP 1,300" """
+        return message.replace(',', ' ').split(' ')[0].strip().upper()
+
+    @classmethod
+    def commands_of(cls, message: str) -> list:
+        """Every command in a message, since several can be joined with ";" like "SETP 1,300;RAMP 1,1,5" """
+        return [cls.command_of(part) for part in message.split(';') if part.strip()]
+
+    def set_ttl(self, query: str, seconds: float):
+        """Change how long a query is cached for. 0 stops caching it"""
+        with self.lock:
+            if seconds:
+                self.ttls[query.upper()] = float(seconds)
+            else:
+                self.ttls.pop(query.upper(), None)
+
+    def get(self, dev_id: str, message: str, count_miss: bool = True):
+        """Returns the cached reply, or None if there isn't a fresh one. count_miss=False is for a quick look before
+        the query is handed to whoever will count the miss when they ask again"""
+        command = self.command_of(message)
+        if any(part not in self.ttls for part in self.commands_of(message)):
+            return None
+        with self.lock:
+            entry = self.entries.get((dev_id, message))
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits[command] = self.hits.get(command, 0) + 1
+                return entry[1]
+            if count_miss:
+                self.misses[command] = self.misses.get(command, 0) + 1
+        return None
+
+    def put(self, dev_id: str, message: str, reply):
+        # a compound query is only kept as long as the shortest lived query in it
+        ttl = min(self.ttls.get(command, 0.) for command in self.commands_of(message))
+        if ttl and reply != "timed out":
+            with self.lock:
+                self.entries[(dev_id, message)] = (time.monotonic() + ttl, reply)
+
+    def invalidate(self, dev_id: str, message: str):
+        """Throw out anything a write to an instrument could have changed"""
+        commands = self.commands_of(message)
+        if "*RST" in commands:
+            stale = None
+        else:
+            stale = {query for command in commands for query in self.invalidated_by.get(command, [])}
+            if not stale:
+                return
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == dev_id and (stale is None or not stale.isdisjoint(self.commands_of(key[1]))):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": sum(self.hits.values()),
+                    "misses": sum(self.misses.values()),
+                    "entries": len(self.entries),
+                    "by_command": {command: {"hits": self.hits.get(command, 0), "misses": self.misses.get(command, 0)}
+                                   for command in set(self.hits) | set(self.misses)}}
+
 
 # This is an example of a class which is not meant to be used to create objects. Instead, you reference the class
 # directly and use the @classmethod
 class Interpreter:
-    """place device information here and rename to suit your needs"""
-    # lakeshore = gpib.Device(8)
-    # device2 = gpib.Device(13)
+    """The instruments the server talks to are kept in a DeviceRegistry loaded from get.gpib_address (instrument ID ->
+    GPIB address). Edit that dictionary to suit your needs, or add and remove instruments while the server is running
+    with REGISTRY::ADD::ID,ADDRESS,GPIB_NUM and REGISTRY::REMOVE::ID"""
+    devices = gpib.DeviceRegistry(get.gpib_address)
+
+    # replies to slow-changing settings are kept here. Use "CACHE::STATS" to see how often it helps and
+    # "CACHE::CLEAR" to empty it
+    cache = ResponseCache()
+
+    # the server's Poller, if it is running one (see ConcurrentServer)
+    poller = None
+
+    # counts of everything the server has done. Use "STATS" to get them
+    metrics = Metrics()
+
+    @classmethod
+    def find_instrument(cls, dev_id):
+        """Returns the device object that belongs to an instrument ID (or None if the ID isn't known)"""
+        return cls.devices.get(dev_id)
+
+    @classmethod
+    def bus_for(cls, message_to_parse):
+        """Returns the number of the GPIB interface a message will be sent over (or None if the ID isn't known).
+        REGISTRY::ADD and REGISTRY::REMOVE go in line on the bus of the instrument they replace or remove, so it isn't
+        closed in the middle of a message"""
+        dev_id, command, message = cls.split_message(message_to_parse)
+        if dev_id == "REGISTRY" and command in ("ADD", "REMOVE"):
+            dev_id = message.split(',')[0].strip().upper()
+        instrument = cls.find_instrument(dev_id)
+        if instrument:
+            return instrument.gpib_num
+        return None
+
+    @staticmethod
+    def split_message(message_to_parse) -> tuple:
+        """Splits "LS::Q::KRDG? A" into ("LS", "Q", "KRDG? A"). Only the instrument ID and the command are made upper
+        case, so the message to the instrument (and the JSON of a batch) gets there exactly as it was sent"""
+        msg_list = message_to_parse.split('::', 2)
+        dev_id = msg_list[0].strip().upper()
+        command = msg_list[1].strip().upper() if len(msg_list) > 1 else ''
+        message = msg_list[2] if len(msg_list) > 2 else ''
+        return dev_id, command, message
+
+    @classmethod
+    def cached_reply(cls, message_to_parse):
+        """The cached reply to a query message (like "LS::Q::PID? 1"), or None if it isn't a query with a fresh reply
+        in the cache. This doesn't touch the bus, so it can be answered without waiting in line behind other messages"""
+        dev_id, command, message = cls.split_message(message_to_parse)
+        if not command.startswith("Q") or cls.find_instrument(dev_id) is None:
+            return None
+        started = time.perf_counter()
+        msgout = cls.cache.get(dev_id, message, count_miss=False)
+        if msgout is not None:
+            cls.metrics.record_command(dev_id, "Q", message, msgout, time.perf_counter() - started, True)
+        return msgout
 
     @classmethod
     def parse(cls, message_to_parse):
-        """Parse a message of the format INSTRUMENT::READ,RIGHT,orQUERY::MESSAGEtoINSTRUMENT"""
-        msg_list = message_to_parse.upper().split('::')
-        dev_id = msg_list[0]
-        command = msg_list[1]
-        try:
-            message = msg_list[2]
-        except IndexError:
-            message = ''
-
-        """MUST EDIT THE FOLLOWING LINES TO SUIT YOUR NEEDS"""
-        if dev_id == "LS":
-            instrument = cls.lakeshore
-            print("Sending message to Lakeshore temperature controller")
-        elif dev_id == "MAKE THIS INSTRUMENT ID 2":
-            instrument = cls.instrument2
-            print("Sending message to instrument2")
-        else:
-            instrument = None
+        """Parse a message of the format INSTRUMENT::READ,RIGHT,orQUERY::MESSAGEtoINSTRUMENT
+        A query with the command "A" (array) uses query_ascii and gives back a NumPy array instead of a string.
+        The command "B" (batch) takes a JSON list of [command, message] pairs, runs them back to back, and gives back a
+        JSON list of the replies.
+        "STATS" gives back the server's Metrics as JSON.
+        "REGISTRY" changes which instruments the server knows about: REGISTRY::ADD::ID,ADDRESS[,GPIB_NUM],
+        REGISTRY::REMOVE::ID or REGISTRY::LIST
+        The instrument ID "CACHE" talks to the response cache instead of an instrument, and "POLL" asks the poller
+        for samples it has already taken: POLL::LATEST::NAME, POLL::HISTORY::NAME or POLL::CHANNELS"""
+        dev_id, command, message = cls.split_message(message_to_parse)
+        if dev_id == "STATS":
+            stats = cls.metrics.snapshot()
+            stats["cache"] = cls.cache.stats()
+            return json.dumps(stats)
+        if not command:
+            raise ValueError(f'"{message_to_parse}" needs a command, like {dev_id}::Q::message')
+
+        if dev_id == "CACHE":
+            if command == "CLEAR":
+                cls.cache.clear()
+                return 'empty'
+            return json.dumps(cls.cache.stats())
+        if dev_id == "REGISTRY":
+            return cls.change_registry(command, message.upper())
+        if dev_id == "POLL":
+            if cls.poller is None:
+                return 'The server is not polling anything'
+            return cls.poller.answer(command, message.strip().upper())
+
+        instrument = cls.find_instrument(dev_id)
 
         if instrument:
-            if command[0] == "W":
-                print(f'Writing "{message}" to {dev_id}')
-                instrument.write(message)
-                msgout = 'empty'
-            elif command[0] == "Q":
-                print(f'Querying {dev_id} with "{message}"')
-                msgout = instrument.query(message)
-            elif command[0] == "R":
-                print(f'Reading from {dev_id}')
-                msgout = instrument.read()
+            if command[0] == "B":
+                # whoever runs this message holds the bus until the whole batch is done
+                logger.debug('Running a batch of commands on %s', dev_id)
+                replies = [protocol.reply_to_text(cls.run(instrument, dev_id, batch_command.upper(), batch_message))
+                           for batch_command, batch_message in json.loads(message)]
+                msgout = json.dumps(replies)
+            else:
+                msgout = cls.run(instrument, dev_id, command, message)
         else:
             msgout = 'Did not give a valid device id'
         return msgout
 
+    @classmethod
+    def change_registry(cls, command, message):
+        if command == "ADD":
+            settings = [setting.strip() for setting in message.split(',')]
+            dev_id = settings[0]
+            addr = int(settings[1])
+            gpib_num = int(settings[2]) if len(settings) > 2 else 0
+            cls.devices.add(dev_id, {"addr": addr, "gpib_num": gpib_num})
+            # anything cached came from whatever had this ID before
+            cls.cache.invalidate(dev_id, "*RST")
+            logger.info("Added %s at GPIB%s::%s", dev_id, gpib_num, addr)
+            return 'empty'
+        elif command == "REMOVE":
+            cls.devices.remove(message)
+            cls.cache.invalidate(message, "*RST")
+            logger.info("Removed %s", message)
+            return 'empty'
+        elif command == "LIST":
+            return json.dumps({dev_id: device.resource_name for dev_id, device in cls.devices.devices.items()})
+        return f'Did not give a valid command: {command}'
+
+    @classmethod
+    def run(cls, instrument, dev_id, command, message):
+        """Read, write, or query the instrument"""
+        started = time.perf_counter()
+        cached = False
+        if command[0] == "W":
+            logger.debug('Writing "%s" to %s', message, dev_id)
+            result = instrument.write(message)
+            # even a write that timed out might have changed something
+            cls.cache.invalidate(dev_id, message)
+            msgout = result if result else 'empty'
+        elif command[0] == "Q":
+            msgout = cls.cache.get(dev_id, message)
+            if msgout is None:
+                logger.debug('Querying %s with "%s"', dev_id, message)
+                msgout = instrument.query(message)
+                cls.cache.put(dev_id, message, msgout)
+            else:
+                cached = True
+        elif command[0] == "R":
+            logger.debug('Reading from %s', dev_id)
+            msgout = instrument.read()
+        elif command[0] == "A":
+            logger.debug('Querying %s for an array with "%s"', dev_id, message)
+            msgout = instrument.query_ascii(message)
+        else:
+            msgout = f'Did not give a valid command: {command}'
+        cls.metrics.record_command(dev_id, command[0], message, msgout, time.perf_counter() - started, cached)
+        return msgout
+
 
 def server_echo_rev(host: str = "localhost", port: int = 62538):
     """Receives messages from a client and returns the message reversed"""
@@ -67,7 +479,7 @@ def server_echo_rev(host: str = "localhost", port: int = 62538):
     # open a socket
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((host, port))
-        print(f"Socket bound to port: {port}")
+        logger.info("Socket bound to port: %s", port)
 
         # put the socket into listening mode
         s.listen()
@@ -78,27 +490,24 @@ def server_echo_rev(host: str = "localhost", port: int = 62538):
             conn, addr = s.accept()
             lock.acquire()
             with conn:
-                print(f"Connected to: {addr[0]}:{addr[1]}  : {time.ctime(time.time())}")
-                while True:
-                    msg_client = conn.recv(1024)
-                    print(repr(msg_client))
-                    if not msg_client:
-                        lock.release()
-                        break
-                    elif msg_client == b"shutdown":
-                        running = False
-                        break
-                    else:
-                        print(f'Recieved message: {msg_client.decode()}')
-                        msg_server = msg_client.decode()[::-1]
+                logger.info("Connected to: %s:%s  : %s", addr[0], addr[1], time.ctime(time.time()))
+                # the message is everything the client sends before it stops sending
+                msg_client = protocol.recv_all(conn)
+                if msg_client == b"shutdown":
+                    running = False
+                elif msg_client:
+                    logger.debug('Recieved message: %s', msg_client)
+                    msg_server = msg_client.decode()[::-1]
                     conn.sendall(msg_server.encode())
+            lock.release()
 
 
-def server_gpib(host="localhost", port=62538):
+def server_gpib(host="localhost", port=62538, log_level="INFO"):
+    setup_logging(log_level)
     running = True
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((host, port))
-        print(f"Socket binded to port: {port}")
+        logger.info("Socket binded to port: %s", port)
 
         # put the socket into listening mode
         s.listen()
@@ -109,23 +518,470 @@ def server_gpib(host="localhost", port=62538):
             conn, addr = s.accept()
             lock.acquire()
             with conn:
-                print(f"Connected to :{addr[0]}:{addr[1]}  : {time.ctime(time.time())}")
-                while True:
-                    msg_client = conn.recv(1024)
-                    # print(repr(msg_client))
-                    if not msg_client:
-                        lock.release()
-                        break
-                    elif msg_client == b"shutdown":
-                        running = False
-                        break
-                    else:
-                        print(f'Recieved message: {msg_client.decode()}')
-                        # parse message
-                        msg_server = Interpreter.parse(msg_client.encode())
-                        print(repr(msg_server))
+                logger.info("Connected to :%s:%s  : %s", addr[0], addr[1], time.ctime(time.time()))
+                # the message is everything the client sends before it stops sending
+                msg_client = protocol.recv_all(conn)
+                if msg_client == b"shutdown":
+                    running = False
+                elif msg_client:
+                    logger.debug('Recieved message: %s', msg_client)
+                    # parse message
+                    msg_server = protocol.reply_to_text(Interpreter.parse(msg_client.decode()))
+                    logger.debug('%r', msg_server)
                     conn.sendall(msg_server.encode())
+            lock.release()
+
+
+class BusWorker(threading.Thread):
+    """Each GPIB interface gets one of these. Messages for instruments on the same bus wait in line in its queue and
+    are sent one at a time, while messages for instruments on a different bus are handled by that bus's worker, so they
+    don't have to wait."""
+    def __init__(self, gpib_num):
+        super(BusWorker, self).__init__(name=f"GPIB{gpib_num}-worker", daemon=True)
+        self.gpib_num = gpib_num
+        self.jobs = queue.Queue()
+        self.jobs_done = 0
+        self.time_waiting = 0.      # seconds messages spent in line for the bus, added up
+        self.time_busy = 0.         # seconds the bus spent running messages, added up
+        Interpreter.metrics.add_bus(self)
+
+    def submit(self, message, callback):
+        """Put a message in line for this bus. callback(reply) is called from the worker thread when it's done"""
+        self.jobs.put((message, callback, time.perf_counter()))
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            message, callback, submitted = job
+            started = time.perf_counter()
+            reply = run_message(message)
+            Interpreter.metrics.record_wait(self.gpib_num, started - submitted)
+            self.time_waiting += started - submitted
+            self.time_busy += time.perf_counter() - started
+            self.jobs_done += 1
+            callback(reply)
+
+
+def run_message(message):
+    """Send a message through the Interpreter without letting a bad message kill the thread that runs it. If it fails,
+    the reply is a gpib_protocol.ServerError, which framed clients get as an ERROR frame and everyone else as text"""
+    try:
+        return Interpreter.parse(message)
+    except Exception as e:
+        Interpreter.metrics.record_error()
+        logger.warning('Could not run "%s": %s', message, e)
+        return protocol.ServerError(f"error: {e}")
+
+
+class ClientConnection:
+    """Keeps track of the bytes going in and out of one client socket for the concurrent server"""
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.mode = None        # decided by the first message: "plain", "tagged" ("@ID::" lines) or "framed"
+        self.subscriptions = []     # (channel name, callback) registered with the Poller
+        self.frames = protocol.FrameReader()
+        self.open = True
+        self.pending = 0            # messages that haven't been answered yet
+        self.closing = False        # the client is done sending, so close once every reply has gone out
+        self.events = selectors.EVENT_READ      # what the selector is watching the socket for (0 if nothing)
+
+    def encode_reply(self, tag, reply) -> bytes:
+        if self.mode == "framed":
+            return protocol.encode_reply(tag, reply)
+        reply = protocol.reply_to_text(reply)
+        if self.mode == "tagged":
+            # tagged replies are one line each, so line breaks from the instrument are stripped off
+            return f"@{tag}::{reply.strip().replace(chr(10), ' ')}\n".encode()
+        return reply.encode()
+
+
+class Poller(threading.Thread):
+    """Reads a set of named channels at a fixed rate, so clients can get the newest reading (or a stream of readings)
+    without every client sending its own queries over the bus. The bus traffic depends on the number of channels and
+    not on the number of clients.
+    channels - {name: message}, e.g. {"TEMP_A": "LS::Q::KRDG? A", "HEATER": "LS::Q::HTR?"}
+    submit - submit(message, callback) sends a message the same way a client's would (ConcurrentServer.dispatch)
+    rate - readings per second
+    history - how many readings of each channel to keep"""
+    def __init__(self, channels: dict, submit, rate: float = 1., history: int = 3600):
+        super(Poller, self).__init__(name="poller", daemon=True)
+        self.channels = {name.upper(): message for name, message in channels.items()}
+        self.submit = submit
+        self.period = 1. / rate
+        self.latest = {}        # name -> (time, value)
+        self.history = {name: collections.deque(maxlen=history) for name in self.channels}
+        self.subscribers = {name: [] for name in self.channels}     # name -> [callback(time, value)]
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        next_time = time.monotonic()
+        while not self.stopped.is_set():
+            # send every channel off at once (so channels on different buses are read at the same time) and wait
+            # until they are all back before starting the next round
+            remaining = [len(self.channels)]
+            round_done = threading.Event()
+            for name, message in self.channels.items():
+                self.submit(message, self.reply_handler(name, remaining, round_done))
+            round_done.wait()
+
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                # the bus can't keep up with the rate, so start the next round right away instead of trying to catch up
+                next_time = time.monotonic()
+                delay = 0
+            self.stopped.wait(delay)
+
+    def reply_handler(self, name, remaining, round_done):
+        def callback(reply):
+            self.publish(name, time.time(), self.value_of(reply))
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    round_done.set()
+        return callback
+
+    @staticmethod
+    def value_of(reply):
+        try:
+            return float(reply)
+        except (TypeError, ValueError):
+            return str(reply).strip()
+
+    def publish(self, name, timestamp, value):
+        with self.lock:
+            self.latest[name] = (timestamp, value)
+            self.history[name].append((timestamp, value))
+            subscribers = list(self.subscribers[name])
+        for callback in subscribers:
+            callback(timestamp, value)
+
+    def subscribe(self, name, callback):
+        """callback(time, value) will be called with every new reading of the channel"""
+        name = name.upper()
+        with self.lock:
+            self.subscribers[name].append(callback)
+
+    def unsubscribe(self, name, callback):
+        with self.lock:
+            if callback in self.subscribers.get(name.upper(), []):
+                self.subscribers[name.upper()].remove(callback)
+
+    def answer(self, command, name):
+        """Answers the "POLL::..." messages"""
+        if command == "CHANNELS":
+            return json.dumps(self.channels)
+        if name not in self.channels:
+            return f'Not polling a channel called: {name}'
+        with self.lock:
+            if command == "LATEST":
+                return json.dumps(self.latest.get(name))
+            elif command == "HISTORY":
+                return json.dumps(list(self.history[name]))
+        return f'Did not give a valid command: {command}'
+
+    def stop(self):
+        self.stopped.set()
+
+
+class ConcurrentServer:
+    """Same commands as server_gpib, but clients don't lock each other out for as long as they stay connected.
+    A single thread watches every client socket (with selectors) and hands each message to the worker of the GPIB
+    interface the instrument is on. Only one message at a time goes over a given bus, but different buses (and
+    different clients) don't wait on each other.
+
+    Clients can either send one plain message per connection (like they do with server_gpib, the message being
+    everything they send before shutting down their side of the connection), or keep the connection open and send
+    tagged lines "@ID::LS::Q::KRDG? A\n". Tagged messages are answered with "@ID::reply\n" as soon as they are done,
+    which may be out of order, so one connection can have many requests in flight. Clients that start with
+    gpib_protocol.MAGIC get length-prefixed frames instead, which can carry long replies and raw NumPy arrays.
+
+    If poll_channels ({name: message}) is given, the server also runs a Poller that reads those channels poll_rate
+    times a second. Tagged and framed clients can send "POLL::SUBSCRIBE::NAME" to get every new reading pushed to them
+    with the same ID, until they send "POLL::UNSUBSCRIBE::NAME" or disconnect.
+
+    If metrics_port is given, the server's Metrics can be read by Prometheus at http://host:metrics_port/metrics"""
+    def __init__(self, host="localhost", port=62538, poll_channels: dict = None, poll_rate: float = 1.,
+                 poll_history: int = 3600, metrics_port: int = None):
+        self.host = host
+        self.port = port
+        self.metrics_port = metrics_port
+        self.workers = {}               # gpib_num -> BusWorker
+        self.workers_lock = threading.Lock()
+        self.writes_waiting = {}        # instrument ID -> writes (and batches) handed to a worker that haven't run yet
+        self.finished = queue.Queue()   # (client, bytes, answered) handed back by the workers
+        self.clients = set()            # open ClientConnections, including ones the selector isn't watching
+        self.sel = selectors.DefaultSelector()
+        self.running = False
+
+        # the workers poke this socket pair after putting a reply in "finished" so the selector wakes up to send it
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.sel.register(self.wake_recv, selectors.EVENT_READ, data="wake")
+
+        self.poller = None
+        if poll_channels:
+            self.poller = Poller(poll_channels, self.dispatch, rate=poll_rate, history=poll_history)
+
+    def serve_forever(self):
+        self.running = True
+        if self.poller is not None:
+            Interpreter.poller = self.poller
+            self.poller.start()
+        metrics_server = serve_metrics(self.metrics_port) if self.metrics_port else None
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.host, self.port))
+            logger.info("Socket bound to port: %s", self.port)
+            s.listen()
+            s.setblocking(False)
+            self.sel.register(s, selectors.EVENT_READ, data=None)
+
+            while self.running:
+                for key, mask in self.sel.select():
+                    if key.data is None:
+                        self.accept(s)
+                    elif key.data == "wake":
+                        self.wake_recv.recv(1024)
+                        while not self.finished.empty():
+                            self.queue_reply(*self.finished.get())
+                    else:
+                        if mask & selectors.EVENT_READ:
+                            self.read_from(key.data)
+                        if mask & selectors.EVENT_WRITE:
+                            self.write_to(key.data)
+                    if not self.running:
+                        break
+
+            for client in list(self.clients):
+                self.close(client)
+            self.sel.unregister(s)
+        if self.poller is not None:
+            self.poller.stop()
+            Interpreter.poller = None
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        for worker in self.workers.values():
+            worker.stop()
+        self.workers = {}
+
+    def shutdown(self):
+        """Stop the server from another thread"""
+        self.running = False
+        self.wake_send.send(b"\0")
+
+    def accept(self, s):
+        conn, addr = s.accept()
+        conn.setblocking(False)
+        client = ClientConnection(conn, addr)
+        self.sel.register(conn, selectors.EVENT_READ, data=client)
+        self.clients.add(client)
+        Interpreter.metrics.connection_opened()
+        logger.info("Connected to: %s:%s  : %s", addr[0], addr[1], time.ctime(time.time()))
+
+    def watch(self, client, events: int):
+        """Change what the selector watches a client's socket for (0 stops watching it)"""
+        if events == client.events:
+            return
+        if not client.events:
+            self.sel.register(client.conn, events, data=client)
+        elif not events:
+            self.sel.unregister(client.conn)
+        else:
+            self.sel.modify(client.conn, events, data=client)
+        client.events = events
+
+    def close(self, client):
+        client.open = False
+        self.clients.discard(client)
+        for name, callback in client.subscriptions:
+            self.poller.unsubscribe(name, callback)
+        self.watch(client, 0)
+        client.conn.close()
+        Interpreter.metrics.connection_closed()
+        logger.info("Disconnected from: %s:%s  : %s", client.addr[0], client.addr[1], time.ctime(time.time()))
+
+    def read_from(self, client):
+        try:
+            msg_client = client.conn.recv(4096)
+        except ConnectionError:
+            msg_client = b""
+        if not msg_client:
+            if client.mode == "plain" and client.inbox:
+                # the client has stopped sending, so the whole plain message is in
+                message = client.inbox.decode()
+                client.inbox.clear()
+                if message == "shutdown":
+                    self.running = False
+                    return
+                self.handle(client, message)
+            if client.pending or client.outbox:
+                # the client has stopped sending (like gpib_client_tools.send does) but is still waiting for replies
+                client.closing = True
+                self.watch(client, selectors.EVENT_WRITE if client.outbox else 0)
+            else:
+                self.close(client)
+            return
+        Interpreter.metrics.record_bytes(received=len(msg_client))
+        if client.mode is None:
+            if msg_client.startswith(protocol.MAGIC[:len(msg_client)]):
+                client.mode = "framed"
+            elif msg_client.startswith(b"@"):
+                client.mode = "tagged"
+            else:
+                client.mode = "plain"
+
+        if client.mode == "framed":
+            try:
+                frames = client.frames.feed(msg_client)
+            except IOError:
+                self.close(client)
+                return
+            for kind, req_id, body in frames:
+                message = body.decode()
+                if message == "shutdown":
+                    self.running = False
+                    return
+                self.handle(client, message, req_id)
+            return
+
+        client.inbox += msg_client
+        if client.mode == "plain":
+            # a plain message can take several recvs, so it waits until the client stops sending
+            return
+        while b"\n" in client.inbox:
+            line, _, rest = client.inbox.partition(b"\n")
+            client.inbox = bytearray(rest)
+            line = line.decode().rstrip("\r")
+            if line == "shutdown":
+                self.running = False
+                return
+            tag, _, message = line[1:].partition("::")
+            self.handle(client, message, tag)
+
+    def write_to(self, client):
+        if not client.open:
+            return
+        try:
+            sent = client.conn.send(client.outbox)
+        except ConnectionError:
+            self.close(client)
+            return
+        del client.outbox[:sent]
+        Interpreter.metrics.record_bytes(sent=sent)
+        if not client.outbox:
+            if client.closing:
+                if client.pending:
+                    self.watch(client, 0)
+                else:
+                    self.close(client)
+            else:
+                self.watch(client, selectors.EVENT_READ)
+
+    def queue_reply(self, client, data: bytes, answered: bool = True):
+        """Send data to a client. answered is False for readings pushed to a subscriber, which aren't the reply to a
+        message"""
+        if client.open:
+            client.pending -= answered
+            client.outbox += data
+            events = selectors.EVENT_WRITE if client.closing else selectors.EVENT_READ | selectors.EVENT_WRITE
+            self.watch(client, events)
+
+    def handle(self, client, message, tag=None):
+        """Send a message to the worker for its bus and set up the reply to go back to the client"""
+        logger.debug('Recieved message: %s', message)
+
+        def callback(reply, answered=True):
+            self.finished.put((client, client.encode_reply(tag, reply), answered))
+            self.wake_send.send(b"\0")
+
+        client.pending += 1
+        msg_list = message.upper().split('::', 2)
+        if msg_list[0] == "POLL" and len(msg_list) == 3 and msg_list[1] in ("SUBSCRIBE", "UNSUBSCRIBE"):
+            self.handle_subscription(client, msg_list[1], msg_list[2], tag, callback)
+        else:
+            self.dispatch(message, callback)
+
+    def handle_subscription(self, client, command, name, tag, callback):
+        if self.poller is None:
+            callback('The server is not polling anything')
+        elif name not in self.poller.channels:
+            callback(f'Not polling a channel called: {name}')
+        elif client.mode == "plain":
+            callback('Subscribing needs a tagged or framed connection')
+        elif command == "SUBSCRIBE":
+            def push(timestamp, value):
+                callback(json.dumps([timestamp, value]), answered=False)
+            # the readings that get pushed aren't a reply, so nothing is owed for this message
+            client.pending -= 1
+            client.subscriptions.append((name, push))
+            self.poller.subscribe(name, push)
+        else:
+            for subscription in [sub for sub in client.subscriptions if sub[0] == name]:
+                client.subscriptions.remove(subscription)
+                self.poller.unsubscribe(*subscription)
+            callback('empty')
+
+    def dispatch(self, message, callback):
+        """Run a message on the worker for its bus and hand the reply to callback(reply)"""
+        try:
+            gpib_num = Interpreter.bus_for(message)
+        except Exception:
+            gpib_num = None
+        if gpib_num is None:
+            # not an instrument on any bus, so there's nothing to wait in line for
+            callback(run_message(message))
+            return
+        dev_id, command, _ = Interpreter.split_message(message)
+        with self.workers_lock:
+            writing = self.writes_waiting.get(dev_id, 0)
+        # a query the cache can answer doesn't have to wait in line behind slow messages on the bus. If a write to the
+        # same instrument is still in line, it could change the answer, so the query waits its turn behind it
+        cached = Interpreter.cached_reply(message) if not writing else None
+        if cached is not None:
+            callback(cached)
+            return
+        if command[:1] in ("W", "B"):
+            callback = self.track_write(dev_id, callback)
+        with self.workers_lock:
+            if gpib_num not in self.workers:
+                self.workers[gpib_num] = BusWorker(gpib_num)
+                self.workers[gpib_num].start()
+            worker = self.workers[gpib_num]
+        worker.submit(message, callback)
+
+    def track_write(self, dev_id, callback):
+        """Count a write as waiting until it has run, and give back the callback to hand its reply to"""
+        with self.workers_lock:
+            self.writes_waiting[dev_id] = self.writes_waiting.get(dev_id, 0) + 1
+
+        def written(reply):
+            with self.workers_lock:
+                self.writes_waiting[dev_id] -= 1
+                if not self.writes_waiting[dev_id]:
+                    del self.writes_waiting[dev_id]
+            callback(reply)
+        return written
+
+
+def server_gpib_concurrent(host="localhost", port=62538, poll_channels: dict = None, poll_rate: float = 1.,
+                           metrics_port: int = None, log_level="INFO"):
+    """Runs a ConcurrentServer until a client sends the shutdown message"""
+    setup_logging(log_level)
+    ConcurrentServer(host, port, poll_channels=poll_channels, poll_rate=poll_rate,
+                     metrics_port=metrics_port).serve_forever()
 
 
 if __name__ == "__main__":
+    setup_logging("DEBUG")
     server_echo_rev()
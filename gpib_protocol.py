@@ -0,0 +1,139 @@
+"""
+Example code created for the Quantum Forge course
+This code holds the pieces of the framed message protocol shared by gpib_comm_server and gpib_client_tools.
+
+The plain protocol sends a message like "LS::Q::KRDG? A" on its own connection and reads until the server hangs up, so
+only one message fits on a connection and numbers can only be sent as text. A framed connection puts a small header in
+front of every message saying how long it is and what kind of message it is, so the other end knows exactly how many
+bytes to wait for.
+NumPy arrays are sent as their raw little-endian bytes and turned back into arrays with np.frombuffer, so nothing has
+to be converted to text and back.
+
+Every frame looks like
+    MAGIC (4 bytes) | kind (1 byte) | request ID (4 bytes) | body length (4 bytes) | body
+A connection is framed if the very first bytes the client sends are MAGIC, otherwise the server treats it as plain text.
+
+@author: Teddy Tortorici
+"""
+
+import struct
+import numpy as np
+
+
+MAGIC = b"GPF1"
+HEADER = struct.Struct("<4sBII")
+
+# kinds of frames
+TEXT = 1        # body is a utf-8 message (requests, and replies that are just text)
+ARRAY = 2       # body is a NumPy array, see encode_array
+ERROR = 3       # body is a utf-8 error message
+
+ARRAY_HEADER = struct.Struct("<BB")     # length of the dtype string, number of dimensions
+
+
+class ServerError(IOError):
+    """Something went wrong on the server while it was handling a message. The server hands one of these back as the
+    reply, which goes to framed clients as an ERROR frame (and is raised there by decode_reply), and to plain and
+    tagged clients as its text, like "error: ..." """
+
+
+def encode_frame(kind: int, req_id: int, body=b"") -> bytes:
+    """Put the header in front of a body"""
+    return HEADER.pack(MAGIC, kind, req_id, len(body)) + bytes(body)
+
+
+def encode_array(array) -> bytes:
+    """Turns an array into a body for an ARRAY frame: dtype string, shape, then the raw little-endian data"""
+    array = np.asarray(array)
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    dtype = array.dtype.str.encode()
+    shape = struct.pack(f"<{array.ndim}Q", *array.shape)
+    return ARRAY_HEADER.pack(len(dtype), array.ndim) + dtype + shape + array.tobytes()
+
+
+def decode_array(body) -> np.ndarray:
+    """Turns the body of an ARRAY frame back into an array. The array points at the body's memory instead of copying it
+    (so it is read-only if the body is bytes)"""
+    dtype_len, ndim = ARRAY_HEADER.unpack_from(body, 0)
+    offset = ARRAY_HEADER.size
+    dtype = np.dtype(bytes(body[offset:offset + dtype_len]).decode())
+    offset += dtype_len
+    shape = struct.unpack_from(f"<{ndim}Q", body, offset)
+    offset += 8 * ndim
+    return np.frombuffer(body, dtype=dtype, offset=offset).reshape(shape)
+
+
+def encode_reply(req_id: int, reply) -> bytes:
+    """Chooses the kind of frame based on what the Interpreter gave back"""
+    if isinstance(reply, np.ndarray):
+        return encode_frame(ARRAY, req_id, encode_array(reply))
+    if isinstance(reply, ServerError):
+        return encode_frame(ERROR, req_id, str(reply).encode())
+    return encode_frame(TEXT, req_id, str(reply).encode())
+
+
+def decode_reply(kind: int, body):
+    if kind == ARRAY:
+        return decode_array(body)
+    elif kind == ERROR:
+        raise ServerError(bytes(body).decode())
+    return bytes(body).decode()
+
+
+def reply_to_text(reply) -> str:
+    """Arrays can still go to plain text clients, they just get written out comma separated"""
+    if isinstance(reply, np.ndarray):
+        return ','.join(repr(float(x)) for x in reply.ravel())
+    return str(reply)
+
+
+class FrameReader:
+    """Collects bytes as they arrive on a non-blocking socket and hands back complete frames"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        """Add newly received bytes. Returns a list of (kind, request ID, body) for every frame that is now complete"""
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            magic, kind, req_id, length = HEADER.unpack_from(self.buffer, 0)
+            if magic != MAGIC:
+                raise IOError("lost track of the frames in the stream")
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((kind, req_id, bytes(self.buffer[HEADER.size:end])))
+            del self.buffer[:end]
+        return frames
+
+
+def recv_exactly(sock, n: int) -> bytearray:
+    """Blocks until exactly n bytes have come in (a single recv can return less than was sent)"""
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    got = 0
+    while got < n:
+        count = sock.recv_into(view[got:], n - got)
+        if count == 0:
+            raise ConnectionError("connection closed in the middle of a frame")
+        got += count
+    return buffer
+
+
+def recv_all(sock) -> bytes:
+    """Blocks until the other end stops sending, and returns everything that came in. A plain message is everything
+    the client sends before it shuts down its side of the connection, and the reply is everything the server sends
+    before it closes it"""
+    chunks = []
+    while chunk := sock.recv(65536):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+    """Read one whole frame from a blocking socket. Returns (kind, request ID, body)"""
+    magic, kind, req_id, length = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if magic != MAGIC:
+        raise IOError("lost track of the frames in the stream")
+    return kind, req_id, recv_exactly(sock, length)
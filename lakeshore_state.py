@@ -0,0 +1,332 @@
+"""
+Example code created for the Quantum Forge course
+This code keeps a copy of a LakeShore's settings (PID, setpoint, ramp, heater range) on the computer, so they don't have
+to be asked for over the bus every time they're needed.
+
+Nothing is asked for until the first time a setting is used, so making a LakeShore object doesn't send anything. After
+that, the copy is kept up to date by every change made through the LakeShore object. If something else could have
+changed the settings (like the front panel or another script), refresh() asks for all of them again in one transaction.
+Both LakeShore classes (in temperature_controller and gpib_client_tools) get their commands from LakeShoreCommands, so
+they behave the same whether they talk to the instrument directly or through the server:
+```
+ls = LakeShore(12)
+print(ls.pid[1])                # asks the instrument the first time only
+ls.set_pid(p=40)                # sends the change and updates the copy
+with ls.staged():               # several changes sent as one message
+    ls.set_ramp_speed(5)
+    ls.set_setpoint(300)
+ls.refresh()
+```
+
+@author: Teddy Tortorici
+"""
+
+import contextlib
+import numpy as np
+import gpib_protocol as protocol
+
+
+def parse_pid(reply: str) -> tuple:
+    """Turns a reply like "+50.0,+20.0,+0.0" into (50., 20., 0.)"""
+    p, i, d = [float(element) for element in reply.split(',')]
+    return p, i, d
+
+
+def parse_ramp(reply: str) -> tuple:
+    """Turns a reply like "1,+10.0" into (1, 10.) for on/off and Kelvin per minute"""
+    on, rate = reply.split(',')
+    return int(on), float(rate)
+
+
+def write_succeeded(reply) -> bool:
+    """gpib.Device.write gives back "" and the server gives back "empty" when a write went through. Anything else
+    (like "timed out") means it might not have"""
+    return reply is None or reply in ("", "empty")
+
+
+class LoopValues:
+    """Lets a setting be used like a list indexed by loop number, e.g. ls.pid[1] or ls.setpoint[2] = 300"""
+    def __init__(self, state, name: str):
+        self.state = state
+        self.name = name
+
+    def __getitem__(self, loop: int):
+        return self.state.get(self.name, loop)
+
+    def __setitem__(self, loop: int, value):
+        self.state.set(self.name, value, loop)
+
+    def __repr__(self):
+        return f"[{', '.join(repr(self.state.values.get((self.name, loop), '?')) for loop in (1, 2))}]"
+
+
+class LakeShoreState:
+    """The local copy of the settings of one LakeShore. device needs query, write and query_many methods (and a
+    compound_queries attribute), like both LakeShore classes have"""
+    # name: (query, write, function that turns the reply into a value). {loop} is filled in for settings that have one
+    # per loop, and the value goes in {0}, {1}, ...
+    settings = {'pid': ("PID? {loop}", "PID {loop}, {0}, {1}, {2}", parse_pid),
+                'setpoint': ("SETP? {loop}", "SETP {loop}, {0}", float),
+                'ramp': ("RAMP? {loop}", "RAMP {loop}, {0}, {1}", parse_ramp),
+                'range': ("RANGE?", "RANGE {0}", int)}
+    loops = {'pid': (1, 2), 'setpoint': (1, 2), 'ramp': (1, 2), 'range': (None,)}
+
+    def __init__(self, device):
+        self.device = device
+        self.values = {}            # (name, loop) -> value
+        self.staged = None          # list of (name, loop, value, message) while changes are being staged
+
+    def get(self, name: str, loop: int = None):
+        """The value of a setting, asking the instrument only if it hasn't been asked yet"""
+        if (name, loop) not in self.values:
+            query = self.settings[name][0].format(loop=loop)
+            self.update(name, self.device.query(query), loop)
+        return self.values[(name, loop)]
+
+    def update(self, name: str, reply: str, loop: int = None):
+        """Store a value from a reply to the setting's query, and give back the value"""
+        value = self.settings[name][2](reply)
+        self.values[(name, loop)] = value
+        return value
+
+    def set(self, name: str, value, loop: int = None) -> bool:
+        """Change a setting on the instrument and in the copy (or wait until flush() if changes are being staged).
+        The copy only changes if the write went through. If it didn't, the setting is forgotten so it gets asked for
+        again the next time it's used. Returns whether the write went through"""
+        values = value if isinstance(value, tuple) else (value,)
+        message = self.settings[name][1].format(*values, loop=loop)
+        if self.staged is not None:
+            self.staged.append((name, loop, value, message))
+            return True
+        return self.written(name, loop, value, self.device.write(message))
+
+    def written(self, name: str, loop: int, value, reply) -> bool:
+        """Update the copy after a write that got reply"""
+        if write_succeeded(reply):
+            self.values[(name, loop)] = value
+            return True
+        self.values.pop((name, loop), None)
+        return False
+
+    def flush(self) -> bool:
+        """Send every staged change in one message. Returns whether every write went through (if the compound write
+        didn't, every setting in it is forgotten so it gets asked for again)"""
+        if not self.staged:
+            return True
+        staged, self.staged = self.staged, []
+        if self.device.compound_queries:
+            reply = self.device.write(';'.join(message for _, _, _, message in staged))
+            replies = [reply] * len(staged)
+        else:
+            replies = [self.device.write(message) for _, _, _, message in staged]
+        results = [self.written(name, loop, value, reply) for (name, loop, value, _), reply in zip(staged, replies)]
+        return all(results)
+
+    @contextlib.contextmanager
+    def staging(self):
+        """Changes made inside the with block are sent together when it ends (and dropped if there was an error)"""
+        if self.staged is not None:
+            # already staging, the outer block sends them
+            yield self
+            return
+        self.staged = []
+        try:
+            yield self
+            self.flush()
+        finally:
+            self.staged = None
+
+    def refresh(self, names: list = None):
+        """Ask the instrument for the settings again (all of them if names is None) in one transaction"""
+        names = list(self.settings) if names is None else names
+        keys = [(name, loop) for name in names for loop in self.loops[name]]
+        replies = self.device.query_many([self.settings[name][0].format(loop=loop) for name, loop in keys])
+        for (name, loop), reply in zip(keys, replies):
+            self.update(name, reply, loop)
+
+    def forget(self):
+        """Throw away the copy, so every setting is asked for again the next time it's used"""
+        self.values = {}
+
+
+class LakeShoreCommands:
+    """The commands both LakeShore classes have in common. The class using this needs query and write methods (like
+    gpib.Device and gpib_client_tools.Device have) and calls setup_lakeshore(model) from its __init__"""
+    # these models answer "KRDG? 0" with every input at once
+    all_inputs_models = (336, 350)
+
+    def setup_lakeshore(self, model: int):
+        self.inputs = ['A', 'B', 'C', 'D'] if model in (340, 336, 350) else ['A', 'B']
+        self.reads_all_inputs = model in self.all_inputs_models
+        # several queries joined with ";" get answered in one transaction. Turned off if the instrument doesn't
+        self.compound_queries = True
+        self.compound_timeouts = 0      # calls in a row where a compound query timed out twice
+
+        # local copy of the settings. Nothing is asked for until it's used, so making the object doesn't send anything
+        self.state = LakeShoreState(self)
+        # indexed by loop like a list, e.g. self.pid[1] is (p, i, d) for loop 1
+        self.pid = LoopValues(self.state, 'pid')
+        self.setpoint = LoopValues(self.state, 'setpoint')
+        self.ramp = LoopValues(self.state, 'ramp')         # (on/off, Kelvin per minute)
+        self.PID = self.pid         # the name older scripts use
+
+    def read_heater_output(self) -> float:
+        """Query the percent power being output to the heater"""
+        return float(self.query('HTR?'))
+
+    def read_heater_range(self) -> float:
+        """Query the heater range. Returns value in Watts"""
+        return float(self.heater_ranges[self.state.update('range', self.query('RANGE?'))])
+
+    @property
+    def heater_range(self) -> float:
+        """The heater range in Watts from the local copy (only asks the instrument the first time)"""
+        return float(self.heater_ranges[self.state.get('range')])
+
+    def read_pid(self, loop: int = 1) -> tuple:
+        """Returns in units of Kelvin per minute"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        return self.state.update('pid', self.query(f"PID? {int(loop)}"), loop)
+
+    def read_ramp_speed(self, loop: int = 1) -> float:
+        """Kelvin per minute"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        return self.state.update('ramp', self.query(f"RAMP? {loop}"), loop)[1]
+
+    def read_ramp_status(self, loop: int = 1) -> bool:
+        """Check whether the setpoint is ramping or not"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        return bool(int(self.query(f"RAMPST? {loop}")))
+
+    def read_setpoint(self, loop=1):
+        """Return the value of setpoint in current units"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        return self.state.update('setpoint', self.query(f"SETP? {loop}"), loop)
+
+    def refresh(self):
+        """Ask the instrument for all of the settings again (in one transaction), in case something other than this
+        object changed them"""
+        self.state.refresh()
+
+    def staged(self):
+        """Changes made with the set_ methods inside a with block are sent together as one message when it ends"""
+        return self.state.staging()
+
+    def read_temperature(self, channel: str = 'A', units: str = 'K') -> float:
+        """Read the temperature on a channel"""
+        # Ensure the variables are uppercase
+        channel = channel.upper()
+        units = units.upper()
+
+        # Ensure the variables are valid
+        if channel not in self.inputs:
+            raise IOError(f"Invalid channel: {channel}")
+        if units not in ['K', 'C']:
+            raise IOError(f"Invalid units: {units}")
+        return float(self.query(f"{units}RDG? {channel}"))
+
+    def read_temperatures(self, channels: list = None, units: str = 'K') -> np.ndarray:
+        """Read several channels (all of them if channels is None) in one transaction on the bus. Returns an array in
+        the same order as channels"""
+        channels = self.inputs if channels is None else [channel.upper() for channel in channels]
+        units = units.upper()
+        for channel in channels:
+            if channel not in self.inputs:
+                raise IOError(f"Invalid channel: {channel}")
+        if units not in ['K', 'C']:
+            raise IOError(f"Invalid units: {units}")
+        messages = self.temperature_messages(channels, units)
+        return np.array(self.temperatures_from_replies(self.query_many(messages), channels))
+
+    def read_all(self, units: str = 'K', loop: int = 1) -> np.ndarray:
+        """Every input, the heater output (%), and the setpoint of a loop, all in one transaction on the bus. Returns
+        an array in the order of self.inputs followed by the heater output and the setpoint"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        units = units.upper()
+        if units not in ['K', 'C']:
+            raise IOError(f"Invalid units: {units}")
+        messages = self.temperature_messages(self.inputs, units) + ['HTR?', f"SETP? {loop}"]
+        replies = self.query_many(messages)
+        temperatures = self.temperatures_from_replies(replies[:-2], self.inputs)
+        return np.array(temperatures + [float(replies[-2]), float(replies[-1])])
+
+    def temperature_messages(self, channels: list, units: str) -> list:
+        if self.reads_all_inputs:
+            return [f"{units}RDG? 0"]
+        return [f"{units}RDG? {channel}" for channel in channels]
+
+    def temperatures_from_replies(self, replies: list, channels: list) -> list:
+        if self.reads_all_inputs:
+            # one comma separated reply with every input in order
+            readings = [float(reading) for reading in replies[0].split(',')]
+            return [readings[self.inputs.index(channel)] for channel in channels]
+        return [float(reply) for reply in replies]
+
+    def query_many(self, messages: list) -> list:
+        """Send several queries for numbers joined with ";" and return the replies as a list. A compound query that
+        times out is tried once more, and then the queries are sent one at a time. If the instrument doesn't answer it
+        properly (the wrong number of replies, or an error message from the server), it doesn't understand compound
+        queries, so they are sent one at a time from then on. The same happens if it keeps timing out"""
+        if self.compound_queries and len(messages) > 1:
+            for attempt in range(2):
+                try:
+                    reply = self.query(';'.join(messages)).strip()
+                except protocol.ServerError as e:
+                    # framed connections raise the server's error instead of giving it back as text
+                    reply = str(e)
+                if reply != "timed out":
+                    break
+            replies = reply.split(';')
+            if reply == "timed out":
+                self.compound_timeouts += 1
+                if self.compound_timeouts >= 3:
+                    self.compound_queries = False
+                return [self.query(message) for message in messages]
+            if len(replies) == len(messages):
+                try:
+                    [float(value) for reply in replies for value in reply.split(',')]
+                    self.compound_timeouts = 0
+                    return replies
+                except ValueError:
+                    pass
+            self.compound_queries = False
+        return [self.query(message) for message in messages]
+
+    def set_heater_range(self, power_range: float, override: bool = False):
+        """Sets the heater range"""
+        # ensure that the power_range is positive
+        power_range = abs(float(power_range))
+
+        # find the nearest valid setting to the power given
+        setting = np.argmin(np.abs(np.array(self.heater_ranges) - power_range))
+        if self.heater_ranges[setting] == 50. and not override:
+            print("50V is probably too high and will fry your solder joints. If you disagree, override==True")
+        else:
+            self.state.set('range', int(setting))
+
+    def set_pid(self, p='', i='', d='', loop=1):
+        """Any of p, i, d left out keep the value they have now"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        # only need to know the old values if some are being kept
+        current = self.pid[loop] if '' in (p, i, d) else None
+        self.pid[loop] = tuple(current[ii] if value == '' else float(value) for ii, value in enumerate((p, i, d)))
+
+    def set_ramp_speed(self, kelvin_per_min, loop=1):
+        """Set the ramp speed to reach set point in Kelvin per min"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        self.ramp[loop] = (1, float(kelvin_per_min))
+
+    def set_setpoint(self, value, loop=1):
+        """Configure Control loop setpoint.
+        loop: specifies which loop to configure.
+        value: the value for the setpoint (in whatever units the setpoint is using"""
+        if loop != 1 and loop != 2:
+            raise IOError(f"invalid loop: {loop}")
+        self.setpoint[loop] = float(value)
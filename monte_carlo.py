@@ -0,0 +1,346 @@
+"""
+Example code created for the Quantum Forge course
+This code finds out how much the capacitance of a design varies when the things that set it (the gap from the etch,
+the thickness and dielectric constant of the substrate, ...) vary from device to device, by trying lots of random
+devices (a "Monte Carlo" simulation).
+
+The samples are made and evaluated in batches, and only running statistics of them are kept (mean, variance, a
+histogram, and a sketch that gives any quantile), so 10^8 samples don't need 10^8 numbers in memory. Batches can be
+spread across worker processes, and each batch gets its own random seed split off from the one given, so the result
+is the same no matter how many processes there are.
+```
+import monte_carlo as mc
+result = mc.monte_carlo(10**8, g=mc.Normal(2, 0.1), u=20, N=50, L=1000, hS=mc.Uniform(490, 510), epsS=3.9,
+                        spec=(5.5, 6.5), processes=8)
+print(result.mean, result.std, result.quantile(0.99), result.yield_fraction)
+```
+
+@author: Teddy Tortorici
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import calculations
+
+
+class Normal:
+    """Normally distributed with a mean and a standard deviation"""
+    def __init__(self, mean: float, std: float):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        return rng.normal(self.mean, self.std, size)
+
+    def __repr__(self):
+        return f"Normal({self.mean}, {self.std})"
+
+
+class Uniform:
+    """Equally likely to be anything between low and high"""
+    def __init__(self, low: float, high: float):
+        self.low = low
+        self.high = high
+
+    def __call__(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        return rng.uniform(self.low, self.high, size)
+
+    def __repr__(self):
+        return f"Uniform({self.low}, {self.high})"
+
+
+class LogNormal:
+    """Always positive, with a median and a relative spread (sigma of the log of the value)"""
+    def __init__(self, median: float, sigma: float):
+        self.median = median
+        self.sigma = sigma
+
+    def __call__(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        return rng.lognormal(np.log(self.median), self.sigma, size)
+
+    def __repr__(self):
+        return f"LogNormal({self.median}, {self.sigma})"
+
+
+class RunningStats:
+    """Count, mean, variance, min and max of all the values added so far, without keeping the values. Batches are
+    combined with Chan's parallel version of Welford's method, which doesn't lose precision the way adding up
+    x and x**2 does"""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.            # sum of squared differences from the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values: np.ndarray):
+        if len(values):
+            other = RunningStats()
+            other.count = len(values)
+            other.mean = float(np.mean(values))
+            other.m2 = float(np.sum((values - other.mean) ** 2))
+            other.min = float(np.min(values))
+            other.max = float(np.max(values))
+            self.merge(other)
+
+    def merge(self, other: "RunningStats"):
+        count = self.count + other.count
+        if not other.count:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> float:
+        """Sample variance"""
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+
+class Histogram:
+    """Counts of the values in each bin between edges, plus how many were below and above all of them"""
+    def __init__(self, edges: np.ndarray):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self, values: np.ndarray):
+        self.counts += np.histogram(values, self.edges)[0]
+        self.underflow += int(np.count_nonzero(values < self.edges[0]))
+        self.overflow += int(np.count_nonzero(values > self.edges[-1]))
+
+    def merge(self, other: "Histogram"):
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+    @property
+    def centers(self) -> np.ndarray:
+        return (self.edges[1:] + self.edges[:-1]) / 2
+
+
+class QuantileSketch:
+    """
+    Gives any quantile of the values added to it to within a relative accuracy, using a fixed amount of memory
+    (a "DDSketch"). Each value is counted in a bucket whose edges go up by a factor of gamma, so a quantile read from
+    the middle of its bucket is never off by more than relative_accuracy times the true value. Values at or near zero
+    are counted separately, and negative values get a set of buckets of their own
+    """
+    def __init__(self, relative_accuracy: float = 1e-3, smallest: float = 1e-12):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.smallest = smallest
+        self.positive = {}          # bucket index: count
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=float)
+        self.count += len(values)
+        self.zeros += int(np.count_nonzero(np.abs(values) < self.smallest))
+        for buckets, side in ((self.positive, values[values >= self.smallest]),
+                              (self.negative, -values[values <= -self.smallest])):
+            indices, counts = np.unique(np.ceil(np.log(side) / self.log_gamma).astype(np.int64), return_counts=True)
+            for index, count in zip(indices.tolist(), counts.tolist()):
+                buckets[index] = buckets.get(index, 0) + count
+
+    def merge(self, other: "QuantileSketch"):
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """The value that a fraction q of the values are below"""
+        if not self.count:
+            return np.nan
+        rank = q * (self.count - 1)
+        # go from the most negative value to the most positive
+        values = [-self.bucket_value(index) for index in sorted(self.negative, reverse=True)] + [0.] + \
+                 [self.bucket_value(index) for index in sorted(self.positive)]
+        counts = [self.negative[index] for index in sorted(self.negative, reverse=True)] + [self.zeros] + \
+                 [self.positive[index] for index in sorted(self.positive)]
+        position = int(np.searchsorted(np.cumsum(counts), rank, side='right'))
+        return values[min(position, len(values) - 1)]
+
+    def bucket_value(self, index: int) -> float:
+        """The value in the middle of a bucket (in the sense of relative error)"""
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class MonteCarloResult:
+    """
+    Everything monte_carlo keeps track of
+    stats - RunningStats of the valid results (the properties mean, std, ... come from here)
+    histogram - Histogram of the valid results
+    sketch - QuantileSketch of the valid results (used by quantile)
+    invalid - how many results were nan or infinite (like devices with a gap bigger than their unit cell)
+    spec - (low, high) limits that a device has to be within to pass, or None
+    passed - how many devices were within spec
+    """
+    def __init__(self, edges: np.ndarray, spec: tuple = None, relative_accuracy: float = 1e-3):
+        self.stats = RunningStats()
+        self.histogram = Histogram(edges)
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.invalid = 0
+        self.spec = spec
+        self.passed = 0
+
+    def add(self, values: np.ndarray):
+        valid = np.isfinite(values)
+        self.invalid += int(len(values) - np.count_nonzero(valid))
+        values = values[valid]
+        self.stats.add(values)
+        self.histogram.add(values)
+        self.sketch.add(values)
+        if self.spec is not None:
+            self.passed += int(np.count_nonzero((values >= self.spec[0]) & (values <= self.spec[1])))
+
+    def merge(self, other: "MonteCarloResult"):
+        self.stats.merge(other.stats)
+        self.histogram.merge(other.histogram)
+        self.sketch.merge(other.sketch)
+        self.invalid += other.invalid
+        self.passed += other.passed
+
+    @property
+    def samples(self) -> int:
+        return self.stats.count + self.invalid
+
+    @property
+    def mean(self) -> float:
+        return self.stats.mean
+
+    @property
+    def variance(self) -> float:
+        return self.stats.variance
+
+    @property
+    def std(self) -> float:
+        return np.sqrt(self.stats.variance)
+
+    @property
+    def min(self) -> float:
+        return self.stats.min
+
+    @property
+    def max(self) -> float:
+        return self.stats.max
+
+    def quantile(self, q: float) -> float:
+        """Accurate to the sketch's relative_accuracy (0.1% by default)"""
+        return self.sketch.quantile(q)
+
+    @property
+    def yield_fraction(self) -> float:
+        """The fraction of all devices (invalid ones count as failed) that were within spec"""
+        return self.passed / self.samples if self.spec is not None and self.samples else np.nan
+
+    @property
+    def yield_error(self) -> float:
+        """The standard error of yield_fraction from only having a finite number of samples"""
+        p = self.yield_fraction
+        return np.sqrt(p * (1 - p) / self.samples) if self.samples else np.nan
+
+    def __repr__(self):
+        text = f"MonteCarloResult(samples={self.samples}, mean={self.mean:.6g}, std={self.std:.6g}"
+        if self.spec is not None:
+            text += f", yield={self.yield_fraction:.6g} +/- {self.yield_error:.2g}"
+        return text + ")"
+
+
+def sample_batch(function, parameters: dict, seed: np.random.SeedSequence, size: int) -> np.ndarray:
+    """Evaluate function on size random devices. Parameters that are distributions are sampled (in the order they
+    were given, from one generator seeded by seed) and the rest are passed as they are"""
+    rng = np.random.default_rng(seed)
+    values = {name: value(rng, size) if callable(value) else value for name, value in parameters.items()}
+    return np.asarray(function(**values), dtype=float)
+
+
+_monte_carlo_job = {}       # what each worker process is running, set once by _start_monte_carlo_worker
+
+
+def _start_monte_carlo_worker(function, parameters, edges, spec, relative_accuracy):
+    _monte_carlo_job.update(function=function, parameters=parameters, edges=edges, spec=spec,
+                            relative_accuracy=relative_accuracy)
+
+
+def _monte_carlo_batch(number: int, seed: np.random.SeedSequence, size: int) -> tuple:
+    job = _monte_carlo_job
+    result = MonteCarloResult(job['edges'], job['spec'], job['relative_accuracy'])
+    result.add(sample_batch(job['function'], job['parameters'], seed, size))
+    return number, result
+
+
+def monte_carlo(samples: int, function=calculations.capacitance, batch_size: int = 1_000_000, processes: int = 1,
+                seed: int = None, bins: int = 200, hist_range: tuple = None, spec: tuple = None,
+                relative_accuracy: float = 1e-3, **parameters) -> MonteCarloResult:
+    """
+    Evaluates function (capacitance by default) on samples random devices, and gives back their statistics as a
+    MonteCarloResult. Parameters are given as numbers (the same for every device) or distributions like
+    Normal(2, 0.1) (anything that can be called with a numpy Generator and a size and gives back that many samples).
+    batch_size - how many devices are evaluated at a time. Memory use goes up with this, not with samples
+    processes - how many worker processes to spread the batches across (None for all the CPUs). With more than 1,
+                function and the distributions have to be defined at the top level of a module, and on Windows the
+                script calling this needs an if __name__ == "__main__": block
+    seed - makes the result reproducible. Each batch gets its own seed split off from it, so the result only depends
+           on seed, samples and batch_size (not on processes)
+    bins, hist_range - the histogram has bins bins between hist_range = (low, high). If hist_range is None, it goes a
+                       little beyond the lowest and highest values of the first batch
+    spec - (low, high) limits a device has to be within to pass, for result.yield_fraction
+    relative_accuracy - of result.quantile
+    """
+    if samples < 1:
+        raise ValueError(f"samples has to be at least 1, not {samples}")
+    if batch_size < 1:
+        raise ValueError(f"batch_size has to be at least 1, not {batch_size}")
+    sizes = [batch_size] * (samples // batch_size) + ([samples % batch_size] if samples % batch_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    # the first batch is done here, to find the range of the histogram before the workers need it
+    first = sample_batch(function, parameters, seeds[0], sizes[0])
+    if hist_range is None:
+        finite = first[np.isfinite(first)]
+        low, high = (np.min(finite), np.max(finite)) if len(finite) else (0., 1.)
+        margin = (high - low) * 0.1 or abs(high) * 0.1 or 1.
+        hist_range = (low - margin, high + margin)
+    edges = np.linspace(hist_range[0], hist_range[1], bins + 1)
+    result = MonteCarloResult(edges, spec, relative_accuracy)
+    result.add(first)
+    del first
+
+    processes = os.cpu_count() if processes is None else processes
+    if processes <= 1 or len(sizes) <= 2:
+        for seed_sequence, size in zip(seeds[1:], sizes[1:]):
+            result.add(sample_batch(function, parameters, seed_sequence, size))
+        return result
+
+    with ProcessPoolExecutor(processes, initializer=_start_monte_carlo_worker,
+                             initargs=(function, parameters, edges, spec, relative_accuracy)) as pool:
+        # batches are merged in order (so rounding doesn't depend on which process finished first), and only a couple
+        # per process are handed out at a time
+        finished = {}
+        merged = [1]
+
+        def merge_finished(futures):
+            finished.update(future.result() for future in futures)
+            while merged[0] in finished:
+                result.merge(finished.pop(merged[0]))
+                merged[0] += 1
+
+        waiting = set()
+        for number in range(1, len(sizes)):
+            if len(waiting) >= 2 * processes:
+                done, waiting = wait(waiting, return_when=FIRST_COMPLETED)
+                merge_finished(done)
+            waiting.add(pool.submit(_monte_carlo_batch, number, seeds[number], sizes[number]))
+        merge_finished(waiting)
+    return result
@@ -2,12 +2,16 @@ import csv
 import numpy as np
 import pyqtgraph as pg
 import PyQt5.QtWidgets as qtw
-from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtCore import pyqtSlot, QTimer
 from PyQt5.QtGui import QIcon
 import os
 import sys
 import get
+import binary_data
 import Plotting_Scripts.DateAxisItem as DateAxisItem
+import Plotting_Scripts.data_source as data_source
+import Plotting_Scripts.decimate as decimate
+import Plotting_Scripts.lod as lod
 
 
 class PlotApp(qtw.QMainWindow):
@@ -28,13 +32,23 @@ class PlotApp(qtw.QMainWindow):
                (228, 104, 232),     # magenta
                (255, 152, 51)]      # orange
 
-    def __init__(self):
+    def __init__(self, refresh_interval=500):
+        """refresh_interval is how often (in milliseconds) the plot checks the file for new data while plotting live"""
         super(PlotApp, self).__init__()
         for key in PlotApp.window_colors.keys():
             pg.setConfigOption(key, PlotApp.window_colors[key])
 
         self.base_path = get.google_drive()
         self.filename = None            # will be fill later
+        self.source = None              # reads the new rows from the file each time the plot updates
+        self.pyramid = None             # zoomed-out copies of the data, for browsing a run that isn't being written
+        self.refresh_interval = refresh_interval
+        self.updating = False           # True while updatePlots is running
+        self.drawing = False            # True while draw is running
+
+        # while plotting live, this calls updatePlots every refresh_interval milliseconds
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.updatePlots)
 
         self.force_quit = True          # will turn false if quit properly
 
@@ -53,6 +67,8 @@ class PlotApp(qtw.QMainWindow):
 
         self.plot = pg.PlotWidget()
         self.setCentralWidget(self.plot)
+        # zooming or panning changes how many points fit in a pixel, so the curves get cut down again
+        self.plot.getViewBox().sigXRangeChanged.connect(self.draw)
 
         self.labels = [None]
 
@@ -91,7 +107,12 @@ class PlotApp(qtw.QMainWindow):
         self.pause_button.triggered.connect(self.pause_live)
         self.pause_button.setEnabled(False)
 
+        interval_button = qtw.QAction('Set Refresh Interval', self)
+        interval_button.triggered.connect(self.ask_refresh_interval)
+
         plotMenu.addActions([self.play_button, self.pause_button])
+        plotMenu.addSeparator()
+        plotMenu.addActions([interval_button])
 
         # Show the App
         self.show()
@@ -100,11 +121,35 @@ class PlotApp(qtw.QMainWindow):
     def plot_live(self):
         self.play_button.setEnabled(False)
         self.pause_button.setEnabled(True)
+        # draw stops using the pyramid as soon as rows are added, but it is kept in case the file doesn't change
+        self.timer.start(self.refresh_interval)
 
     @pyqtSlot()
     def pause_live(self):
+        self.timer.stop()
         self.play_button.setEnabled(True)
         self.pause_button.setEnabled(False)
+        self.updatePlots()
+        if self.pyramid is None or self.pyramid.stamp != lod.file_stamp(self.filename):
+            self.set_pyramid(lod.open_pyramid(self.filename, self.source))
+
+    def set_pyramid(self, pyramid):
+        """Closes the file of the pyramid being replaced"""
+        if self.pyramid is not None and self.pyramid is not pyramid:
+            self.pyramid.close()
+        self.pyramid = pyramid
+
+    @pyqtSlot()
+    def ask_refresh_interval(self):
+        interval, ok = qtw.QInputDialog.getInt(self, 'Refresh Interval', 'Milliseconds between updates:',
+                                               self.refresh_interval, 10, 60000)
+        if ok:
+            self.set_refresh_interval(interval)
+
+    def set_refresh_interval(self, interval):
+        self.refresh_interval = int(interval)
+        if self.timer.isActive():
+            self.timer.start(self.refresh_interval)
 
     @pyqtSlot()
     def open_data(self):
@@ -113,11 +158,15 @@ class PlotApp(qtw.QMainWindow):
         options = qtw.QFileDialog.Options()
         options |= qtw.QFileDialog.DontUseNativeDialog
         filename, _ = qtw.QFileDialog.getOpenFileName(self, "Select Data Set", self.base_path,
-                                                      "CSV (*.csv);;All Files (*)", options=options)
+                                                      "CSV (*.csv);;Binary (*.bin *.json);;All Files (*)",
+                                                      options=options)
         self.filename = filename
+        self.source = data_source.open_source(filename)
+        self.source.read_new()
+        self.set_pyramid(lod.open_pyramid(filename, self.source))
 
         # Find the column labels in the file and use them to label the axes
-        self.labels = self.get_labels(filename)
+        self.labels = self.source.labels or self.get_labels(filename)
         self.plot.setLabel('left', self.labels[1])
         self.plot.setLabel('bottom', self.labels[0])
         # If there are multiple Y columns, set up a legend
@@ -137,18 +186,51 @@ class PlotApp(qtw.QMainWindow):
         for ii, label in enumerate(self.labels[1:]):
             self.curves[ii] = self.plot.plot(pen=self.pens[ii], name=label)
 
-        self.updatePlots()
+        self.draw()
 
     @pyqtSlot()
     def updatePlots(self):
-        data = self.load_data(self.filename)
-        if len(data.shape) > 1:
-            x = data[:, 0]
+        # if the last update hasn't finished, skip this one instead of letting them pile up
+        if self.updating or self.source is None:
+            return
+        self.updating = True
+        try:
+            # only the lines added since the last update get read, instead of the whole file every time
+            if self.source.read_new():
+                self.draw()
+        finally:
+            self.updating = False
+
+    def draw(self):
+        """Hands the curves only the points that are in view, cut down to about 2 per pixel. When zoomed out on a run
+        that isn't being written, these come from the pyramid so only a small part of the data gets read"""
+        if self.drawing or self.source is None or not len(self.source):
+            return
+        self.drawing = True
+        try:
+            x = self.source.column(0)
+            view = self.plot.getViewBox()
+            if view.autoRangeEnabled()[0]:
+                x_min, x_max = x[0], x[-1]
+            else:
+                x_min, x_max = view.viewRange()[0]
+            width = max(int(view.width()), 100)
+            start, stop = decimate.visible_range(x, x_min, x_max)
+            pyramid = self.pyramid if self.pyramid is not None and self.pyramid.rows == len(self.source) else None
             for ii, curve in enumerate(self.curves):
-                curve.setData(x=x, y=data[:, ii + 1])
+                points = None
+                if pyramid is not None:
+                    points = pyramid.query(ii, x_min, x_max, stop - start, width)
+                if points is None:
+                    points = decimate.peak_decimate(x, self.source.column(ii + 1), x_min, x_max, width)
+                curve.setData(*points)
+        finally:
+            self.drawing = False
 
     @staticmethod
     def load_data(filename, attempts=20):
+        if binary_data.is_binary(filename):
+            return np.asarray(binary_data.load(filename).data)
         data = None
         for ii in range(attempts):    # as long as the "try" passes, the loop breaks
             try:
@@ -161,6 +243,8 @@ class PlotApp(qtw.QMainWindow):
     @staticmethod
     def get_labels(filename, line_skip=8):
         """Locates the first row in the file which isn't commented out. Expected to be the labels"""
+        if binary_data.is_binary(filename):
+            return binary_data.load(filename).columns
         with open(filename, 'r') as f:
             reader = csv.reader(f, delimiter=',')
             for ii, row in enumerate(reader):
@@ -175,6 +259,7 @@ class PlotApp(qtw.QMainWindow):
         if exit_q == qtw.QMessageBox.Yes:
             self.force_quit = False
             print('Exiting')
+            self.set_pyramid(None)
             self.close()
 
     def closeEvent(self, event):
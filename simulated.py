@@ -0,0 +1,230 @@
+"""
+Example code created for the Quantum Forge course
+This code pretends to be an instrument, so the rest of the code can be run (and timed) on a computer with no GPIB
+interface or instruments attached.
+
+The objects here have the same read, write, query, and query_ascii_values methods as the resource that
+pyvisa.ResourceManager().open_resource gives you, so a gpib.Device can use one in place of a real instrument:
+```
+import gpib
+import simulated
+
+dev = gpib.Device(addr=12, backend=simulated.SimulatedLakeShore(model=331))
+dev = gpib.Device(addr=12, backend="sim")     # same thing with the default settings
+```
+Every message takes about as long to answer as it would over a real GPIB bus (set by latency and jitter).
+
+@author: Teddy Tortorici
+"""
+
+import random
+import threading
+import time
+import numpy as np
+import pyvisa
+
+
+class SimulatedResource:
+    """Base class for simulated instruments. Children fill in respond(message), which gives back the reply to a query
+    (or None for a message that doesn't have a reply)
+    latency - average time in seconds a message takes over the bus. Can be a dict of {command: seconds} with a
+              "default" entry to give some commands different timings
+    jitter - standard deviation of the latency in seconds"""
+    idn = "SIMULATED,INSTRUMENT,0,1.0"
+
+    def __init__(self, latency=0.02, jitter=0.003):
+        if not isinstance(latency, dict):
+            latency = {"default": latency}
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.output_queue = []      # replies waiting to be read after a query was sent with write
+
+    def wait(self, message: str):
+        """Sleep for as long as the message would take over a real bus"""
+        command = message.replace(',', ' ').split(' ')[0].strip().upper()
+        mean = self.latency.get(command, self.latency["default"])
+        time.sleep(max(0., random.gauss(mean, self.jitter)))
+
+    @staticmethod
+    def timeout():
+        return pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+
+    def handle(self, message: str):
+        """Run every command in a message. Commands can be joined with ";" and the replies are joined the same way"""
+        with self.lock:
+            replies = [self.respond(command.strip()) for command in message.split(';') if command.strip()]
+        replies = [reply for reply in replies if reply is not None]
+        if replies:
+            return ';'.join(replies)
+        return None
+
+    def respond(self, command: str):
+        if command.upper() == "*IDN?":
+            return self.idn
+        return None
+
+    def query(self, message: str) -> str:
+        self.wait(message)
+        reply = self.handle(message)
+        if reply is None:
+            raise self.timeout()
+        return reply + "\r\n"
+
+    def write(self, message: str):
+        self.wait(message)
+        reply = self.handle(message)
+        if reply is not None:
+            self.output_queue.append(reply + "\r\n")
+
+    def read(self) -> str:
+        self.wait("read")
+        if not self.output_queue:
+            raise self.timeout()
+        return self.output_queue.pop(0)
+
+    def query_ascii_values(self, message, container=list, separator=',', converter='f'):
+        reply = self.query(message)
+        return container([float(value) for value in reply.replace(';', separator).split(separator)])
+
+    def close(self):
+        pass
+
+
+class SimulatedLakeShore(SimulatedResource):
+    """Answers the commands for a LakeShore 331 or 340 temperature controller used in this repo (KRDG?, CRDG?, SETP,
+    RANGE, PID, RAMP, RAMPST?, HTR?) from a simple thermal model. As a 336 or 350 it also answers "KRDG? 0" with every
+    input at once:
+
+        C dT/dt = P_heater - G (T - T_bath)
+
+    Input A reads the stage temperature, and input B reads a sample that follows the stage with a time lag. Loop 1 runs
+    a PID loop that drives the heater to bring input A to the setpoint, and the setpoint can ramp like the real thing.
+    Time in the model runs with the real clock.
+    heat_capacity - C in J/K
+    conductance - G to the cold bath in W/K
+    bath_temperature - in K
+    lag - time constant of input B following input A in seconds
+    noise - standard deviation of the readings in K"""
+    def __init__(self, model: int = 331, latency=0.025, jitter=0.004, heat_capacity: float = 2.,
+                 conductance: float = 0.015, bath_temperature: float = 20., lag: float = 30., noise: float = 0.002,
+                 start_temperature: float = None):
+        super(SimulatedLakeShore, self).__init__(latency, jitter)
+        self.model = int(model)
+        self.idn = f"LSCI,MODEL{self.model},SIMULATED,1.0"
+        self.inputs = ['A', 'B', 'C', 'D'] if self.model in (340, 336, 350) else ['A', 'B']
+        if self.model == 340:
+            self.heater_ranges = [0.0, 0.05, 0.5, 5.0, 50.0]
+        else:
+            self.heater_ranges = [0.0, 0.5, 5.0, 50.0]
+        self.heat_capacity = heat_capacity
+        self.conductance = conductance
+        self.bath_temperature = bath_temperature
+        self.lag = lag
+        self.noise = noise
+        self.start_temperature = bath_temperature if start_temperature is None else start_temperature
+        self.reset()
+
+    def reset(self):
+        self.temperature = {'A': self.start_temperature, 'B': self.start_temperature}
+        self.setpoint = [0, self.start_temperature, self.start_temperature]     # loops 1 and 2 (0 is a dummy)
+        self.target = list(self.setpoint)           # where a ramping setpoint is headed
+        self.pid = [0, [50., 20., 0.], [50., 20., 0.]]
+        self.ramp = [0, [0, 10.], [0, 10.]]         # [on/off, Kelvin per minute]
+        self.range = 0
+        self.heater = 0.                            # percent of the heater range
+        self.integral = 0.
+        self.last_error = 0.
+        self.last_update = time.monotonic()
+
+    def step(self, dt: float):
+        """Move the model forward by dt seconds"""
+        for loop in (1, 2):
+            if self.ramp[loop][0] and self.setpoint[loop] != self.target[loop]:
+                change = self.ramp[loop][1] / 60. * dt
+                difference = self.target[loop] - self.setpoint[loop]
+                self.setpoint[loop] = self.target[loop] if abs(difference) <= change \
+                    else self.setpoint[loop] + np.sign(difference) * change
+
+        # PID loop 1 drives the heater with input A. I is in repeats per minute and D in minutes, like the real thing
+        p, i, d = self.pid[1]
+        error = self.setpoint[1] - self.temperature['A']
+        self.integral = float(np.clip(self.integral + error * dt, -1e4, 1e4))
+        derivative = (error - self.last_error) / dt
+        self.last_error = error
+        max_power = self.heater_ranges[self.range]
+        if max_power > 0:
+            output = p * (error + i / 60. * self.integral + d * 60. * derivative)
+            self.heater = float(np.clip(output, 0., 100.))
+        else:
+            self.heater = 0.
+            self.integral = 0.
+
+        power = max_power * self.heater / 100.
+        flow = power - self.conductance * (self.temperature['A'] - self.bath_temperature)
+        self.temperature['A'] += flow / self.heat_capacity * dt
+        self.temperature['B'] += (self.temperature['A'] - self.temperature['B']) * dt / self.lag
+
+    def update(self):
+        """Catch the model up to the current time in small steps"""
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        if elapsed <= 0:
+            # the clock hasn't ticked since the last update (it only ticks every ~16 ms on some Windows machines)
+            return
+        self.last_update = now
+        steps = int(min(max(np.ceil(elapsed / 0.05), 1), 20000))
+        for _ in range(steps):
+            self.step(elapsed / steps)
+
+    def reading(self, channel: str) -> float:
+        # inputs C and D just read the sample (input B)
+        temperature = self.temperature.get(channel, self.temperature['B'])
+        return temperature + random.gauss(0., self.noise)
+
+    def respond(self, command: str):
+        self.update()
+        words = command.upper().replace(',', ' ').split()
+        if not words:
+            return None
+        name, args = words[0], words[1:]
+        loop = int(args[0]) if args and args[0].isdigit() else 1
+
+        if name == "*IDN?":
+            return self.idn
+        elif name == "*RST":
+            self.reset()
+        elif name in ("KRDG?", "CRDG?"):
+            channel = args[0] if args else 'A'
+            offset = 273.15 if name == "CRDG?" else 0.
+            if channel == '0' and self.model in (336, 350):
+                # every input at once
+                return ','.join(f"{self.reading(channel) - offset:+.4f}" for channel in self.inputs)
+            if channel not in self.inputs:
+                return None
+            return f"{self.reading(channel) - offset:+.4f}"
+        elif name == "SETP?":
+            return f"{self.setpoint[loop]:+.4f}"
+        elif name == "SETP":
+            self.target[loop] = float(args[1])
+            if not self.ramp[loop][0]:
+                self.setpoint[loop] = self.target[loop]
+        elif name == "RANGE?":
+            return str(self.range)
+        elif name == "RANGE":
+            self.range = int(min(int(args[0]), len(self.heater_ranges) - 1))
+        elif name == "PID?":
+            return ','.join(f"{value:+.1f}" for value in self.pid[loop])
+        elif name == "PID":
+            self.pid[loop] = [float(value) for value in args[1:4]]
+        elif name == "RAMP?":
+            return f"{self.ramp[loop][0]},{self.ramp[loop][1]:+.1f}"
+        elif name == "RAMP":
+            self.ramp[loop] = [int(args[1]), float(args[2])]
+        elif name == "RAMPST?":
+            return str(int(bool(self.ramp[loop][0]) and self.setpoint[loop] != self.target[loop]))
+        elif name == "HTR?":
+            return f"{self.heater:+.1f}"
+        else:
+            return super(SimulatedLakeShore, self).respond(command)
+        return None
@@ -0,0 +1,50 @@
+"""The scripts live at the top of the repository rather than in a package, so make them importable from the tests"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+import socket
+import threading
+import time
+import pytest
+import gpib
+import simulated
+import gpib_comm_server as server
+import gpib_client_tools as client
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(port: int):
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.02)
+
+
+@pytest.fixture(scope="module")
+def sim_server():
+    """A ConcurrentServer on a free port with a simulated LakeShore 340 called LS, polling its channel A as TEMP_A.
+    Gives back the port"""
+    server.setup_logging("WARNING")
+    server.Interpreter.devices.add("LS", gpib.Device(8, backend=simulated.SimulatedLakeShore(model=340)))
+    server.Interpreter.cache.clear()
+    port = free_port()
+    concurrent = server.ConcurrentServer(port=port, poll_channels={"TEMP_A": "LS::Q::KRDG? A"}, poll_rate=20)
+    thread = threading.Thread(target=concurrent.serve_forever, daemon=True)
+    thread.start()
+    wait_for_server(port)
+    yield port
+    client.close_connections()
+    concurrent.shutdown()
+    thread.join(5)
+    server.Interpreter.devices.remove("LS")
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import binary_data
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / "run.bin")
+    with binary_data.BinaryDataWriter(filename, ["Time (s)", "Stage A (K)"], comments=["first"]) as f:
+        f.append([0.0, 300.1])
+        f.append_rows(np.array([[1.0, 300.0], [2.0, 299.9]]))
+        f.add_comment("second")
+    data = binary_data.load(filename)
+    assert len(data) == 3
+    assert data.columns == ["Time (s)", "Stage A (K)"]
+    assert data.comments == ["first", "second"]
+    assert np.array_equal(data.column("Stage A (K)"), [300.1, 300.0, 299.9])
+    assert np.array_equal(data.column(0), data.data[:, 0])
+    # the header opens it too
+    assert len(binary_data.load(binary_data.header_name(filename))) == 3
+
+
+def test_appending_to_an_existing_file(tmp_path):
+    filename = str(tmp_path / "run.bin")
+    with binary_data.BinaryDataWriter(filename, ["t", "y"], comments=["one"]) as f:
+        f.append([0., 1.])
+    with binary_data.BinaryDataWriter(filename, ["t", "y"], comments=["two"]) as f:
+        f.append([1., 2.])
+    data = binary_data.load(filename)
+    assert np.array_equal(data.data, [[0., 1.], [1., 2.]])
+    assert data.comments == ["one", "two"]
+    with pytest.raises(ValueError):
+        binary_data.BinaryDataWriter(filename, ["t", "z"])
+
+
+def test_wrong_number_of_columns(tmp_path):
+    with binary_data.BinaryDataWriter(str(tmp_path / "run.bin"), ["t", "y"]) as f:
+        with pytest.raises(ValueError):
+            f.append([0., 1., 2.])
+
+
+def test_partly_written_row_is_left_off(tmp_path):
+    filename = str(tmp_path / "run.bin")
+    with binary_data.BinaryDataWriter(filename, ["t", "y"]) as f:
+        f.append([0., 1.])
+        f.file.write(np.array([1.], dtype=binary_data.DTYPE).tobytes())
+    assert len(binary_data.load(filename)) == 1
+
+
+def test_empty_file(tmp_path):
+    filename = str(tmp_path / "run.bin")
+    binary_data.BinaryDataWriter(filename, ["t", "y"]).close()
+    assert binary_data.load(filename).data.shape == (0, 2)
+
+
+def test_time_slice(tmp_path):
+    filename = str(tmp_path / "run.bin")
+    with binary_data.BinaryDataWriter(filename, ["t", "y"]) as f:
+        f.append_rows(np.stack([np.arange(100.), np.arange(100.) ** 2], axis=1))
+    rows = binary_data.load(filename).time_slice(10., 20.)
+    assert np.array_equal(rows[:, 0], np.arange(10., 20.))
+
+
+def test_is_binary():
+    assert binary_data.is_binary("run.bin") and binary_data.is_binary("run.JSON")
+    assert not binary_data.is_binary("run.csv")
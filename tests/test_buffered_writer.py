@@ -0,0 +1,60 @@
+import time
+import pytest
+import data_taker
+
+
+def test_lines_wait_for_flush_rows(tmp_path):
+    filename = tmp_path / "run.csv"
+    writer = data_taker.BufferedWriter(str(filename), flush_rows=3, flush_interval=60.)
+    try:
+        writer.write("1,2\n")
+        writer.write("3,4\n")
+        time.sleep(0.1)
+        assert filename.read_text() == ""
+        writer.write("5,6\n")
+        for _ in range(100):
+            if filename.read_text():
+                break
+            time.sleep(0.01)
+        assert filename.read_text() == "1,2\n3,4\n5,6\n"
+    finally:
+        writer.close()
+
+
+def test_lines_are_written_after_flush_interval(tmp_path):
+    filename = tmp_path / "run.csv"
+    writer = data_taker.BufferedWriter(str(filename), flush_rows=100, flush_interval=0.05)
+    try:
+        writer.write("1,2\n")
+        for _ in range(100):
+            if filename.read_text():
+                break
+            time.sleep(0.01)
+        assert filename.read_text() == "1,2\n"
+    finally:
+        writer.close()
+
+
+def test_close_writes_everything(tmp_path):
+    filename = tmp_path / "run.csv"
+    writer = data_taker.BufferedWriter(str(filename), flush_rows=1000, flush_interval=60.)
+    lines = [f"{ii},{ii * 2}\n" for ii in range(500)]
+    for line in lines:
+        writer.write(line)
+    writer.close()
+    writer.close()
+    assert filename.read_text() == "".join(lines)
+    assert not writer.thread.is_alive()
+    with pytest.raises(ValueError):
+        writer.write("too late\n")
+
+
+def test_flush_now(tmp_path):
+    filename = tmp_path / "run.csv"
+    writer = data_taker.BufferedWriter(str(filename), flush_rows=1000, flush_interval=60.)
+    try:
+        writer.write("# comment\n")
+        writer.flush(fsync=True)
+        assert filename.read_text() == "# comment\n"
+    finally:
+        writer.close()
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import calculations as calc
+
+
+def test_k_ell_zero_thickness_is_large_h():
+    large_h = calc.k_ell(2., 20.)
+    assert calc.k_ell(2., 20., 0) == pytest.approx(large_h)
+    assert calc.k_ell(2., 20., np.inf) == pytest.approx(large_h)
+    assert np.allclose(calc.k_ell(2., 20., np.array([0., np.inf])), large_h)
+
+
+def test_k_ell_arrays_match_scalars():
+    g = np.array([1., 2., 5.])
+    h = np.array([50., 500., 5000.])
+    assert np.allclose(calc.k_ell(g, 20., h), [calc.k_ell(gi, 20., hi) for gi, hi in zip(g, h)])
+
+
+def test_gap_from_capacitance_undoes_cap_common():
+    gaps = np.array([0.5, 1., 2., 5., 10.])
+    solution = calc.gap_from_capacitance(calc.cap_common(gaps))
+    assert solution.converged.all()
+    assert np.allclose(solution.value, gaps, rtol=1e-8)
+
+
+def test_solve_for_any_parameter_with_arrays():
+    eps = np.array([[2., 3.9], [7.5, 11.7]])
+    parameters = dict(g=np.array([1., 4.]), u=20, N=50, L=1000, hS=500)
+    target = calc.capacitance(epsS=eps, **parameters)
+    solution = calc.solve_for('epsS', target, low=1., high=20., **parameters)
+    assert solution.value.shape == eps.shape
+    assert solution.converged.all()
+    assert np.allclose(solution.value, eps, rtol=1e-8)
+
+
+def test_solve_for_flags_targets_out_of_range():
+    largest = calc.cap_common(1e-6 * 20)
+    solution = calc.gap_from_capacitance([calc.cap_common(2.), 2 * largest, -1.])
+    assert solution.converged.tolist() == [True, False, False]
+    assert solution.value[0] == pytest.approx(2.)
+
+
+@pytest.fixture(scope="module")
+def table():
+    return calc.EllipticTable()
+
+
+def test_table_error_against_exact_k_ell(table):
+    rng = np.random.default_rng(0)
+    g = rng.uniform(0.05, 19., 20000)
+    h = rng.choice([np.inf, 5., 50., 500.], 20000)
+    k = calc.k_ell(g, 20., h)
+    inside = (k >= table.k_min) & (k <= table.k_max)
+    assert inside.mean() > 0.5
+    exact = calc.elliptic_over_comp(k)
+    # the error is only measured at some points, so allow a little more than rel_tol in between them
+    assert np.max(np.abs(table(k) / exact - 1)) < 2 * table.rel_tol
+    assert np.array_equal(table(k[~inside]), exact[~inside])
+    assert table.max_rel_error <= table.rel_tol
+
+
+def test_fast_capacitance_matches(table, monkeypatch):
+    monkeypatch.setattr(calc, "_elliptic_table", table)
+    g = np.linspace(0.1, 15., 500)
+    assert np.allclose(calc.capacitance(g, 20, 50, 1000, 500, 3.9, fast=True),
+                       calc.capacitance(g, 20, 50, 1000, 500, 3.9), rtol=2e-9, atol=0)
+
+
+def test_table_that_cant_reach_rel_tol(monkeypatch):
+    monkeypatch.setattr(calc.EllipticTable, "max_size", 1024)
+    with pytest.raises(ValueError, match="rel_tol"):
+        calc.EllipticTable(rel_tol=1e-12)
+    with pytest.raises(ValueError, match="rel_tol"):
+        calc.EllipticTable(values=np.ones(514))
+
+
+def test_sweep_grid_matches_capacitance():
+    g = np.linspace(1, 5, 7)
+    u = np.array([10., 20., 40.])
+    result = calc.sweep(g=g, u=u, N=50, L=1000, hS=500, epsS=3.9, chunk_size=5, processes=1)
+    assert result.values.shape == (7, 3)
+    assert np.allclose(result.values, calc.capacitance(g[:, None], u[None, :], 50, 1000, 500, 3.9))
+    assert result.sel(g=5, u=20) == pytest.approx(calc.capacitance(5, 20, 50, 1000, 500, 3.9))
+
+
+def test_sweep_with_nothing_swept():
+    result = calc.sweep(g=2, u=20, N=50, L=1000, hS=500, epsS=3.9, processes=1)
+    assert result.values.shape == ()
+    assert result.sel() == pytest.approx(calc.cap_common(2))
@@ -0,0 +1,67 @@
+import asyncio
+import numpy as np
+import pytest
+import gpib_client_async as aclient
+
+
+def run(coroutine_function, *args):
+    """Run a test coroutine in its own event loop, closing its connections at the end like a script would"""
+    async def main():
+        try:
+            return await coroutine_function(*args)
+        finally:
+            await aclient.close_connections()
+    return asyncio.run(main())
+
+
+def test_requests_run_together(sim_server):
+    async def main():
+        ls = aclient.LakeShore(340, port=sim_server)
+        return await asyncio.gather(ls.read_temperature('A'), ls.read_temperature('d'), ls.read_id(), ls.read_pid(1))
+    temp_a, temp_d, idn, pid = run(main)
+    assert temp_a > 0 and temp_d > 0
+    assert idn.startswith("LSCI,MODEL340")
+    assert isinstance(pid, tuple) and len(pid) == 3
+
+
+def test_channels_and_loops_are_checked(sim_server):
+    async def main():
+        ls = aclient.LakeShore(331, port=sim_server)
+        with pytest.raises(IOError):
+            await ls.read_temperature('C')
+        with pytest.raises(IOError):
+            await ls.read_setpoint(3)
+    run(main)
+
+
+def test_write_gives_back_the_server_reply(sim_server):
+    async def main():
+        ls = aclient.LakeShore(340, port=sim_server)
+        assert await ls.write("SETP 2,25") == "empty"
+        assert await ls.read_setpoint(2) == 25.
+        return await aclient.Device("NOPE", port=sim_server).write("*RST")
+    assert run(main) == "Did not give a valid device id"
+
+
+def test_batch_and_array(sim_server):
+    async def main():
+        ls = aclient.LakeShore(340, port=sim_server)
+        async with ls.batch() as batch:
+            temp = batch.query("KRDG? A")
+            pid = batch.query("PID? 1")
+        return float(temp.result()), pid.result(), await ls.query_array("PID? 1")
+    temp, pid, array = run(main)
+    assert temp > 0
+    assert np.array_equal(array, [float(x) for x in pid.split(',')])
+
+
+def test_connections_from_closed_loops_are_dropped(sim_server):
+    async def main():
+        return await aclient.get_connection(port=sim_server)
+    first = asyncio.run(main())
+    second = asyncio.run(main())
+    assert first is not second
+    assert [key[1:] for key in aclient._connections] == [("localhost", sim_server)]
+    # the entry left is from the second loop, which is closed now too, so the next one replaces it
+    run(main)
+    assert aclient._connections == {}
@@ -0,0 +1,61 @@
+import threading
+import numpy as np
+import pytest
+import gpib_client_tools as client
+
+
+@pytest.mark.parametrize("framed", [True, False])
+def test_round_trips(sim_server, framed):
+    connection = client.Connection("localhost", sim_server, framed=framed)
+    try:
+        assert connection.request("LS::Q::*IDN?", timeout=5).strip() == "LSCI,MODEL340,SIMULATED,1.0"
+        # replies to messages sent together come back to the right request, whatever order they finish in
+        futures = {channel: connection.submit(f"LS::Q::KRDG? {channel}") for channel in "ABCD"}
+        futures["PID"] = connection.submit("ls::q::pid? 1")
+        assert all(float(futures[channel].result(5)) > 0 for channel in "ABCD")
+        assert len(futures["PID"].result(5).split(',')) == 3
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("framed", [True, False])
+def test_array_round_trip(sim_server, framed):
+    device = client.Device("LS", port=sim_server, persistent=True, framed=framed)
+    pid = device.query_array("PID? 1")
+    assert isinstance(pid, np.ndarray)
+    assert np.array_equal(pid, [float(x) for x in device.query("PID? 1").split(',')])
+
+
+def test_bad_subscription_only_ends_its_own_stream(sim_server):
+    device = client.Device("LS", port=sim_server, persistent=True)
+    connection = client.get_connection("localhost", sim_server)
+    errors = []
+    failed = threading.Event()
+
+    def on_error(error):
+        errors.append(error)
+        failed.set()
+
+    client.PolledChannel("NOPE", port=sim_server).subscribe(lambda timestamp, value: None, on_error)
+    assert failed.wait(5)
+    assert isinstance(errors[0], IOError)
+    # the shared connection is still open and still answers everything else
+    assert connection.open
+    assert client.get_connection("localhost", sim_server) is connection
+    assert float(device.query("KRDG? A")) > 0
+
+
+def test_failing_callback_only_ends_its_own_stream(sim_server):
+    channel = client.PolledChannel("TEMP_A", port=sim_server)
+    good = threading.Event()
+    failed = threading.Event()
+
+    def broken(timestamp, value):
+        raise RuntimeError("bug in the subscriber")
+
+    channel.subscribe(broken, lambda error: failed.set())
+    channel.subscribe(lambda timestamp, value: good.set())
+    assert failed.wait(5)
+    assert good.wait(5)
+    assert client.get_connection("localhost", sim_server).open
+    channel.unsubscribe(broken)
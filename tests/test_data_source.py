@@ -0,0 +1,91 @@
+import numpy as np
+import binary_data
+import Plotting_Scripts.data_source as data_source
+
+
+def append(path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def test_column_buffer_grows():
+    buffer = data_source.ColumnBuffer(2, capacity=4)
+    for start in range(0, 100, 10):
+        buffer.extend(np.arange(start, start + 10, dtype=float).repeat(2).reshape(10, 2))
+    assert len(buffer) == 100
+    assert np.array_equal(buffer.column(1), np.arange(100.))
+
+
+def test_only_new_rows_are_read(tmp_path):
+    filename = str(tmp_path / "run.csv")
+    append(filename, "# made today\ntime,A,B\n0,300,301\n")
+    tail = data_source.CSVTail(filename)
+    assert tail.read_new() == 1
+    assert tail.labels == ["time", "A", "B"]
+    append(filename, "1,299,300\n2,298,299\n")
+    assert tail.read_new() == 2
+    assert tail.read_new() == 0
+    assert np.array_equal(tail.column(1), [300., 299., 298.])
+
+
+def test_partial_last_line_waits(tmp_path):
+    filename = str(tmp_path / "run.csv")
+    append(filename, "time,A\n0,300\n1,29")
+    tail = data_source.CSVTail(filename)
+    assert tail.read_new() == 1
+    append(filename, "9.5\n")
+    assert tail.read_new() == 1
+    assert np.array_equal(tail.column(1), [300., 299.5])
+
+
+def test_labels_only_come_from_the_first_row(tmp_path):
+    filename = str(tmp_path / "run.csv")
+    append(filename, "0,300\n")
+    tail = data_source.CSVTail(filename)
+    tail.read_new()
+    append(filename, "oops,garbage\n1,299\n")
+    assert tail.read_new() == 1
+    assert tail.labels is None
+    assert np.array_equal(tail.column(1), [300., 299.])
+
+
+def test_comments_before_the_labels(tmp_path):
+    filename = str(tmp_path / "run.csv")
+    append(filename, "# made today\n")
+    tail = data_source.CSVTail(filename)
+    assert tail.read_new() == 0
+    append(filename, "time,A\n0,300\n")
+    assert tail.read_new() == 1
+    assert tail.labels == ["time", "A"]
+
+
+def test_rows_that_dont_fit_are_skipped(tmp_path):
+    filename = str(tmp_path / "run.csv")
+    append(filename, "0,300\n1,299,5\n2,nan\n3,x\n")
+    tail = data_source.CSVTail(filename)
+    assert tail.read_new() == 2
+    assert np.array_equal(tail.column(0), [0., 2.])
+
+
+def test_replaced_file_starts_over(tmp_path):
+    filename = str(tmp_path / "run.csv")
+    append(filename, "time,A\n0,300\n1,299\n")
+    tail = data_source.CSVTail(filename)
+    tail.read_new()
+    with open(filename, 'w') as f:
+        f.write("time,B\n5,1\n")
+    assert tail.read_new() == 1
+    assert tail.labels == ["time", "B"]
+    assert np.array_equal(tail.column(0), [5.])
+
+
+def test_binary_tail(tmp_path):
+    filename = str(tmp_path / "run.bin")
+    with binary_data.BinaryDataWriter(filename, ["t", "y"]) as f:
+        f.append([0., 1.])
+        tail = data_source.open_source(filename)
+        assert isinstance(tail, data_source.BinaryTail)
+        assert tail.labels == ["t", "y"] and len(tail) == 1
+        f.append_rows([[1., 2.], [2., 3.]])
+        assert tail.read_new() == 2
+    assert np.array_equal(tail.column(1), [1., 2., 3.])
@@ -0,0 +1,38 @@
+import numpy as np
+import Plotting_Scripts.decimate as decimate
+
+
+def test_visible_range_has_a_point_past_each_edge():
+    x = np.arange(100.)
+    assert decimate.visible_range(x, 10.5, 20.5) == (10, 22)
+    assert decimate.visible_range(x, -5., 500.) == (0, 100)
+
+
+def test_short_curves_are_left_alone():
+    x = np.arange(50.)
+    y = np.sin(x)
+    new_x, new_y = decimate.peak_decimate(x, y, 0., 49., 100)
+    assert np.array_equal(new_x, x) and np.array_equal(new_y, y)
+
+
+def test_spikes_survive():
+    x = np.arange(1_000_003.)
+    y = np.zeros_like(x)
+    y[123_457] = 10.
+    y[876_543] = -10.
+    y[-1] = 3.
+    new_x, new_y = decimate.peak_decimate(x, y, x[0], x[-1], 200)
+    assert len(new_x) <= 2 * 200 + 2
+    assert new_y.max() == 10. and new_y.min() == -10.
+    assert 123_457. in new_x and 876_543. in new_x
+    # the points left over at the end make one more bin
+    assert new_x[-1] == x[-1]
+    assert np.all(np.diff(new_x) >= 0)
+
+
+def test_only_the_view_is_decimated():
+    x = np.arange(10_000.)
+    y = x.copy()
+    new_x, new_y = decimate.peak_decimate(x, y, 2000., 3000., 50)
+    assert new_x[0] >= 1999. and new_x[-1] <= 3001.
+    assert len(new_x) <= 2 * 50 + 2
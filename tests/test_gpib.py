@@ -0,0 +1,129 @@
+import json
+import time
+import pytest
+import gpib
+import simulated
+import gpib_comm_server as server
+import gpib_client_tools as client
+
+
+class FakeResource(simulated.SimulatedResource):
+    """Keeps track of being closed, and of what happened in what order"""
+    def __init__(self, name="fake", events=None, latency=0.):
+        super(FakeResource, self).__init__(latency=latency, jitter=0.)
+        self.name = name
+        self.events = [] if events is None else events
+        self.closed = False
+
+    def query(self, message: str) -> str:
+        self.events.append(("start", message))
+        reply = super(FakeResource, self).query(message)
+        self.events.append(("end", message))
+        return reply
+
+    def close(self):
+        self.events.append(("close", self.name))
+        self.closed = True
+
+
+class FakeResourceManager:
+    def __init__(self):
+        self.opened = []
+
+    def open_resource(self, resource_name):
+        self.opened.append(resource_name)
+        return FakeResource(resource_name)
+
+
+@pytest.fixture
+def resource_manager(monkeypatch):
+    """Stands in for pyvisa, so VISA devices can be opened without any hardware"""
+    manager = FakeResourceManager()
+    monkeypatch.setattr(gpib, "_resource_manager", manager)
+    return manager
+
+
+def test_visa_devices_open_when_first_used(resource_manager):
+    device = gpib.Device(12, gpib_num=1)
+    assert not device.is_open
+    assert resource_manager.opened == []
+    assert device.id().startswith(simulated.SimulatedResource.idn)
+    device.query("*IDN?")
+    assert resource_manager.opened == ["GPIB1::12::INSTR"]
+    # every device shares the same ResourceManager
+    assert gpib.Device(13).rm is device.rm is resource_manager
+
+
+def test_closed_visa_device_opens_again(resource_manager):
+    device = gpib.Device(12)
+    device.query("*IDN?")
+    first = device.dev
+    device.close()
+    assert first.closed and not device.is_open
+    device.query("*IDN?")
+    assert resource_manager.opened == ["GPIB0::12::INSTR"] * 2
+
+
+@pytest.mark.parametrize("backend", ["sim", FakeResource()])
+def test_closed_simulated_device_still_works(backend):
+    device = gpib.Device(3, backend=backend)
+    resource = device.dev
+    device.close()
+    assert device.dev is resource
+    assert device.id().startswith(("LSCI", simulated.SimulatedResource.idn))
+
+
+def test_registry_settings(resource_manager, tmp_path):
+    made = gpib.Device(5, backend="sim")
+    registry = gpib.DeviceRegistry({"ls": 12, "Scope": {"addr": 10, "gpib_num": 1}, "SIM": made})
+    assert registry.ids() == ["LS", "SCOPE", "SIM"]
+    assert "Ls" in registry and "nope" not in registry
+    assert registry.get("scope").resource_name == "GPIB1::10::INSTR"
+    assert registry.get("sim") is made
+    assert registry.get("nope") is None
+    # nothing gets opened just by being in the registry
+    assert resource_manager.opened == []
+
+    config = tmp_path / "instruments.json"
+    config.write_text(json.dumps({"LS": 12, "SCOPE": {"addr": 10, "gpib_num": 1}}))
+    assert gpib.DeviceRegistry.from_file(str(config)).get("SCOPE").resource_name == "GPIB1::10::INSTR"
+
+
+def test_registry_closes_replaced_and_removed_devices():
+    old = FakeResource("old")
+    new = FakeResource("new")
+    registry = gpib.DeviceRegistry({"LS": gpib.Device(12, backend=old)})
+    registry.add("ls", gpib.Device(12, backend=new))
+    assert old.closed and not new.closed
+    registry.remove("LS")
+    assert new.closed
+    assert "LS" not in registry
+    registry.remove("LS")
+
+
+def test_server_removes_an_instrument_after_its_messages(sim_server):
+    events = []
+    slow = FakeResource("slow", events, latency=0.3)
+    server.Interpreter.devices.add("SLOW", gpib.Device(14, backend=slow))
+    connection = client.Connection("localhost", sim_server)
+    try:
+        query = connection.submit("SLOW::Q::*IDN?")
+        time.sleep(0.05)
+        assert connection.request("REGISTRY::REMOVE::SLOW", timeout=5) == "empty"
+        assert query.result(5).startswith(simulated.SimulatedResource.idn)
+        assert events == [("start", "*IDN?"), ("end", "*IDN?"), ("close", "slow")]
+        assert "SLOW" not in server.Interpreter.devices
+    finally:
+        connection.close()
+        server.Interpreter.devices.remove("SLOW")
+
+
+def test_server_adds_and_lists_instruments(sim_server, resource_manager):
+    assert client.send("REGISTRY::ADD::scope,10,1", port=sim_server) == "empty"
+    try:
+        assert json.loads(client.send("REGISTRY::LIST", port=sim_server))["SCOPE"] == "GPIB1::10::INSTR"
+        assert client.send("SCOPE::Q::*IDN?", port=sim_server).startswith(simulated.SimulatedResource.idn)
+        assert resource_manager.opened == ["GPIB1::10::INSTR"]
+    finally:
+        assert client.send("REGISTRY::REMOVE::SCOPE", port=sim_server) == "empty"
+    assert "SCOPE" not in json.loads(client.send("REGISTRY::LIST", port=sim_server))
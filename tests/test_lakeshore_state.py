@@ -0,0 +1,67 @@
+import lakeshore_state
+
+
+class FakeLakeShore:
+    """Answers queries from a dict, and gives back the next of write_replies for every write"""
+    compound_queries = True
+
+    def __init__(self, write_replies=()):
+        self.answers = {"RANGE?": "2"}
+        for loop in (1, 2):
+            self.answers.update({f"PID? {loop}": "+50.0,+20.0,+0.0", f"SETP? {loop}": "+300.0",
+                                 f"RAMP? {loop}": "1,+10.0"})
+        self.write_replies = list(write_replies)
+        self.written = []
+        self.queries = []
+
+    def query(self, message):
+        self.queries.append(message)
+        return self.answers[message]
+
+    def query_many(self, messages):
+        return [self.query(message) for message in messages]
+
+    def write(self, message):
+        self.written.append(message)
+        return self.write_replies.pop(0) if self.write_replies else "empty"
+
+
+def test_successful_write_updates_the_copy():
+    device = FakeLakeShore(["empty"])
+    state = lakeshore_state.LakeShoreState(device)
+    assert state.set('setpoint', 310., 1)
+    assert state.get('setpoint', 1) == 310.
+    assert device.queries == []
+
+
+def test_failed_write_is_asked_for_again():
+    device = FakeLakeShore(["timed out"])
+    state = lakeshore_state.LakeShoreState(device)
+    assert state.get('setpoint', 1) == 300.
+    assert not state.set('setpoint', 310., 1)
+    assert state.get('setpoint', 1) == 300.
+    assert device.queries == ["SETP? 1", "SETP? 1"]
+
+
+def test_failed_staged_write_forgets_every_staged_setting():
+    device = FakeLakeShore(["timed out"])
+    state = lakeshore_state.LakeShoreState(device)
+    state.refresh()
+    with state.staging():
+        state.set('setpoint', 310., 1)
+        state.set('ramp', (1, 5.), 1)
+    assert device.written == ["SETP 1, 310.0;RAMP 1, 1, 5.0"]
+    assert ('setpoint', 1) not in state.values and ('ramp', 1) not in state.values
+    assert state.values[('pid', 1)] == (50., 20., 0.)
+    assert state.get('ramp', 1) == (1, 10.)
+
+
+def test_successful_staged_write_updates_the_copy():
+    device = FakeLakeShore()
+    state = lakeshore_state.LakeShoreState(device)
+    with state.staging():
+        state.set('setpoint', 310., 1)
+        state.set('range', 3)
+    assert len(device.written) == 1
+    assert state.get('setpoint', 1) == 310. and state.get('range') == 3
+    assert device.queries == []
@@ -0,0 +1,50 @@
+import numpy as np
+import Plotting_Scripts.data_source as data_source
+import Plotting_Scripts.lod as lod
+
+
+def write_csv(path, rows=5000):
+    x = np.arange(rows, dtype=float)
+    np.savetxt(path, np.stack([x, np.sin(x / 100)], axis=1), delimiter=',', header='time,y', comments='')
+    return str(path)
+
+
+def test_levels_keep_the_extremes():
+    x = np.arange(4096, dtype=float)
+    y = np.zeros(4096)
+    y[1000] = 5.
+    pyramid = lod.Pyramid.build(x, [y], factor=8, min_bins=16)
+    for depth in range(1, pyramid.depth + 1):
+        assert pyramid.level(depth)['max'].max() == 5.
+        assert pyramid.level(depth)['count'].sum() == 4096
+    assert pyramid.query(0, 0, 4095, 4096, 100) is not None
+    assert pyramid.query(0, 0, 4095, 50, 100) is None
+
+
+def test_open_pyramid_reuses_the_saved_one(tmp_path):
+    filename = write_csv(tmp_path / 'run.csv')
+    source = data_source.open_source(filename)
+    source.read_new()
+    built = lod.open_pyramid(filename, source)
+    assert built.stamp == lod.file_stamp(filename)
+    with lod.open_pyramid(filename, source) as loaded:
+        assert loaded.stamp == built.stamp
+        assert loaded.rows == built.rows == 5000
+        assert np.allclose(loaded.level(1)['mean'], built.level(1)['mean'])
+    assert loaded.store.fid is None
+    # levels that were read before closing stay usable
+    assert len(loaded.level(1)['x'])
+
+
+def test_saved_pyramid_for_a_changed_file_is_not_used(tmp_path):
+    filename = write_csv(tmp_path / 'run.csv')
+    source = data_source.open_source(filename)
+    source.read_new()
+    lod.open_pyramid(filename, source).close()
+    assert lod.Pyramid.load(lod.cache_name(filename), [0., 0.]) is None
+    with open(filename, 'a') as f:
+        f.write('5000,0.5\n')
+    source.read_new()
+    pyramid = lod.open_pyramid(filename, source)
+    assert pyramid.rows == 5001
+    assert pyramid.stamp == lod.file_stamp(filename)
@@ -0,0 +1,64 @@
+import json
+import urllib.request
+import gpib_comm_server as server
+import gpib_client_tools as client
+from conftest import free_port
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = server.Histogram()
+    for seconds in (0.0001, 0.003, 0.003, 20.):
+        histogram.observe(seconds)
+    buckets = dict(histogram.cumulative())
+    assert buckets[0.0005] == 1
+    assert buckets[0.005] == 3
+    assert buckets[10.] == 3
+    assert buckets["+Inf"] == 4
+    assert histogram.to_dict()["mean"] == sum((0.0001, 0.003, 0.003, 20.)) / 4
+
+
+def test_snapshot_counts_commands_and_timeouts():
+    metrics = server.Metrics()
+    metrics.record_command("LS", "Q", "KRDG? A", "300.0", 0.01)
+    metrics.record_command("LS", "Q", "KRDG? B", "timed out", 1.)
+    metrics.record_command("LS", "Q", "PID? 1", "50,20,0", 0., cached=True)
+    metrics.record_error()
+    snapshot = json.loads(json.dumps(metrics.snapshot()))
+    commands = {command["command"]: command for command in snapshot["commands"]}
+    assert commands["KRDG?"]["count"] == 2
+    assert commands["KRDG?"]["timeouts"] == 1
+    assert commands["KRDG?"]["latency"]["count"] == 2
+    assert commands["PID?"]["cached"] == 1
+    assert snapshot["errors"] == 1
+
+
+def test_prometheus_text(sim_server):
+    client.send("LS::Q::KRDG? A", port=sim_server)
+    text = server.Interpreter.metrics.prometheus()
+    assert "# TYPE gpib_requests_total counter" in text
+    assert "# TYPE gpib_request_seconds histogram" in text
+    assert 'gpib_request_seconds_bucket{device="LS",command="KRDG?",le="+Inf"}' in text
+    assert 'gpib_bus_queue_depth{bus="0"}' in text
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            float(line.rsplit(" ", 1)[1])
+
+
+def test_stats_reply(sim_server):
+    client.send("LS::Q::KRDG? A", port=sim_server)
+    stats = json.loads(client.send("STATS", port=sim_server))
+    assert stats["connections_total"] >= stats["connections_open"] >= 1
+    assert "0" in stats["buses"] and "0" in stats["bus_wait"]
+    assert any(command["device"] == "LS" and command["count"] > 0 for command in stats["commands"])
+
+
+def test_serve_metrics_only_listens_locally():
+    httpd = server.serve_metrics(free_port())
+    try:
+        assert httpd.server_address[0] == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{httpd.server_address[1]}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "gpib_uptime_seconds" in response.read().decode()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
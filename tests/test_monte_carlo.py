@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+import monte_carlo as mc
+
+PARAMETERS = dict(g=mc.Normal(2, 0.1), u=20, N=50, L=1000, hS=mc.Uniform(490, 510), epsS=mc.Normal(3.9, 0.05))
+
+
+@pytest.mark.parametrize("samples, batch_size", [(0, 100), (-5, 100), (10, 0)])
+def test_needs_samples_and_batches(samples, batch_size):
+    with pytest.raises(ValueError):
+        mc.monte_carlo(samples, batch_size=batch_size, **PARAMETERS)
+
+
+def test_matches_statistics_of_all_the_samples():
+    # monte_carlo gives each batch a seed spawned from the one it was given
+    values = mc.sample_batch(mc.calculations.capacitance, PARAMETERS, np.random.SeedSequence(3).spawn(1)[0], 20000)
+    result = mc.monte_carlo(20000, batch_size=20000, seed=3, spec=(2.4, 2.5), **PARAMETERS)
+    assert result.samples == 20000
+    assert result.mean == pytest.approx(values.mean())
+    assert result.std == pytest.approx(values.std(ddof=1))
+    assert result.yield_fraction == np.mean((values >= 2.4) & (values <= 2.5))
+    for q in (0.01, 0.5, 0.99):
+        assert result.quantile(q) == pytest.approx(np.quantile(values, q), rel=2e-3)
+
+
+def test_batches_merge_like_one():
+    one = mc.monte_carlo(30000, batch_size=30000, seed=1, hist_range=(2, 3), **PARAMETERS)
+    values = mc.sample_batch(mc.calculations.capacitance, PARAMETERS, np.random.SeedSequence(1).spawn(1)[0], 30000)
+    batched = mc.monte_carlo(30000, batch_size=7000, seed=1, hist_range=(2, 3), **PARAMETERS)
+    assert one.mean == pytest.approx(values.mean())
+    assert batched.samples == 30000
+    assert batched.mean == pytest.approx(one.mean, rel=1e-2)
+    assert batched.histogram.counts.sum() + batched.histogram.underflow + batched.histogram.overflow == 30000
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import gpib_protocol as protocol
+import gpib_client_tools as client
+
+
+@pytest.mark.parametrize("array", [np.arange(10, dtype=float), np.ones((3, 4), dtype=np.int32),
+                                   np.array([], dtype=np.float32), np.arange(6, dtype='>f8').reshape(2, 3)])
+def test_array_frames_round_trip(array):
+    frame = protocol.encode_reply(7, array)
+    frames = protocol.FrameReader().feed(frame)
+    assert len(frames) == 1
+    kind, req_id, body = frames[0]
+    assert (kind, req_id) == (protocol.ARRAY, 7)
+    decoded = protocol.decode_reply(kind, body)
+    assert decoded.shape == array.shape
+    assert np.array_equal(decoded, array)
+
+
+def test_frames_split_across_reads():
+    data = protocol.encode_reply(1, "first") + protocol.encode_reply(2, "second reply")
+    reader = protocol.FrameReader()
+    frames = []
+    for ii in range(0, len(data), 5):
+        frames += reader.feed(data[ii:ii + 5])
+    assert [(req_id, protocol.decode_reply(kind, body)) for kind, req_id, body in frames] == \
+        [(1, "first"), (2, "second reply")]
+
+
+def test_server_errors_become_error_frames():
+    kind, req_id, body = protocol.FrameReader().feed(protocol.encode_reply(3, protocol.ServerError("error: bad")))[0]
+    assert kind == protocol.ERROR
+    with pytest.raises(protocol.ServerError, match="error: bad"):
+        protocol.decode_reply(kind, body)
+    assert protocol.reply_to_text(protocol.ServerError("error: bad")) == "error: bad"
+
+
+def test_framed_client_gets_server_errors_raised(sim_server):
+    connection = client.Connection("localhost", sim_server, framed=True)
+    try:
+        with pytest.raises(protocol.ServerError, match="^error: "):
+            connection.request("LS", timeout=5)
+        # the connection is still fine afterwards
+        assert connection.request("LS::Q::*IDN?", timeout=5).startswith("LSCI")
+    finally:
+        connection.close()
+
+
+def test_tagged_client_gets_server_errors_as_text(sim_server):
+    connection = client.Connection("localhost", sim_server, framed=False)
+    try:
+        assert connection.request("LS", timeout=5).startswith("error: ")
+    finally:
+        connection.close()
@@ -0,0 +1,80 @@
+import pytest
+import simulated
+import temperature_controller
+import gpib_client_tools as client
+
+
+class FlakyLakeShore(simulated.SimulatedLakeShore):
+    """Times out on the first timeouts compound queries, and then answers normally"""
+    def __init__(self, timeouts: int, **kwargs):
+        super(FlakyLakeShore, self).__init__(latency={"default": 0.}, jitter=0., **kwargs)
+        self.timeouts = timeouts
+
+    def query(self, message):
+        if ';' in message and self.timeouts > 0:
+            self.timeouts -= 1
+            raise self.timeout()
+        return super(FlakyLakeShore, self).query(message)
+
+
+class NoCompoundLakeShore(simulated.SimulatedLakeShore):
+    """Only answers the first query of a compound one"""
+    def handle(self, message):
+        return super(NoCompoundLakeShore, self).handle(message.split(';')[0])
+
+
+@pytest.mark.parametrize("timeouts", [1, 2])
+def test_timeouts_dont_turn_off_compound_queries(timeouts):
+    lakeshore = temperature_controller.LakeShore(12, 331, backend=FlakyLakeShore(timeouts))
+    assert len(lakeshore.read_temperatures()) == 2
+    assert lakeshore.compound_queries
+
+
+def test_repeated_timeouts_turn_off_compound_queries():
+    lakeshore = temperature_controller.LakeShore(12, 331, backend=FlakyLakeShore(100))
+    for _ in range(3):
+        assert len(lakeshore.read_temperatures()) == 2
+    assert not lakeshore.compound_queries
+
+
+def test_wrong_number_of_replies_turns_off_compound_queries():
+    lakeshore = temperature_controller.LakeShore(12, 331, backend=NoCompoundLakeShore(latency={"default": 0.}))
+    assert len(lakeshore.read_temperatures()) == 2
+    assert not lakeshore.compound_queries
+
+
+def client_lakeshore(replies: list):
+    """A client LakeShore whose compound queries get the given replies in turn (single queries get "300.0")"""
+    lakeshore = client.LakeShore(331)
+    lakeshore.query = lambda msg: replies.pop(0) if ';' in msg else "300.0"
+    return lakeshore
+
+
+def test_client_retries_a_timeout():
+    lakeshore = client_lakeshore(["timed out", "300.0;301.0"])
+    assert list(lakeshore.read_temperatures()) == [300., 301.]
+    assert lakeshore.compound_queries
+
+
+def test_client_keeps_compound_queries_after_one_bad_call():
+    lakeshore = client_lakeshore(["timed out", "timed out", "300.0;301.0"])
+    assert list(lakeshore.read_temperatures()) == [300., 300.]
+    assert lakeshore.compound_queries
+    assert list(lakeshore.read_temperatures()) == [300., 301.]
+
+
+def test_client_turns_off_compound_queries_on_an_error_reply():
+    lakeshore = client_lakeshore(["error: bad message"])
+    assert list(lakeshore.read_temperatures()) == [300., 300.]
+    assert not lakeshore.compound_queries
+
+
+def test_both_lakeshores_answer_the_same_way(sim_server):
+    direct = temperature_controller.LakeShore(12, 340, backend=simulated.SimulatedLakeShore(model=340, latency=0.))
+    served = client.LakeShore(340, port=sim_server, persistent=True)
+    for lakeshore in (direct, served):
+        assert isinstance(lakeshore.read_pid(1), tuple)
+        assert lakeshore.read_temperatures(['a', 'D']).shape == (2,)
+        assert lakeshore.read_all().shape == (len(lakeshore.inputs) + 2,)
+        assert lakeshore.read_temperature('C') > 0
+        assert lakeshore.compound_queries
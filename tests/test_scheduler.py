@@ -0,0 +1,67 @@
+import threading
+import time
+import pytest
+import data_taker
+
+
+def failing_measure(after: int):
+    calls = [0]
+
+    def measure():
+        calls[0] += 1
+        if calls[0] > after:
+            raise ConnectionError("server went away")
+        return [calls[0]]
+    return measure
+
+
+def run_in_thread(scheduler, duration):
+    """Run the scheduler in a thread, so a test can't hang forever if run() never returns"""
+    outcome = {}
+
+    def target():
+        try:
+            outcome['report'] = scheduler.run(duration)
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "Scheduler.run didn't return"
+    return outcome
+
+
+@pytest.mark.parametrize("duration", [None, 60.])
+def test_measurement_error_stops_and_propagates(duration):
+    other_samples = []
+    scheduler = data_taker.Scheduler([data_taker.MeasurementGroup("bad", failing_measure(3), rate=50.),
+                                      data_taker.MeasurementGroup("good", lambda: [0], rate=50.,
+                                                                  callback=other_samples.append)],
+                                     verbose=False)
+    started = time.monotonic()
+    outcome = run_in_thread(scheduler, duration)
+    assert isinstance(outcome.get('error'), ConnectionError)
+    assert time.monotonic() - started < 5.
+    # the other group was stopped too
+    assert not scheduler.threads
+    count = len(other_samples)
+    time.sleep(0.1)
+    assert len(other_samples) == count
+
+
+def test_callback_error_propagates():
+    def callback(sample):
+        raise ValueError("can't save")
+    scheduler = data_taker.Scheduler([data_taker.MeasurementGroup("g", lambda: [0], rate=50., callback=callback)],
+                                     verbose=False)
+    assert isinstance(run_in_thread(scheduler, None).get('error'), ValueError)
+
+
+def test_samples_are_evenly_spaced():
+    samples = []
+    scheduler = data_taker.Scheduler([data_taker.MeasurementGroup("g", lambda: [0], rate=50., callback=samples.append)],
+                                     verbose=False)
+    report = run_in_thread(scheduler, 0.5)['report'][0]
+    assert report['samples'] == len(samples) >= 20
+    assert [sample.index for sample in samples] == list(range(len(samples)))
+    assert max(sample.lateness for sample in samples) < 0.02 * 5
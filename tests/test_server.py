@@ -0,0 +1,225 @@
+import json
+import threading
+import time
+import pytest
+import gpib
+import simulated
+import gpib_comm_server as server
+import gpib_client_tools as client
+from conftest import free_port, wait_for_server
+
+
+@pytest.fixture
+def two_buses(sim_server):
+    """Two more simulated LakeShores that take 0.3 s to answer anything: SLOW0 on bus 0 next to LS, and SLOW1 on
+    bus 1"""
+    for dev_id, gpib_num in (("SLOW0", 0), ("SLOW1", 1)):
+        backend = simulated.SimulatedLakeShore(model=340, latency=0.3, jitter=0.)
+        server.Interpreter.devices.add(dev_id, gpib.Device(10 + gpib_num, gpib_num, backend=backend))
+    yield sim_server
+    for dev_id in ("SLOW0", "SLOW1"):
+        server.Interpreter.devices.remove(dev_id)
+
+
+def timed_requests(port, messages) -> float:
+    """Sends the messages all at once and gives back how long it took for every reply to come back"""
+    connection = client.Connection("localhost", port)
+    try:
+        started = time.perf_counter()
+        futures = [connection.submit(message) for message in messages]
+        for future in futures:
+            assert float(future.result(5)) > 0
+        return time.perf_counter() - started
+    finally:
+        connection.close()
+
+
+def test_different_buses_run_at_the_same_time(two_buses):
+    assert timed_requests(two_buses, ["SLOW0::Q::KRDG? A", "SLOW1::Q::KRDG? A"]) < 0.55
+
+
+def test_one_bus_runs_one_message_at_a_time(two_buses):
+    assert timed_requests(two_buses, ["SLOW0::Q::KRDG? A", "SLOW0::Q::KRDG? B"]) >= 0.6
+
+
+def test_cache_answers_repeated_queries():
+    cache = server.ResponseCache()
+    assert cache.get("LS", "PID? 1") is None
+    cache.put("LS", "PID? 1", "+50.0,+20.0,+0.0")
+    assert cache.get("LS", "PID? 1") == "+50.0,+20.0,+0.0"
+    # other instruments, other loops, and queries that aren't cached don't get it
+    assert cache.get("LS2", "PID? 1") is None
+    assert cache.get("LS", "PID? 2") is None
+    cache.put("LS", "KRDG? A", "+20.0")
+    assert cache.get("LS", "KRDG? A") is None
+    assert cache.stats()["by_command"]["PID?"] == {"hits": 1, "misses": 3}
+
+
+def test_cache_throws_out_what_writes_change():
+    cache = server.ResponseCache()
+    for message in ("PID? 1", "SETP? 1", "RAMP? 1", "*IDN?", "SETP? 1;PID? 1"):
+        cache.put("LS", message, "reply")
+    cache.put("LS2", "PID? 1", "reply")
+    cache.invalidate("LS", "PID 1,50,20,0")
+    assert cache.get("LS", "PID? 1") is None
+    assert cache.get("LS", "SETP? 1;PID? 1") is None
+    assert cache.get("LS", "SETP? 1") == "reply"
+    assert cache.get("LS2", "PID? 1") == "reply"
+    cache.invalidate("LS", "RAMP 1,1,5")
+    assert cache.get("LS", "SETP? 1") is None
+    assert cache.get("LS", "*IDN?") == "reply"
+    cache.invalidate("LS", "*RST")
+    assert cache.get("LS", "*IDN?") is None
+    assert cache.get("LS2", "PID? 1") == "reply"
+
+
+def test_server_cache_hits_and_write_invalidation(sim_server):
+    device = client.Device("LS", port=sim_server, persistent=True)
+
+    def pid_stats():
+        return json.loads(device.send("CACHE::STATS"))["by_command"].get("PID?", {"hits": 0, "misses": 0})
+
+    device.send("CACHE::CLEAR")
+    before = pid_stats()
+    first = device.query("PID? 2")
+    assert device.query("PID? 2") == first
+    after = pid_stats()
+    assert (after["hits"] - before["hits"], after["misses"] - before["misses"]) == (1, 1)
+
+    assert device.write("PID 2,12.5,3,0") == "empty"
+    assert device.query("PID? 2").strip() == "+12.5,+3.0,+0.0"
+    assert pid_stats()["misses"] - after["misses"] == 1
+
+
+def test_cache_hit_does_not_wait_for_the_bus(sim_server, monkeypatch):
+    connection = client.Connection("localhost", sim_server)
+    try:
+        first = connection.request("LS::Q::PID? 1", timeout=5)
+        backend = server.Interpreter.find_instrument("LS").dev
+        monkeypatch.setattr(backend, "latency", {"default": 0.02, "KRDG?": 1.})
+        slow = connection.submit("LS::Q::KRDG? B")
+        time.sleep(0.05)
+        started = time.perf_counter()
+        assert connection.request("LS::Q::PID? 1", timeout=0.5) == first
+        assert time.perf_counter() - started < 0.5
+        assert not slow.done()
+        assert float(slow.result(5)) > 0
+    finally:
+        connection.close()
+
+
+def test_query_after_a_waiting_write_gets_the_new_value(sim_server, monkeypatch):
+    connection = client.Connection("localhost", sim_server)
+    try:
+        connection.request("LS::W::PID 2,40,10,0", timeout=5)
+        assert connection.request("LS::Q::PID? 2", timeout=5).strip() == "+40.0,+10.0,+0.0"
+        backend = server.Interpreter.find_instrument("LS").dev
+        monkeypatch.setattr(backend, "latency", {"default": 0.02, "PID": 0.3})
+        write = connection.submit("LS::W::PID 2,41,11,0")
+        assert connection.request("LS::Q::PID? 2", timeout=5).strip() == "+41.0,+11.0,+0.0"
+        assert write.result(5) == "empty"
+        # once the write is done, the cache answers again
+        assert connection.request("LS::Q::PID? 2", timeout=5).strip() == "+41.0,+11.0,+0.0"
+    finally:
+        connection.close()
+
+
+class Recorder(simulated.SimulatedResource):
+    """Remembers every message exactly as the instrument got it"""
+    def __init__(self):
+        super(Recorder, self).__init__(latency=0., jitter=0.)
+        self.messages = []
+
+    def handle(self, message):
+        self.messages.append(message)
+        return super(Recorder, self).handle(message)
+
+
+@pytest.fixture
+def recorder():
+    backend = Recorder()
+    server.Interpreter.devices.add("REC", gpib.Device(9, backend=backend))
+    yield backend
+    server.Interpreter.devices.remove("REC")
+
+
+def test_batch_messages_keep_their_case_and_escapes(recorder):
+    batch = [["w", "DISP:TEXT 'Hello\\nWorld é'"], ["q", "*idn?"]]
+    replies = json.loads(server.Interpreter.parse("rec::b::" + json.dumps(batch)))
+    assert recorder.messages == ["DISP:TEXT 'Hello\\nWorld é'", "*idn?"]
+    assert replies[1].startswith(simulated.SimulatedResource.idn)
+
+
+def test_messages_keep_their_case(recorder):
+    server.Interpreter.parse("rec::w::mode lower")
+    assert recorder.messages == ["mode lower"]
+
+
+def test_plain_stats_is_not_cut_off(sim_server):
+    for _ in range(5):
+        client.send("LS::Q::KRDG? A", port=sim_server)
+    reply = client.send("STATS", port=sim_server)
+    assert len(reply) > 1024
+    assert "LS" in {command["device"] for command in json.loads(reply)["commands"]}
+
+
+def test_plain_query_after_stats(sim_server):
+    client.send("STATS", port=sim_server)
+    assert float(client.send("LS::Q::KRDG? A", port=sim_server)) > 0
+
+
+def idn_batch(port, count: int) -> list:
+    """A batch long enough that its message takes several recvs to come in"""
+    batch = client.Device("REC", port=port).batch()
+    for _ in range(count):
+        batch.query("*IDN?")
+    return batch.send()
+
+
+def test_long_plain_message(sim_server, recorder):
+    replies = idn_batch(sim_server, 400)
+    assert len(replies) == 400
+    assert all(reply.startswith(simulated.SimulatedResource.idn) for reply in replies)
+
+
+def test_long_plain_message_to_server_gpib(recorder):
+    port = free_port()
+    thread = threading.Thread(target=server.server_gpib, kwargs=dict(port=port, log_level="WARNING"), daemon=True)
+    thread.start()
+    wait_for_server(port)
+    try:
+        assert len(idn_batch(port, 400)) == 400
+        assert len(json.loads(client.send("STATS", port=port))["commands"]) > 0
+    finally:
+        client.send("shutdown", port=port)
+        thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_long_plain_message_to_server_echo_rev():
+    port = free_port()
+    thread = threading.Thread(target=server.server_echo_rev, kwargs=dict(port=port), daemon=True)
+    thread.start()
+    wait_for_server(port)
+    try:
+        message = ",".join(str(ii) for ii in range(20000))
+        assert client.send(message, port=port) == message[::-1]
+    finally:
+        client.send("shutdown", port=port)
+        thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_long_plain_message_to_concurrent_server():
+    port = free_port()
+    concurrent = server.ConcurrentServer(port=port)
+    thread = threading.Thread(target=concurrent.serve_forever, daemon=True)
+    thread.start()
+    wait_for_server(port)
+    try:
+        # one reply for the whole batch, however many recvs it took to come in
+        batch = json.dumps([["Q", "*IDN?"]] * 2000)
+        assert client.send(f"NOPE::B::{batch}", port=port) == "Did not give a valid device id"
+    finally:
+        concurrent.shutdown()
+        thread.join(5)
@@ -0,0 +1,10 @@
+import simulated
+
+
+def test_compound_query_within_one_clock_tick(monkeypatch):
+    """Several updates in the same tick of a coarse clock (like Windows' ~16 ms one) mustn't divide by zero"""
+    monkeypatch.setattr(simulated.time, "monotonic", lambda: 1000.)
+    lakeshore = simulated.SimulatedLakeShore(model=331, latency={"default": 0.})
+    replies = lakeshore.handle("KRDG? A;KRDG? B").split(';')
+    assert len(replies) == 2
+    assert all(float(reply) > 0 for reply in replies)
@@ -0,0 +1,86 @@
+import pytest
+import gpib_client_tools as client
+
+
+class FakeClock:
+    """Stands in for the time module, so waits of an hour take no time"""
+    def __init__(self):
+        self.now = 0.
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(client, "time", fake)
+    return fake
+
+
+@pytest.mark.parametrize("latency", [0., 0.02, 0.1, 1.])
+def test_settles_with_read_latency(clock, latency):
+    def read():
+        clock.now += latency
+        return 300.
+
+    result = client.wait_until_stable(300., read=read, tolerance=0.1, window=60., timeout=3600.)
+    assert result.value == 300.
+    assert 60. <= result.elapsed < 90.
+    assert result.readings[-1, 0] - result.readings[0, 0] >= 60.
+
+
+def test_waits_for_approach_then_window(clock):
+    def read():
+        clock.now += 0.05
+        return 300. - 20. * 0.99 ** clock.now
+
+    result = client.wait_until_stable(300., read=read, tolerance=0.5, window=60., timeout=3600.)
+    # 20 * 0.99**t is 0.5 at t = 367 s, and then it has to stay there for a window
+    assert 367. + 60. <= result.elapsed < 367. + 60. + 30.
+
+
+def test_timeout(clock):
+    with pytest.raises(TimeoutError):
+        client.wait_until_stable(400., read=lambda: 300., tolerance=0.1, window=60., timeout=600.)
+    assert clock.now == pytest.approx(600.)
+
+
+def test_timed_out_readings_are_skipped(clock):
+    replies = iter(["timed out", 300., "timed out"] * 1000)
+
+    def read():
+        clock.now += 0.05
+        return next(replies)
+
+    result = client.wait_until_stable(300., read=read, tolerance=0.1, window=60., timeout=3600.)
+    assert result.value == 300.
+    assert 60. <= result.elapsed < 90.
+
+
+class StuckChannel:
+    """A channel with readings waiting, whose server stops answering before the unsubscribe"""
+    def __init__(self, readings):
+        self.readings = readings
+        self.timeout = None
+
+    def subscribe(self, callback, on_error):
+        for reading in self.readings:
+            callback(*reading)
+
+    def unsubscribe(self, callback, timeout=None):
+        self.timeout = timeout
+        raise TimeoutError
+
+
+def test_unsubscribe_that_times_out(clock):
+    channel = StuckChannel([(t, 300.) for t in range(0, 70, 5)])
+    result = client.wait_until_stable(300., channel=channel, tolerance=0.1, window=60., timeout=3600.)
+    assert result.value == 300.
+    assert channel.timeout is not None